@@ -17,6 +17,11 @@ BASEDIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 
 SCRIPTDIR="$BASEDIR/pipeline"
 
+# Record stage and script metrics for this run (see stagemetrics.py)
+STAGEMETRICS="$BASEDIR/scripts/stagemetrics.py"
+export WIKIBERT_METRICS="${WIKIBERT_METRICS-$BASEDIR/data/$LC/metrics.jsonl}"
+export WIKIBERT_RUN_ID="$(date +%Y%m%dT%H%M%S)-$$"
+
 br=$(basename "$0")
 echo $'\n'"---------- $br $LC: START ----------" >&2
 echo "           $(date)"$'\n' >&2
@@ -26,10 +31,14 @@ for script in $(find "$SCRIPTDIR" -maxdepth 1 -name '[0-9]*.sh' | sort); do
     bs=$(basename "$script")
     echo $'\n'"---------- $br: RUNNING $bs ----------" >&2
     echo "           $(date)"$'\n' >&2
-    "$script" "$LC"
+    python3 "$STAGEMETRICS" run --stage "$bs" -- "$script" "$LC"
     echo $'\n'"---------- $br: COMPLETED $bs ----------" >&2
     echo "           $(date)"$'\n' >&2
 done
 
 echo $'\n'"---------- $br: DONE ----------" >&2
 echo "           $(date)"$'\n' >&2
+
+if [ -n "$WIKIBERT_METRICS" ]; then
+    python3 "$STAGEMETRICS" summary "$WIKIBERT_METRICS" >&2
+fi
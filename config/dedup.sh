@@ -0,0 +1,14 @@
+# Parameters passed to dedupdocs.py. Documents with estimated Jaccard
+# similarity of token 5-gram sets at or above the threshold are near
+# duplicates, and only the first of each cluster is kept. The memory
+# budget (in MB) applies to grouping documents by LSH band keys.
+
+DEDUP_PARAMS="
+--jobs 8
+--shingle-size 5
+--num-perm 128
+--bands 16
+--threshold 0.8
+--memory-budget 2048
+--seed 0
+"
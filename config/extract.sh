@@ -0,0 +1,9 @@
+# Extract texts from the multistream dump in parallel shards with
+# multistream.py (true), or from the regular dump with WikiExtractor
+# alone (false). Shards of STREAMS_PER_SHARD streams of 100 pages each
+# are extracted by EXTRACT_JOBS worker processes. Texts extracted from
+# the regular dump must be removed before switching to multistream.
+
+MULTISTREAM=false
+EXTRACT_JOBS=8
+STREAMS_PER_SHARD=100
@@ -1,5 +1,7 @@
 # Parameters passed to filterdocs.py. $LC is the two-character language
-# code given as an argument to the top-level scripts.
+# code given as an argument to the top-level scripts. --prescreen-reject
+# is not used, as documents with mostly non-word-char letters already
+# fail --foreign-ratio, which is checked before langdetect.
 
 DOC_FILTER_PARAMS="
 --min-sents 3
@@ -16,4 +18,16 @@ DOC_FILTER_PARAMS="
 --word-chars $DOC_FILTER_WORD_CHARS
 --language $LC
 --langdetect $LC
+--langdetect-sents 20
+--prescreen-accept 0.5
 "
+
+# Number of worker processes filtering files in 500-filter-docs.sh
+
+DOC_FILTER_JOBS=8
+
+# Set to "true" to tokenize and filter in one streaming step in
+# 500-filter-docs.sh, skipping 400-segment-texts.sh and the
+# tokenized-texts intermediate directory.
+
+FUSED_TOKENIZE_FILTER="false"
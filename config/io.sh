@@ -0,0 +1,12 @@
+# Compression of intermediate corpora: one of none, gz, bz2, xz or zst
+# (zst requires the zstandard package). Readers detect compressed
+# input from its contents, so codecs can be changed between runs.
+# Document indexes are only built for uncompressed files.
+
+TOKENIZED_TEXT_CODEC="none"
+FILTERED_TEXT_CODEC="none"
+DEDUPED_TEXT_CODEC="none"
+SAMPLED_DOC_CODEC="none"
+
+# Number of threads compressing the output of each script
+COMPRESS_THREADS=2
@@ -0,0 +1,9 @@
+# Parameters passed to sampledocs.py. With --hash, documents are
+# assigned to the sample by a seeded hash of their text, so files can
+# be processed independently (and in any order) with the same result.
+
+SAMPLEDOCS_PARAMS="
+--hash
+--seed 0
+"
+SAMPLED_DOC_RATIO=0.9
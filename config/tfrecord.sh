@@ -1,4 +1,8 @@
-# Parameters passed to bert/create_pretraining_data.py.
+# Parameters passed to bert/create_pretraining_data.py (through
+# scripts/createtfrecords.py, which tokenizes each file once for both
+# sequence lengths using up to CREATE_TFRECORD_JOBS processes).
+
+CREATE_TFRECORD_JOBS=2
 
 CREATE_TFRECORD_PARAMS="
 --vocab_file=$WORDPIECE_VOCAB_PATH
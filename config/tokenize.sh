@@ -0,0 +1,15 @@
+# Parameters passed to udtokenize.py. Adding e.g. --batch-size 100000
+# tokenizes several paragraphs per UDPipe call, which is faster but can
+# change sentence boundaries and tokens compared to the default
+# per-paragraph calls.
+
+TOKENIZER_PARAMS="
+--jobs 8
+"
+
+# Socket of a tokenization server shared by the pipelines on this host
+# (start it with "python3 scripts/udpipeserver.py serve --socket PATH").
+# udtokenize.py and segmentfilter.py send documents to the server when
+# it is running and load the UDPipe model themselves otherwise. Set
+# WIKIBERT_UDPIPE_SOCKET to an empty value to disable.
+export WIKIBERT_UDPIPE_SOCKET="${WIKIBERT_UDPIPE_SOCKET-$PWD/$DATA_DIR/udpipe.sock}"
@@ -0,0 +1,17 @@
+# Method for creating the WordPiece vocabulary: "sentencepiece" trains
+# a SentencePiece BPE model on sampled sentences and converts it with
+# sent2wordpiece, "wordpiece" learns the vocabulary directly from word
+# counts over all deduplicated texts with wordpiecevocab.py (skipping
+# sentence sampling and basic tokenization).
+
+VOCAB_METHOD="sentencepiece"
+
+# Parameters passed to wordpiecevocab.py
+
+WORDPIECEVOCAB_PARAMS="
+--vocab-size 20000
+--character-coverage 0.9999
+--min-frequency 2
+--jobs 8
+--memory-budget 8192
+"
@@ -7,6 +7,15 @@ source "$PIPELINE_DIR/common.sh"
 
 mkdir -p "$WIKI_DUMP_DIR"
 
+if [ "$MULTISTREAM" = "true" ]; then
+    if [ -s "$WIKI_INDEX_PATH" ]; then
+	echo "$SCRIPT: $WIKI_INDEX_PATH exists, skipping download." >&2
+    else
+	echo "$SCRIPT: downloading $WIKI_INDEX_URL to $WIKI_INDEX_PATH ..." >&2
+	wget -O "$WIKI_INDEX_PATH" "$WIKI_INDEX_URL"
+    fi
+fi
+
 if [ -s "$WIKI_DUMP_PATH" ]; then
     echo "$SCRIPT: $WIKI_DUMP_PATH exists, skipping download." >&2
     exit 0
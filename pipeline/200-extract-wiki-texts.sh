@@ -18,6 +18,33 @@ fi
 
 mkdir -p "$WIKI_TEXT_DIR"
 
+WIKIEXTRACTOR_PARAMS="--filter_disambig_pages --ignored_tags $IGNORED_TAGS --compress"
+
+if [ "$MULTISTREAM" = "true" ]; then
+    if [ ! -s "$WIKI_INDEX_PATH" ]; then
+	error_exit "missing $WIKI_INDEX_PATH"
+    fi
+    # Only shard directories are expected, as extracting next to texts
+    # from the regular dump would duplicate every document
+    count=$(find "$WIKI_TEXT_DIR" -mindepth 1 -maxdepth 1 \
+		 ! -regex '.*/[0-9][0-9][0-9][0-9][0-9]' | wc -l | \
+		perl -pe 's/\s//g')
+    if [ $count -gt 0 ]; then
+	error_exit "$WIKI_TEXT_DIR contains $count entries that are not
+    multistream shards (extracted with MULTISTREAM=false?), remove it first"
+    fi
+    # Shards are moved into place when complete, so an interrupted
+    # extraction resumes from the missing shards
+    echo "$SCRIPT: extracting $WIKI_DUMP_PATH to $WIKI_TEXT_DIR" >&2
+    python3 "$MULTISTREAM_EXTRACT" extract \
+	    --jobs "$EXTRACT_JOBS" \
+	    --streams-per-shard "$STREAMS_PER_SHARD" \
+	    --wikiextractor "$WIKIEXTRACTOR" \
+	    --params "$WIKIEXTRACTOR_PARAMS" \
+	    "$WIKI_DUMP_PATH" "$WIKI_INDEX_PATH" "$WIKI_TEXT_DIR"
+    exit 0
+fi
+
 count=$(find "$WIKI_TEXT_DIR" -type f | wc -l | perl -pe 's/\s//g')
 
 if [ $count -gt 0 ]; then
@@ -26,10 +53,7 @@ if [ $count -gt 0 ]; then
     exit 0
 else
     echo "$SCRIPT: extracting $WIKI_DUMP_PATH to $WIKI_TEXT_DIR" >&2
-    python3 "$WIKIEXTRACTOR" \
-	    --filter_disambig_pages \
-	    --ignored_tags "$IGNORED_TAGS" \
+    python3 "$WIKIEXTRACTOR" $WIKIEXTRACTOR_PARAMS \
 	    --output "$WIKI_TEXT_DIR" \
-	    --compress \
 	    "$WIKI_DUMP_PATH"
 fi
@@ -5,6 +5,11 @@
 PIPELINE_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 source "$PIPELINE_DIR/common.sh"
 
+if [ "$FUSED_TOKENIZE_FILTER" = "true" ]; then
+    echo "$SCRIPT: tokenization fused with filtering, skipping." >&2
+    exit 0
+fi
+
 count=$(find "$WIKI_TEXT_DIR" -type f | wc -l | perl -pe 's/\s//g')
 
 if [ $count -eq 0 ]; then
@@ -24,7 +29,14 @@ find "$WIKI_TEXT_DIR" -type f | sort | while read f; do
 	echo "$SCRIPT: $outpath exists, skipping $f ." >&2
     else
 	echo "$SCRIPT: tokenizing $f to $outpath ..." >&2
-	python3 "$TOKENIZER" "$UDPIPE_MODEL_PATH" "$f" \
-		> "$outpath"
+	python3 "$TOKENIZER" $TOKENIZER_PARAMS \
+		--output-codec "$TOKENIZED_TEXT_CODEC" \
+		--compress-threads "$COMPRESS_THREADS" \
+		"$UDPIPE_MODEL_PATH" "$f" > "$outpath"
     fi
 done
+
+# Index documents for random access; up-to-date indexes are kept
+echo "$SCRIPT: indexing documents in $TOKENIZED_TEXT_DIR ..." >&2
+find "$TOKENIZED_TEXT_DIR" -type f ! -name '*.idx' -print0 | sort -z | \
+    xargs -0 -r python3 "$DOCINDEX" build
@@ -5,26 +5,55 @@
 PIPELINE_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 source "$PIPELINE_DIR/common.sh"
 
-count=$(find "$TOKENIZED_TEXT_DIR" -type f | wc -l | perl -pe 's/\s//g')
+if [ "$FUSED_TOKENIZE_FILTER" = "true" ]; then
+    # Tokenize and filter extracted texts without intermediate files
+    INPUT_DIR="$WIKI_TEXT_DIR"
+else
+    INPUT_DIR="$TOKENIZED_TEXT_DIR"
+fi
+
+count=$(find "$INPUT_DIR" -type f ! -name '*.idx' | wc -l | perl -pe 's/\s//g')
 
 if [ $count -eq 0 ]; then
-    error_exit "no files in $TOKENIZED_TEXT_DIR"
+    error_exit "no files in $INPUT_DIR"
+else
+    echo "$SCRIPT: processing $count files in $INPUT_DIR"
+fi
+
+if [ "$FUSED_TOKENIZE_FILTER" = "true" ]; then
+    find "$INPUT_DIR" -type f ! -name '*.idx' | sort | while read f; do
+	relpath=$(relative_path "$f" "$INPUT_DIR")
+	reldir=$(dirname "$relpath")
+	outdir="$DOC_FILTERED_DIR/$reldir"
+	outbase=$(echo $(basename "$f") | perl -pe 's/\..*//')
+	outpath=$(pwd_relative_path "$outdir/$outbase")
+	mkdir -p "$outdir"
+	if [ -s "$outpath" ]; then
+	    echo "$SCRIPT: $outpath exists, skipping $f ." >&2
+	else
+	    echo "$SCRIPT: tokenizing and filtering $f to $outpath ..." >&2
+	    echo "$SCRIPT: running $SEGMENTFILTER" $TOKENIZER_PARAMS \
+		 $DOC_FILTER_PARAMS >&2
+	    python3 "$SEGMENTFILTER" $TOKENIZER_PARAMS $DOC_FILTER_PARAMS \
+		    --output-codec "$FILTERED_TEXT_CODEC" \
+		    --compress-threads "$COMPRESS_THREADS" \
+		    "$UDPIPE_MODEL_PATH" "$f" > "$outpath"
+	fi
+    done
 else
-    echo "$SCRIPT: processing $count files in $TOKENIZED_TEXT_DIR"
+    # Filter all files in one run with the filters set up once per
+    # worker; outputs are written atomically and existing ones skipped
+    echo "$SCRIPT: filtering $INPUT_DIR to $DOC_FILTERED_DIR ..." >&2
+    echo "$SCRIPT: running $DOC_FILTER" $DOC_FILTER_PARAMS >&2
+    python3 "$DOC_FILTER" $DOC_FILTER_PARAMS \
+	    --jobs "$DOC_FILTER_JOBS" \
+	    --output-codec "$FILTERED_TEXT_CODEC" \
+	    --compress-threads "$COMPRESS_THREADS" \
+	    --output-dir "$DOC_FILTERED_DIR" \
+	    "$INPUT_DIR"
 fi
 
-find "$TOKENIZED_TEXT_DIR" -type f | sort | while read f; do
-    relpath=$(relative_path "$f" "$TOKENIZED_TEXT_DIR")
-    reldir=$(dirname "$relpath")
-    outdir="$DOC_FILTERED_DIR/$reldir"
-    outbase=$(echo $(basename "$f") | perl -pe 's/\..*//')
-    outpath=$(pwd_relative_path "$outdir/$outbase")
-    mkdir -p "$outdir"
-    if [ -s "$outpath" ]; then
-	echo "$SCRIPT: $outpath exists, skipping $f ." >&2
-    else
-	echo "$SCRIPT: filtering $f to $outpath ..." >&2
-	echo "$SCRIPT: running $DOC_FILTER" $DOC_FILTER_PARAMS >&2
-	python3 "$DOC_FILTER" $DOC_FILTER_PARAMS "$f" > "$outpath"
-    fi
-done
+# Index documents for random access; up-to-date indexes are kept
+echo "$SCRIPT: indexing documents in $DOC_FILTERED_DIR ..." >&2
+find "$DOC_FILTERED_DIR" -type f ! -name '*.idx' -print0 | sort -z | \
+    xargs -0 -r python3 "$DOCINDEX" build
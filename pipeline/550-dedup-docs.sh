@@ -0,0 +1,35 @@
+#!/bin/bash
+
+# Remove near-duplicate documents from filtered texts.
+
+PIPELINE_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+source "$PIPELINE_DIR/common.sh"
+
+if [ -d "$DEDUPED_DIR" ]; then
+    echo "$SCRIPT: $DEDUPED_DIR exists, skipping deduplication." >&2
+    exit 0
+fi
+
+count=$(find "$DOC_FILTERED_DIR" -type f ! -name '*.idx' | wc -l | perl -pe 's/\s//g')
+
+if [ $count -eq 0 ]; then
+    error_exit "no files in $DOC_FILTERED_DIR"
+else
+    echo "$SCRIPT: processing $count files in $DOC_FILTERED_DIR"
+fi
+
+echo "$SCRIPT: running $DEDUPDOCS" $DEDUP_PARAMS >&2
+
+# Write to temporary directory so that an interrupted run is not taken
+# as done
+rm -rf "$DEDUPED_DIR.tmp"
+python3 "$DEDUPDOCS" $DEDUP_PARAMS \
+	--output-codec "$DEDUPED_TEXT_CODEC" \
+	--compress-threads "$COMPRESS_THREADS" \
+	--report "$DEDUP_REPORT_PATH" \
+	"$DOC_FILTERED_DIR" "$DEDUPED_DIR.tmp"
+mv "$DEDUPED_DIR.tmp" "$DEDUPED_DIR"
+
+echo "$SCRIPT: indexing documents in $DEDUPED_DIR ..." >&2
+find "$DEDUPED_DIR" -type f ! -name '*.idx' -print0 | sort -z | \
+    xargs -0 -r python3 "$DOCINDEX" build
@@ -1,10 +1,15 @@
 #!/bin/bash
 
-# Sample given ratio of sentences for given language.
+# Sample given number of sentences for given language.
 
 PIPELINE_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 source "$PIPELINE_DIR/common.sh"
 
+if [ "$VOCAB_METHOD" = "wordpiece" ]; then
+    echo "$SCRIPT: vocabulary learned from word counts, skipping." >&2
+    exit 0
+fi
+
 mkdir -p "$SAMPLED_TEXT_DIR"
 
 if [ -s "$SAMPLED_TEXT_PATH" ]; then
@@ -12,27 +17,23 @@ if [ -s "$SAMPLED_TEXT_PATH" ]; then
     exit 0
 fi
 
-count=$(find "$DOC_FILTERED_DIR" -type f | wc -l | perl -pe 's/\s//g')
+count=$(find "$DEDUPED_DIR" -type f ! -name '*.idx' | wc -l | perl -pe 's/\s//g')
 
 if [ $count -eq 0 ]; then
-    error_exit "no files in $DOC_FILTERED_DIR"
+    error_exit "no files in $DEDUPED_DIR"
 else
-    echo "$SCRIPT: processing $count files in $DOC_FILTERED_DIR"
+    echo "$SCRIPT: processing $count files in $DEDUPED_DIR"
 fi
 
-# Grab total number of sentences, determine sampling probability to
-# get approximately targeted number of sentences.
-total=$(find "$DOC_FILTERED_DIR" -type f | sort | xargs cat \
-	    | egrep -v '^[[:space:]]*$' | wc -l | perl -pe 's/\s//g')
-
-ratio=$(python3 -c "print(min(1.0, $SAMPLED_SENTENCE_NUM/$total))")
-
-echo "$SCRIPT: sampling $ratio of sentences (total $total, target $SAMPLED_SENTENCE_NUM)" >&2
+echo "$SCRIPT: sampling $SAMPLED_SENTENCE_NUM sentences (seed $SAMPLED_SENTENCE_SEED)" >&2
 
-find "$DOC_FILTERED_DIR" -type f | sort | xargs cat \
-    | egrep -v '^[[:space:]]*$' \
-    | perl -pe '$_ = "" unless(rand()<'"$ratio"')' \
-	   > "$SAMPLED_TEXT_PATH"
+# Write to temporary file so that an interrupted run is not taken as done
+python3 "$SAMPLESENTENCES" \
+	--jobs "$SAMPLED_SENTENCE_JOBS" \
+	--number "$SAMPLED_SENTENCE_NUM" \
+	--seed "$SAMPLED_SENTENCE_SEED" \
+	"$DEDUPED_DIR" > "$SAMPLED_TEXT_PATH.tmp"
+mv "$SAMPLED_TEXT_PATH.tmp" "$SAMPLED_TEXT_PATH"
 
 result=$(wc -l < "$SAMPLED_TEXT_PATH" | perl -pe 's/\s//g')
 
@@ -0,0 +1,41 @@
+#!/bin/bash
+
+# Split filtered and deduplicated documents into sampled and held-out documents.
+
+PIPELINE_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+source "$PIPELINE_DIR/common.sh"
+
+count=$(find "$DEDUPED_DIR" -type f ! -name '*.idx' | wc -l | perl -pe 's/\s//g')
+
+if [ $count -eq 0 ]; then
+    error_exit "no files in $DEDUPED_DIR"
+else
+    echo "$SCRIPT: processing $count files in $DEDUPED_DIR"
+fi
+
+# Paths are derived without relative_path to avoid starting python3
+# processes for every file
+find "$DEDUPED_DIR" -type f ! -name '*.idx' | sort | while read f; do
+    relpath="${f#$DEDUPED_DIR/}"
+    reldir=$(dirname "$relpath")
+    sampleddir="$SAMPLED_DOC_DIR/$reldir"
+    heldoutdir="$HELD_OUT_DOC_DIR/$reldir"
+    outbase="${f##*/}"
+    outbase="${outbase%%.*}"
+    sampledpath="$sampleddir/$outbase"
+    heldoutpath="$heldoutdir/$outbase"
+    mkdir -p "$sampleddir" "$heldoutdir"
+    if [ -e "$sampledpath" -a -e "$heldoutpath" ]; then
+	echo "$SCRIPT: $sampledpath and $heldoutpath exist, skipping $f ." >&2
+    else
+	echo "$SCRIPT: sampling $f to $sampledpath and $heldoutpath ..." >&2
+	python3 "$SAMPLEDOCS" $SAMPLEDOCS_PARAMS \
+		--output-codec "$SAMPLED_DOC_CODEC" \
+		--compress-threads "$COMPRESS_THREADS" \
+		--sampled "$sampledpath.tmp" \
+		--rest "$heldoutpath.tmp" \
+		"$SAMPLED_DOC_RATIO" "$f"
+	mv "$heldoutpath.tmp" "$heldoutpath"
+	mv "$sampledpath.tmp" "$sampledpath"
+    fi
+done
@@ -5,6 +5,11 @@
 PIPELINE_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 source "$PIPELINE_DIR/common.sh"
 
+if [ "$VOCAB_METHOD" = "wordpiece" ]; then
+    echo "$SCRIPT: vocabulary learned from word counts, skipping." >&2
+    exit 0
+fi
+
 mkdir -p "$TOKENIZED_SAMPLE_DIR"
 
 if [ -s "$TOKENIZED_SAMPLE_PATH" ]; then
@@ -16,5 +21,6 @@ if [ ! -s "$SAMPLED_TEXT_PATH" ]; then
     error_exit "missing $SAMPLED_TEXT_PATH"
 else
     echo "$SCRIPT: performing basic tokenization on $SAMPLED_TEXT_PATH with output to $TOKENIZED_SAMPLE_PATH" >&2
-    python3 "$BASICTOKENIZE" "$SAMPLED_TEXT_PATH" > "$TOKENIZED_SAMPLE_PATH"
+    python3 "$BASICTOKENIZE" $BASICTOKENIZE_PARAMS "$SAMPLED_TEXT_PATH" \
+	    > "$TOKENIZED_SAMPLE_PATH"
 fi
@@ -1,10 +1,31 @@
 #!/bin/bash
 
-# Create sentencepiece model for given language.
+# Create sentencepiece model for given language, or with VOCAB_METHOD
+# "wordpiece", the wordpiece vocabulary.
 
 PIPELINE_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 source "$PIPELINE_DIR/common.sh"
 
+if [ "$VOCAB_METHOD" = "wordpiece" ]; then
+    mkdir -p "$WORDPIECE_VOCAB_DIR"
+    if [ -s "$WORDPIECE_VOCAB_PATH" ]; then
+	echo "$SCRIPT: $WORDPIECE_VOCAB_PATH exists, not recreating." >&2
+	exit 0
+    fi
+    if [ -s "$WORD_COUNTS_PATH" ]; then
+	input="--counts $WORD_COUNTS_PATH"
+    else
+	input="--save-counts $WORD_COUNTS_PATH $DEDUPED_DIR"
+    fi
+    echo "$SCRIPT: running $WORDPIECEVOCAB" $WORDPIECEVOCAB_PARAMS $input >&2
+    # Write to temporary file so that an interrupted run is not taken
+    # as done
+    python3 "$WORDPIECEVOCAB" $WORDPIECEVOCAB_PARAMS $input \
+	    > "$WORDPIECE_VOCAB_PATH.tmp"
+    mv "$WORDPIECE_VOCAB_PATH.tmp" "$WORDPIECE_VOCAB_PATH"
+    exit 0
+fi
+
 if [ ! -s "$TOKENIZED_SAMPLE_PATH" ]; then
     error_exit "$TOKENIZED_SAMPLE_PATH does not exist"
 fi
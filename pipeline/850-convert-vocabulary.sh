@@ -5,6 +5,11 @@
 PIPELINE_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 source "$PIPELINE_DIR/common.sh"
 
+if [ "$VOCAB_METHOD" = "wordpiece" ]; then
+    echo "$SCRIPT: vocabulary learned from word counts, skipping." >&2
+    exit 0
+fi
+
 if [ ! -s $SENTENCEPIECE_VOCAB_PATH ]; then
     error_exit "$SENTENCEPIECE_VOCAB_PATH does not exist"
 fi
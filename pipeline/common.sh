@@ -40,11 +40,25 @@ get_language_attribute () {
     python3 "$SCRIPT_DIR/getvalue.py" "$LANGUAGE_DATA_DIR/$1.json" "$2"
 }
 
+source "$CONFIG_DIR/io.sh"
+
 WIKI_DUMP_URL=$(get_language_attribute "$LC" "wiki-dump")
+source "$CONFIG_DIR/extract.sh"
+if [ "$MULTISTREAM" = "true" ]; then
+    # Multistream variant of the dump and its index of stream offsets
+    WIKI_DUMP_URL=$(echo "$WIKI_DUMP_URL" | \
+	perl -pe 's/pages-articles\.xml\.bz2$/pages-articles-multistream.xml.bz2/')
+    WIKI_INDEX_URL=$(echo "$WIKI_DUMP_URL" | \
+	perl -pe 's/\.xml\.bz2$/-index.txt.bz2/')
+fi
 WIKI_DUMP_DIR="$DATA_DIR/$LC/wikipedia-dump"
 WIKI_DUMP_PATH="$WIKI_DUMP_DIR/$(basename $WIKI_DUMP_URL)"
+if [ "$MULTISTREAM" = "true" ]; then
+    WIKI_INDEX_PATH="$WIKI_DUMP_DIR/$(basename $WIKI_INDEX_URL)"
+fi
 
 WIKIEXTRACTOR="$BASE_DIR/wikiextractor/WikiExtractor.py"
+MULTISTREAM_EXTRACT="$SCRIPT_DIR/multistream.py"
 WIKI_TEXT_DIR="$DATA_DIR/$LC/wikipedia-texts"
 
 UDPIPE_MODEL_URL=$(get_language_attribute "$LC" "udpipe-model")
@@ -53,17 +67,31 @@ UDPIPE_MODEL_PATH="$UDPIPE_MODEL_DIR/$(basename $UDPIPE_MODEL_URL)"
 
 TOKENIZER="$SCRIPT_DIR/udtokenize.py"
 TOKENIZED_TEXT_DIR="$DATA_DIR/$LC/tokenized-texts"
+source "$CONFIG_DIR/tokenize.sh"
 
 DOC_FILTER="$SCRIPT_DIR/filterdocs.py"
 DOC_FILTER_WORD_CHARS=$(get_language_attribute "$LC" "word-chars")
 DOC_FILTERED_DIR="$DATA_DIR/$LC/filtered-texts"
+SEGMENTFILTER="$SCRIPT_DIR/segmentfilter.py"
+DOCINDEX="$SCRIPT_DIR/docindex.py"
 source "$CONFIG_DIR/filter.sh"
 
+DEDUPED_DIR="$DATA_DIR/$LC/deduped-texts"
+DEDUP_REPORT_PATH="$DATA_DIR/$LC/dedup-report.tsv"
+DEDUPDOCS="$SCRIPT_DIR/dedupdocs.py"
+source "$CONFIG_DIR/dedup.sh"
+
 SAMPLED_TEXT_DIR="$DATA_DIR/$LC/sampled-texts"
 SAMPLED_TEXT_PATH="$SAMPLED_TEXT_DIR/sampled-sentences.txt"
 SAMPLED_SENTENCE_NUM=10000000
+SAMPLED_SENTENCE_SEED=0
+# Each sampling worker (and the merging parent) keeps up to twice the
+# sample size of sentences in memory, about 4 GB per 10M sentences
+SAMPLED_SENTENCE_JOBS=4
+SAMPLESENTENCES="$SCRIPT_DIR/samplesentences.py"
 
 BASICTOKENIZE="$SCRIPT_DIR/basictokenize.py"
+BASICTOKENIZE_PARAMS="--jobs 8"
 TOKENIZED_SAMPLE_DIR="$DATA_DIR/$LC/tokenized-samples"
 TOKENIZED_SAMPLE_PATH="$TOKENIZED_SAMPLE_DIR/tokenized-sample-cased.txt"
 
@@ -77,14 +105,27 @@ WORDPIECE_VOCAB_DIR="$DATA_DIR/$LC/wordpiece/cased"
 WORDPIECE_VOCAB_PATH="$WORDPIECE_VOCAB_DIR/vocab.txt"
 SENT2WORDPIECE=$(pwd_relative_path "$BASE_DIR/sent2wordpiece/sent2wordpiece.py")
 SENT2WORDPIECE_PARAMS=""
+WORDPIECEVOCAB="$SCRIPT_DIR/wordpiecevocab.py"
+WORD_COUNTS_PATH="$WORDPIECE_VOCAB_DIR/word-counts.tsv"
+source "$CONFIG_DIR/wordpiece.sh"
 
 TFRECORD_DIR_128="$DATA_DIR/$LC/tfrecords/seq-128"
 TFRECORD_DIR_512="$DATA_DIR/$LC/tfrecords/seq-512"
 CREATE_TFRECORD="$BASE_DIR/bert/create_pretraining_data.py"
+CREATE_TFRECORDS="$SCRIPT_DIR/createtfrecords.py"
+WORDPIECE_ID_CACHE_DIR="$DATA_DIR/$LC/wordpiece-ids"
 source "$CONFIG_DIR/tfrecord.sh"
 
 SAMPLED_DOC_DIR="$DATA_DIR/$LC/sampled-docs"
 HELD_OUT_DOC_DIR="$DATA_DIR/$LC/held-out-docs"
 SAMPLEDOCS="$SCRIPT_DIR/sampledocs.py"
+source "$CONFIG_DIR/sampledocs.sh"
 
 MD5SUM_DIR="$DATA_DIR/$LC/md5sums"
+
+# Scripts append resource metrics to $WIKIBERT_METRICS (set it to an
+# empty value to disable); see stagemetrics.py for the summary command
+STAGEMETRICS="$SCRIPT_DIR/stagemetrics.py"
+export WIKIBERT_METRICS="${WIKIBERT_METRICS-$PWD/$DATA_DIR/$LC/metrics.jsonl}"
+export WIKIBERT_RUN_ID="${WIKIBERT_RUN_ID:-$(date +%Y%m%dT%H%M%S)-$$}"
+export WIKIBERT_STAGE=$(basename "$0")
@@ -2,15 +2,27 @@
 
 import sys
 import re
-import bz2
 
-from bert.tokenization import BasicTokenizer
+from collections import deque
+from multiprocessing import Pool
+
+import corpusio
+import stagemetrics
+
+from fasttokenization import FastBasicTokenizer
 
 
 # Match WikiExtractor document start and end tags
 DOC_START_TAG_RE = re.compile(r'^<doc\s+id=.*>$')
 DOC_END_TAG_RE = re.compile(r'^</doc>$')
 
+# Number of lines per job with --jobs
+CHUNK_LINES = 10000
+
+# Tokenizer and options of worker process, see init_worker()
+WORKER_TOKENIZER = None
+WORKER_OPTIONS = None
+
 
 def argparser():
     from argparse import ArgumentParser
@@ -20,45 +32,94 @@ def argparser():
     ap.add_argument('-d', '--document-tags', default=False, action='store_true',
                     help='Include document start/end tags in output')
     ap.add_argument('-e', '--encoding', default='utf-8')
+    ap.add_argument('-j', '--jobs', metavar='N', default=1, type=int,
+                    help='Number of tokenizer worker processes (default 1)')
     ap.add_argument('--uncased', default=False, action='store_true',
                     help='Lowercase and strip accents (for uncased model)')
     ap.add_argument('file', nargs='+')
     return ap
 
 
-def tokenize_stream(tokenizer, f, fn, options):
-    for ln, l in enumerate(f, start=1):
+def tokenize_lines(tokenizer, lines, options):
+    # Return output for lines as a string
+    output = []
+    for l in lines:
         l = l.rstrip('\n')
         start_m = DOC_START_TAG_RE.match(l)
         end_m = DOC_END_TAG_RE.match(l)
         if l.isspace() or not l:
             if options.keep_blank:
-                print(l)
+                output.append(l)
         elif start_m or end_m:
             if options.document_tags:
-                print(l)
+                output.append(l)
             elif end_m:
-                print()    # Empty line as doc boundary
+                output.append('')    # Empty line as doc boundary
         else:
-            print(' '.join(tokenizer.tokenize(l)))
+            output.append(' '.join(tokenizer.tokenize(l)))
+    output.append('')
+    return '\n'.join(output) if len(output) > 1 else ''
+
+
+def init_worker(options):
+    global WORKER_TOKENIZER, WORKER_OPTIONS
+    WORKER_TOKENIZER = FastBasicTokenizer(do_lower_case=options.uncased)
+    WORKER_OPTIONS = options
+
 
+def tokenize_chunk(lines):
+    return tokenize_lines(WORKER_TOKENIZER, lines, WORKER_OPTIONS)
 
-def basic_tokenize(tokenizer, fn, options):
-    if fn.endswith('.bz2'):
-        with bz2.open(fn, 'rt', encoding=options.encoding) as f:
-            tokenize_stream(tokenizer, f, fn, options)
+
+def read_chunks(f, size=CHUNK_LINES):
+    chunk = []
+    for l in f:
+        chunk.append(l)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def tokenize_stream(tokenizer, f, fn, options, pool=None):
+    # Tokenize lines from f to stdout, in parallel in pool if given
+    # with output in input order.
+    lines = 0
+    if pool is None:
+        for chunk in read_chunks(f):
+            sys.stdout.write(tokenize_lines(tokenizer, chunk, options))
+            lines += len(chunk)
     else:
-        with open(fn) as f:
-            tokenize_stream(tokenizer, f, fn, options)
+        pending, max_pending = deque(), options.jobs * 4
+        for chunk in read_chunks(f):
+            pending.append(pool.apply_async(tokenize_chunk, (chunk,)))
+            lines += len(chunk)
+            while len(pending) > max_pending:
+                sys.stdout.write(pending.popleft().get())
+        while pending:
+            sys.stdout.write(pending.popleft().get())
+    stagemetrics.count('lines-in', lines)
+
+
+def basic_tokenize(tokenizer, fn, options, pool=None):
+    with corpusio.open_text(fn, encoding=options.encoding) as f:
+        tokenize_stream(tokenizer, f, fn, options, pool)
 
 
 def main(argv):
     args = argparser().parse_args(argv[1:])
-    tokenizer = BasicTokenizer(do_lower_case=args.uncased)
+    if args.jobs > 1:
+        tokenizer, pool = None, Pool(args.jobs, init_worker, (args,))
+    else:
+        tokenizer, pool = FastBasicTokenizer(args.uncased), None
     for fn in args.file:
-        basic_tokenize(tokenizer, fn, args)
+        basic_tokenize(tokenizer, fn, args, pool)
+    if pool is not None:
+        pool.close()
+        pool.join()
     return 0
 
 
 if __name__ == '__main__':
-    sys.exit(main(sys.argv))
+    sys.exit(stagemetrics.run_main(main, sys.argv))
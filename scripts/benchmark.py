@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+
+# Benchmark the hot functions of pipeline scripts on synthetic corpora.
+#
+# Deterministic WikiExtractor-style and tokenized (blank line-separated)
+# corpora are generated for Latin, Cyrillic and CJK scripts, and each
+# benchmark is run in a separate process, reporting documents/second,
+# MB/second and peak resident memory. Results are written as JSON and
+# can be compared against a stored baseline to flag regressions.
+
+import sys
+import os
+import json
+import time
+import random
+import platform
+import resource
+import shutil
+import tempfile
+import contextlib
+
+from collections import OrderedDict, namedtuple
+from multiprocessing import get_context
+
+
+# Alphabets, word lengths and language codes for synthetic text
+SCRIPTS = OrderedDict([
+    ('latin', {
+        'letters': 'abcdefghijklmnopqrstuvwxyzäö',
+        'word-lengths': (1, 12),
+        'language': 'fi',
+        'spaces': True,
+        'full-stop': '.',
+    }),
+    ('cyrillic', {
+        'letters': 'абвгдежзийклмнопрстуфхцчшщъыьэюя',
+        'word-lengths': (1, 12),
+        'language': 'ru',
+        'spaces': True,
+        'full-stop': '.',
+    }),
+    ('cjk', {
+        'letters': (''.join(map(chr, range(0x4E00, 0x4F00))) +
+                    ''.join(map(chr, range(0x3041, 0x3097)))),
+        'word-lengths': (1, 3),
+        'language': 'ja',
+        'spaces': False,
+        'full-stop': '。',
+    }),
+])
+
+# Number of distinct words in synthetic vocabularies
+VOCABULARY_SIZE = 20000
+
+# Synthetic corpus files and statistics
+Corpus = namedtuple('Corpus', 'script wiki tokenized scored documents')
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Benchmark pipeline scripts.')
+    ap.add_argument('-b', '--baseline', metavar='FILE', default=None,
+                    help='Compare results to JSON FILE from earlier run')
+    ap.add_argument('-B', '--benchmark', metavar='NAME', default=None,
+                    action='append', choices=list(BENCHMARKS.keys()),
+                    help='Run benchmark NAME (repeatable, default all)')
+    ap.add_argument('-o', '--output', metavar='FILE', default=None,
+                    help='Write JSON results to FILE (default stdout)')
+    ap.add_argument('-r', '--repeat', metavar='N', default=3, type=int,
+                    help='Take the fastest of N runs (default 3)')
+    ap.add_argument('-s', '--size', metavar='MB', default=10, type=float,
+                    help='Size of tokenized corpus in MB (default 10)')
+    ap.add_argument('-S', '--script', metavar='SCRIPT', default=None,
+                    action='append', choices=list(SCRIPTS.keys()),
+                    help='Generate text in SCRIPT (repeatable, default all)')
+    ap.add_argument('--seed', metavar='INT', default=0, type=int,
+                    help='Seed for corpus generation')
+    ap.add_argument('-t', '--tolerance', metavar='RATIO', default=0.1,
+                    type=float, help='Flag benchmarks more than RATIO ' +
+                    'slower than baseline (default 0.1)')
+    ap.add_argument('--udpipe-model', metavar='FILE', default=None,
+                    help='UDPipe model for udtokenize (skipped if not given)')
+    ap.add_argument('--workdir', metavar='DIR', default=None,
+                    help='Keep generated corpora in DIR for reuse')
+    return ap
+
+
+def make_vocabulary(rng, settings):
+    letters, (min_len, max_len) = settings['letters'], settings['word-lengths']
+    return [
+        ''.join(rng.choice(letters)
+                for _ in range(rng.randint(min_len, max_len)))
+        for _ in range(VOCABULARY_SIZE)
+    ]
+
+
+def make_sentence(rng, words, weights, settings):
+    # Return tokens of sentence with Zipfian word frequencies
+    tokens = rng.choices(words, cum_weights=weights, k=rng.randint(4, 30))
+    if settings['spaces']:
+        tokens[0] = tokens[0].capitalize()
+        if len(tokens) > 8 and rng.random() < 0.5:
+            tokens.insert(rng.randint(2, len(tokens)-2), ',')
+    if rng.random() < 0.1:
+        tokens.insert(rng.randint(0, len(tokens)), str(rng.randint(1, 2020)))
+    tokens.append(settings['full-stop'])
+    return tokens
+
+
+def write_document(doc_id, rng, words, weights, settings, wiki, tokenized,
+                   scored):
+    joiner = ' ' if settings['spaces'] else ''
+    title = joiner.join(rng.choices(words, cum_weights=weights, k=2))
+    print('<doc id="{0}" url="https://wikipedia.org/wiki?curid={0}" '
+          'title="{1}">'.format(doc_id, title), file=wiki)
+    print(title, file=wiki)
+    print(file=wiki)
+    for _ in range(rng.randint(1, 8)):
+        sentences = [make_sentence(rng, words, weights, settings)
+                     for _ in range(rng.randint(1, 6))]
+        text = ' '.join(joiner.join(s).replace(' ,', ',')
+                        .replace(' ' + settings['full-stop'],
+                                 settings['full-stop'])
+                        for s in sentences)
+        print(text, file=wiki)
+        for s in sentences:
+            print(' '.join(s), file=tokenized)
+            print('{:.1f}\t{}'.format(rng.lognormvariate(7, 1), ' '.join(s)),
+                  file=scored)
+    print('</doc>', file=wiki)
+    print(file=tokenized)
+    print(file=scored)
+
+
+def generate_corpus(directory, script, size, seed):
+    # Generate corpus files in directory unless already present
+    prefix = os.path.join(directory, '{}-{}mb-{}'.format(script, size, seed))
+    paths = [prefix + suffix for suffix in ('.wiki', '.txt', '.scored')]
+    count_path = prefix + '.docs'
+    if os.path.exists(count_path):
+        with open(count_path) as f:
+            return Corpus(script, *paths, int(f.read()))
+    settings = SCRIPTS[script]
+    rng = random.Random('{}-{}'.format(script, seed))
+    words = make_vocabulary(rng, settings)
+    weights, total = [], 0
+    for rank in range(len(words)):
+        total += 1 / (rank+1)
+        weights.append(total)
+    documents = 0
+    with contextlib.ExitStack() as stack:
+        wiki, tokenized, scored = [
+            stack.enter_context(open(p, 'w', encoding='utf-8'))
+            for p in paths
+        ]
+        while tokenized.tell() < size * 2**20:
+            write_document(documents, rng, words, weights, settings,
+                           wiki, tokenized, scored)
+            documents += 1
+    with open(count_path, 'w') as out:
+        out.write(str(documents))
+    return Corpus(script, *paths, documents)
+
+
+# Benchmarks take a corpus and options, do any setup and return the
+# function to time and the path of the input it processes.
+
+def udtokenize_benchmark(corpus, options):
+    if options.udpipe_model is None:
+        raise ImportError('no --udpipe-model given')
+    try:
+        import udtokenize
+    except SystemExit:
+        raise ImportError('failed to import ufal.udpipe')
+    args = udtokenize.argparser().parse_args(
+        ['--batch-size', '100000', options.udpipe_model, corpus.wiki])
+    model, pipeline = udtokenize.create_model(options.udpipe_model)
+
+    def run():
+        with open(corpus.wiki) as f:
+            for lines in udtokenize.read_documents(f):
+                udtokenize.tokenize_document(model, pipeline, lines,
+                                             corpus.wiki, args)
+    return run, corpus.wiki
+
+
+def filterdocs_benchmark(corpus, options):
+    import filterdocs
+    settings = SCRIPTS[corpus.script]
+    args = filterdocs.argparser().parse_args([
+        '--min-sents', '3', '--max-sents', '1000', '--avg-len', '4',
+        '--upper-ratio', '0.1', '--no-word-ratio', '0.2',
+        '--punct-ratio', '0.075', '--digit-ratio', '0.075',
+        '--min-toks', '20', '--max-toks', '10000', '--min-words', '30',
+        '--foreign-ratio', '0.02', '--language', settings['language'],
+    ] + ([] if settings['language'] in filterdocs.UNICODE_RANGES else [
+        '--word-chars', settings['letters'],
+    ]) + [corpus.tokenized])
+    filterdocs.setup_filter(args)
+
+    def run():
+        filterdocs.process(corpus.tokenized, args)
+    return run, corpus.tokenized
+
+
+def basictokenize_benchmark(corpus, options):
+    import basictokenize
+    import fasttokenization
+    args = basictokenize.argparser().parse_args([corpus.wiki])
+    fasttokenization.character_tables()    # computed once per process
+
+    def run():
+        # new tokenizer for each run so that its word cache starts empty
+        tokenizer = fasttokenization.FastBasicTokenizer(do_lower_case=False)
+        basictokenize.basic_tokenize(tokenizer, corpus.wiki, args)
+    return run, corpus.wiki
+
+
+def sampledocs_benchmark(corpus, options):
+    import sampledocs
+    args = sampledocs.argparser().parse_args(['0.5', corpus.tokenized])
+    sampledocs.seed(options.seed)
+
+    def run():
+        sampledocs.sample_documents(corpus.tokenized, sampledocs.NullOut(),
+                                    sampledocs.NullOut(), args)
+    return run, corpus.tokenized
+
+
+def sampledocs_hash_benchmark(corpus, options):
+    import sampledocs
+    args = sampledocs.argparser().parse_args(
+        ['--hash', '0.5', corpus.tokenized])
+
+    def run():
+        sampledocs.sample_documents_by_hash(
+            corpus.tokenized, sampledocs.NullOut(), sampledocs.NullOut(),
+            args)
+    return run, corpus.tokenized
+
+
+def ppfilter_benchmark(corpus, options):
+    import ppfilter
+    args = ppfilter.argparser().parse_args(['--min-tokens', '5', corpus.scored])
+    args.threshold, args.trim_threshold = 10000, 5000
+
+    def run():
+        ppfilter.process_file(corpus.scored, args)
+    return run, corpus.scored
+
+
+def tokenizedstats_benchmark(corpus, options):
+    import tokenizedstats
+    args = tokenizedstats.argparser().parse_args([corpus.tokenized])
+
+    def run():
+        tokenizedstats.tokenized_stats(corpus.tokenized, args)
+    return run, corpus.tokenized
+
+
+def tokenizedstats_fast_benchmark(corpus, options):
+    import tokenizedstats
+    args = tokenizedstats.argparser().parse_args(['--fast', corpus.tokenized])
+
+    def run():
+        tokenizedstats.fast_tokenized_stats(corpus.tokenized, args)
+    return run, corpus.tokenized
+
+
+BENCHMARKS = OrderedDict([
+    ('udtokenize', udtokenize_benchmark),
+    ('filterdocs', filterdocs_benchmark),
+    ('basictokenize', basictokenize_benchmark),
+    ('sampledocs', sampledocs_benchmark),
+    ('sampledocs-hash', sampledocs_hash_benchmark),
+    ('ppfilter', ppfilter_benchmark),
+    ('tokenizedstats', tokenizedstats_benchmark),
+    ('tokenizedstats-fast', tokenizedstats_fast_benchmark),
+])
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss /= 1024
+    return maxrss / 1024
+
+
+def run_benchmark(job):
+    # Run benchmark in this (fresh) process, discarding its output, and
+    # return a dict of results or a reason for skipping it.
+    name, corpus, options = job
+    try:
+        run, path = BENCHMARKS[name](corpus, options)
+    except ImportError as e:
+        return {'skipped': str(e)}
+    with open(os.devnull, 'w') as devnull, \
+         contextlib.redirect_stdout(devnull), \
+         contextlib.redirect_stderr(devnull):
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+    size = os.path.getsize(path) / 2**20
+    return {
+        'seconds': seconds,
+        'docs-per-sec': corpus.documents / seconds,
+        'mb-per-sec': size / seconds,
+        'peak-rss-mb': peak_rss_mb(),
+    }
+
+
+def benchmark(name, corpus, options):
+    # Return the fastest of options.repeat runs, each in a new process
+    best = None
+    context = get_context('spawn')
+    for _ in range(max(1, options.repeat)):
+        with context.Pool(1) as pool:
+            result = pool.apply(run_benchmark, ((name, corpus, options),))
+        if 'skipped' in result:
+            return result
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best
+
+
+def compare_to_baseline(results, baseline, tolerance, out=sys.stderr):
+    # Print comparison of throughput to baseline, returning the number
+    # of regressions.
+    regressions = 0
+    for key, result in results.items():
+        base = baseline.get(key)
+        if 'mb-per-sec' not in result or not base or 'mb-per-sec' not in base:
+            continue
+        ratio = result['mb-per-sec'] / base['mb-per-sec']
+        if ratio < 1 - tolerance:
+            status = 'REGRESSION'
+            regressions += 1
+        elif ratio > 1 + tolerance:
+            status = 'improved'
+        else:
+            status = 'ok'
+        print('{}\t{:.2f} MB/s\t(baseline {:.2f} MB/s, {:+.1%})\t{}'.format(
+            key, result['mb-per-sec'], base['mb-per-sec'], ratio-1, status),
+            file=out)
+    return regressions
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    names = args.benchmark or list(BENCHMARKS.keys())
+    scripts = args.script or list(SCRIPTS.keys())
+    if args.workdir is None:
+        workdir = tempfile.mkdtemp(prefix='benchmark-')
+    else:
+        workdir = args.workdir
+        os.makedirs(workdir, exist_ok=True)
+    results = OrderedDict()
+    try:
+        for script in scripts:
+            corpus = generate_corpus(workdir, script, args.size, args.seed)
+            for name in names:
+                key = '{}/{}'.format(name, script)
+                results[key] = result = benchmark(name, corpus, args)
+                if 'skipped' in result:
+                    print('{}\tskipped: {}'.format(key, result['skipped']),
+                          file=sys.stderr)
+                else:
+                    print('{}\t{:.0f} docs/s\t{:.2f} MB/s\t{:.0f} MB RSS'.format(
+                        key, result['docs-per-sec'], result['mb-per-sec'],
+                        result['peak-rss-mb']), file=sys.stderr)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+    output = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'size-mb': args.size,
+        'seed': args.seed,
+        'results': results,
+    }
+    if args.output is None:
+        print(json.dumps(output, indent=2))
+    else:
+        with open(args.output, 'w') as out:
+            json.dump(output, out, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('size-mb') != args.size:
+            print('warning: baseline corpus size {} MB differs'.format(
+                baseline.get('size-mb')), file=sys.stderr)
+        if compare_to_baseline(results, baseline['results'], args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
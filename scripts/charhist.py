@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# Count characters in text files in parallel using codepoint histograms.
+#
+# Files are divided into chunks ending at newlines that are decoded and
+# counted in worker processes with numpy.bincount over codepoints, and
+# the partial histograms are merged. The histogram can be saved and
+# loaded so that tools such as getalphabet.py and letterfreq.py can
+# answer from it without re-reading the text.
+
+import sys
+import os
+import json
+
+import numpy as np
+
+from collections import Counter
+from multiprocessing import Pool
+
+import corpusio
+import stagemetrics
+
+
+# Size of chunks of bytes counted at a time
+CHUNK_SIZE = 16 * 2**20
+
+# str.lower() maps capital sigma to final sigma depending on context
+CAPITAL_SIGMA, SMALL_SIGMA, FINAL_SIGMA = 'Σ', 'σ', 'ς'
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Count characters in text.')
+    ap.add_argument('-j', '--jobs', metavar='N', default=os.cpu_count(),
+                    type=int, help='Number of worker processes')
+    ap.add_argument('-o', '--output', metavar='FILE', required=True,
+                    help='Save histogram to FILE')
+    ap.add_argument('file', nargs='+')
+    return ap
+
+
+class CharHistogram(object):
+    """Character counts for text, with the number of capital sigmas
+    that str.lower() maps to final sigma in context."""
+
+    def __init__(self, counts=None, final_sigmas=0):
+        self.counts = Counter() if counts is None else counts
+        self.final_sigmas = final_sigmas
+
+    def update(self, other):
+        self.counts.update(other.counts)
+        self.final_sigmas += other.final_sigmas
+
+    def lowercased(self):
+        # Return Counter of characters after str.lower() of the text
+        lowered = Counter()
+        for c, count in self.counts.items():
+            if c == CAPITAL_SIGMA:
+                lowered[FINAL_SIGMA] += self.final_sigmas
+                lowered[SMALL_SIGMA] += count - self.final_sigmas
+            else:
+                for l in c.lower():
+                    lowered[l] += count
+        return +lowered
+
+    def save(self, path):
+        data = {
+            'final-sigmas': self.final_sigmas,
+            'counts': {
+                '{:04X}'.format(ord(c)): n for c, n in
+                sorted(self.counts.items())
+            },
+        }
+        with open(path, 'w') as out:
+            json.dump(data, out, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        counts = Counter({
+            chr(int(k, 16)): n for k, n in data['counts'].items()
+        })
+        return cls(counts, data['final-sigmas'])
+
+
+def count_text(text):
+    codepoints = np.frombuffer(text.encode('utf-32-le'), dtype='<u4')
+    counts = np.bincount(codepoints)
+    nonzero = np.flatnonzero(counts)
+    histogram = CharHistogram(Counter(dict(zip(
+        map(chr, nonzero.tolist()), counts[nonzero].tolist()))))
+    if CAPITAL_SIGMA in text:
+        # lines end at newlines, so lowercasing the chunk as a whole
+        # gives the same final sigmas as lowercasing each line
+        histogram.final_sigmas = (text.lower().count(FINAL_SIGMA) -
+                                  text.count(FINAL_SIGMA))
+    return histogram
+
+
+def count_chunk(chunk):
+    fn, start, end = chunk
+    if start is None:
+        # decompress and count in pieces of whole lines
+        histogram = CharHistogram()
+        with corpusio.open_text(fn, encoding='utf-8', newline='') as f:
+            for lines in iter(lambda: f.readlines(CHUNK_SIZE), []):
+                histogram.update(count_text(''.join(lines)))
+        return histogram
+    with open(fn, 'rb') as f:
+        f.seek(start)
+        data = f.read(end-start)
+    return count_text(data.decode('utf-8'))
+
+
+def count_files(fns, jobs=1, chunk_size=CHUNK_SIZE):
+    chunks = [c for fn in fns for c in corpusio.file_chunks(fn, chunk_size)]
+    histogram = CharHistogram()
+    if jobs > 1 and len(chunks) > 1:
+        with Pool(min(jobs, len(chunks))) as pool:
+            for h in pool.imap_unordered(count_chunk, chunks):
+                histogram.update(h)
+    else:
+        for chunk in chunks:
+            histogram.update(count_chunk(chunk))
+    stagemetrics.count('characters', sum(histogram.counts.values()))
+    return histogram
+
+
+def add_histogram_arguments(ap):
+    # Add options for tools answering from histograms to ArgumentParser
+    ap.add_argument('--histogram', metavar='FILE', default=None,
+                    help='Read character counts from histogram saved ' +
+                    'with --save-histogram instead of files')
+    ap.add_argument('-j', '--jobs', metavar='N', default=os.cpu_count(),
+                    type=int, help='Number of worker processes')
+    ap.add_argument('--save-histogram', metavar='FILE', default=None,
+                    help='Save character histogram of files to FILE')
+    ap.add_argument('file', nargs='*')
+
+
+def get_histogram(options):
+    # Return CharHistogram for options set by add_histogram_arguments
+    if options.histogram is not None:
+        if options.file:
+            raise ValueError('both --histogram and files given')
+        return CharHistogram.load(options.histogram)
+    if not options.file:
+        raise ValueError('no files or --histogram given')
+    histogram = count_files(options.file, options.jobs)
+    if options.save_histogram is not None:
+        histogram.save(options.save_histogram)
+    return histogram
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    histogram = count_files(args.file, args.jobs)
+    histogram.save(args.output)
+    print('counted {} characters ({} distinct) in {} files'.format(
+        sum(histogram.counts.values()), len(histogram.counts),
+        len(args.file)), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(stagemetrics.run_main(main, sys.argv))
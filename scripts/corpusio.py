@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+# Read and write possibly compressed corpus files.
+#
+# Readers detect the codec (gzip, bzip2, xz or, if the zstandard
+# package is installed, zstd) from the magic bytes at the start of the
+# file, so that compressed intermediates need no special names. Writers
+# compress blocks of output independently in a pool of threads (the
+# compression libraries release the GIL) and write them in order from a
+# separate thread; each block is a complete gzip member, bzip2 stream,
+# xz stream or zstd frame, and their concatenation is a valid file.
+# list_files() lists the corpus files in directories given as input and
+# file_chunks() divides files into byte ranges for parallel reading.
+
+import sys
+import os
+import io
+import re
+import gzip
+import bz2
+import lzma
+import threading
+
+from queue import Queue
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Codec names for --output-codec ('none' for uncompressed output)
+CODECS = ('none', 'gz', 'bz2', 'xz', 'zst')
+
+# Patterns matching the start of files compressed with each codec. For
+# bz2, the "BZh" signature and block size digit are followed by the
+# magic of the first block ("1AY&SY") or, for empty data, of the end
+# of the stream, as text can start with "BZh".
+MAGIC = (
+    (re.compile(re.escape(b'\x1f\x8b')), 'gz'),
+    (re.compile(rb'BZh[1-9](?:1AY&SY|\x17rE8P\x90)'), 'bz2'),
+    (re.compile(re.escape(b'\xfd7zXZ\x00')), 'xz'),
+    (re.compile(re.escape(b'\x28\xb5\x2f\xfd')), 'zst'),
+)
+
+# Number of bytes needed to match MAGIC
+MAGIC_SIZE = 10
+
+# Default compression levels, favouring speed
+DEFAULT_LEVELS = {
+    'gz': 6,
+    'bz2': 9,
+    'xz': 1,
+    'zst': 3,
+}
+
+# Size of uncompressed blocks compressed independently
+BLOCK_SIZE = 4 * 2**20
+
+# Default size of byte ranges from file_chunks()
+CHUNK_SIZE = 16 * 2**20
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Decompress or recompress corpus files.')
+    add_output_arguments(ap)
+    ap.add_argument('-d', '--detect', default=False, action='store_true',
+                    help='Only print the codec of each file')
+    ap.add_argument('file', nargs='+')
+    return ap
+
+
+def add_output_arguments(ap):
+    # Add options for compressing output to ArgumentParser
+    ap.add_argument('--output-codec', choices=CODECS, default='none',
+                    help='Compress output with codec (default none)')
+    ap.add_argument('--compress-level', metavar='N', default=None, type=int,
+                    help='Compression level (default depends on codec)')
+    ap.add_argument('--compress-threads', metavar='N', default=2, type=int,
+                    help='Number of threads compressing output (default 2)')
+
+
+def detect_codec(path):
+    # Return the codec name of compressed file path, or None
+    with open(path, 'rb') as f:
+        head = f.read(MAGIC_SIZE)
+    for magic, codec in MAGIC:
+        if magic.match(head):
+            return codec
+    return None
+
+
+def is_compressed(path):
+    return detect_codec(path) is not None
+
+
+def check_codec(codec):
+    if codec == 'zst' and zstandard is None:
+        raise ValueError('zstd requires the zstandard package ' +
+                         '(try `pip3 install zstandard`?)')
+
+
+def open_binary(path):
+    # Open path for reading decompressed bytes
+    codec = detect_codec(path)
+    check_codec(codec)
+    if codec is None:
+        return open(path, 'rb')
+    elif codec == 'gz':
+        return gzip.open(path, 'rb')
+    elif codec == 'bz2':
+        return bz2.open(path, 'rb')
+    elif codec == 'xz':
+        return lzma.open(path, 'rb')
+    else:
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            open(path, 'rb'), read_across_frames=True, closefd=True)
+        return io.BufferedReader(reader)
+
+
+def open_text(path, encoding=None, errors=None, newline=None):
+    # Open path for reading text, as open(path) but decompressing
+    if not is_compressed(path):
+        return open(path, encoding=encoding, errors=errors, newline=newline)
+    return io.TextIOWrapper(open_binary(path), encoding=encoding,
+                            errors=errors, newline=newline)
+
+
+def list_files(paths):
+    # Return (path, name) pairs for given files and the (non-hidden)
+    # files in given directories, with names relative to directories.
+    # Document indexes (.idx) in directories are skipped.
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append((path, os.path.basename(path)))
+            continue
+        found = []
+        for root, dirs, fns in os.walk(path):
+            found.extend(os.path.join(root, fn) for fn in fns
+                         if not (fn.startswith('.') or fn.endswith('.idx')))
+        files.extend((fn, os.path.relpath(fn, path)) for fn in sorted(found))
+    return files
+
+
+def file_chunks(fn, chunk_size=CHUNK_SIZE):
+    # Return (path, start, end) byte ranges of approximately chunk_size
+    # bytes ending at newlines. Compressed files are a single chunk
+    # with None for start and end.
+    if is_compressed(fn):
+        return [(fn, None, None)]
+    size = os.path.getsize(fn)
+    chunks, start = [], 0
+    with open(fn, 'rb') as f:
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            chunks.append((fn, start, end))
+            start = end
+    return chunks
+
+
+def compress_block(codec, level, data):
+    if codec == 'gz':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    elif codec == 'bz2':
+        return bz2.compress(data, level)
+    elif codec == 'xz':
+        return lzma.compress(data, preset=level)
+    else:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+class CompressedWriter(io.RawIOBase):
+    """Binary writer compressing blocks in parallel threads."""
+
+    def __init__(self, fileobj, codec, level=None, threads=2,
+                 close_fileobj=True, block_size=BLOCK_SIZE):
+        check_codec(codec)
+        self.fileobj = fileobj
+        self.codec = codec
+        self.level = DEFAULT_LEVELS[codec] if level is None else level
+        self.close_fileobj = close_fileobj
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.executor = ThreadPoolExecutor(max(1, threads))
+        # Futures of compressed blocks in output order; bounded to
+        # limit memory use when compression or writing falls behind
+        self.queue = Queue(maxsize=max(1, threads) * 2)
+        self.error = None
+        self.writer = threading.Thread(target=self._write_blocks,
+                                       daemon=True)
+        self.writer.start()
+
+    def _write_blocks(self):
+        while True:
+            future = self.queue.get()
+            if future is None:
+                break
+            try:
+                if self.error is None:
+                    self.fileobj.write(future.result())
+            except BaseException as e:
+                self.error = e
+
+    def _submit(self, data):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(self.executor.submit(
+            compress_block, self.codec, self.level, bytes(data)))
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.block_size:
+            self._submit(self.buffer)
+            self.buffer = bytearray()
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer:
+                self._submit(self.buffer)
+                self.buffer = bytearray()
+        finally:
+            self.queue.put(None)
+            self.writer.join()
+            self.executor.shutdown()
+            if self.close_fileobj:
+                self.fileobj.close()
+            else:
+                self.fileobj.flush()
+            super().close()
+        if self.error is not None:
+            raise self.error
+
+
+def wrap_text(fileobj, codec, level=None, threads=2, encoding=None,
+              close_fileobj=True):
+    writer = CompressedWriter(fileobj, codec, level, threads, close_fileobj)
+    return io.TextIOWrapper(io.BufferedWriter(writer, BLOCK_SIZE),
+                            encoding=encoding)
+
+
+def open_output(path, codec='none', level=None, threads=2, encoding=None):
+    # Open path for writing text, compressed with codec unless 'none'
+    if codec in (None, 'none'):
+        return open(path, 'w', encoding=encoding)
+    return wrap_text(open(path, 'wb'), codec, level, threads, encoding)
+
+
+def options_output(path, options):
+    # open_output() with options set by add_output_arguments()
+    return open_output(path, options.output_codec, options.compress_level,
+                       options.compress_threads)
+
+
+@contextmanager
+def compressed_stdout(options):
+    # Compress what is written to sys.stdout in the context as given
+    # by options set by add_output_arguments()
+    if options.output_codec in (None, 'none'):
+        yield
+        return
+    original = sys.stdout
+    original.flush()
+    sys.stdout = wrap_text(original.buffer, options.output_codec,
+                           options.compress_level, options.compress_threads,
+                           original.encoding, close_fileobj=False)
+    try:
+        yield
+    finally:
+        try:
+            sys.stdout.close()
+        finally:
+            sys.stdout = original
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    if args.detect:
+        for fn in args.file:
+            print('{}\t{}'.format(fn, detect_codec(fn) or 'none'))
+        return 0
+    try:
+        with compressed_stdout(args):
+            out = sys.stdout.buffer
+            for fn in args.file:
+                with open_binary(fn) as f:
+                    for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                        out.write(block)
+    except ValueError as e:
+        print('error: {}'.format(e), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
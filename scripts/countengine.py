@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+
+# Count keys such as words or word n-grams in large corpora in bounded
+# memory.
+#
+# Worker processes count the keys in chunks of the input files
+# (document ranges of indexed files, byte ranges ending at newlines
+# otherwise), and whenever a worker's counter exceeds its share of the
+# memory budget, it is written to disk as a run sorted by key. The runs
+# are combined with a k-way merge (in several passes if there are more
+# than MERGE_WIDTH) into a count table: a text file of "key<TAB>count"
+# lines sorted by key, with a sparse index of every SPARSE_INTERVAL-th
+# key in TABLE.sparse for lookups with a seek and a short scan. Tabs,
+# newlines and backslashes in keys are escaped in runs and tables.
+
+import sys
+import os
+import re
+import heapq
+import shutil
+import tempfile
+
+from bisect import bisect_right
+from collections import Counter
+from itertools import groupby
+from multiprocessing import Pool
+from operator import itemgetter
+
+import corpusio
+import stagemetrics
+
+from docindex import load_index
+
+
+# Suffix of the sparse index of a count table
+SPARSE_SUFFIX = '.sparse'
+
+# Number of table lines per sparse index entry
+SPARSE_INTERVAL = 256
+
+# Maximum number of runs merged at once
+MERGE_WIDTH = 64
+
+# Approximate bytes of memory used per key in a counter (dict entry,
+# string and int objects), for keeping within the memory budget
+BYTES_PER_KEY = 200
+
+UNITS = ('words', 'basic')
+
+# Mapper function of worker process, see init_worker()
+WORKER_MAPPER = None
+
+ESCAPES = {'\\': '\\\\', '\t': '\\t', '\n': '\\n'}
+UNESCAPES = {v: k for k, v in ESCAPES.items()}
+ESCAPE_RE = re.compile(r'[\\\t\n]')
+UNESCAPE_RE = re.compile(r'\\[\\tn]')
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Count keys in bounded memory.')
+    sub = ap.add_subparsers(dest='command')
+    sub.required = True
+    count = sub.add_parser('count', help='Count keys in files into table')
+    add_count_arguments(count)
+    count.add_argument('-o', '--output', metavar='TABLE', required=True,
+                       help='Count table to write')
+    count.add_argument('--ngram', metavar='N', default=1, type=int,
+                       help='Count n-grams of N keys (default 1)')
+    count.add_argument('--unit', choices=UNITS, default='words',
+                       help='Count whitespace-separated words or BERT ' +
+                       'basic tokens (default words)')
+    count.add_argument('--uncased', default=False, action='store_true',
+                       help='Lowercase and strip accents basic tokens')
+    count.add_argument('file', nargs='+', help='File or directory')
+    lookup = sub.add_parser('lookup', help='Print counts of keys')
+    lookup.add_argument('table', metavar='TABLE')
+    lookup.add_argument('key', nargs='+')
+    top = sub.add_parser('top', help='Print the most frequent keys')
+    top.add_argument('-n', '--number', metavar='N', default=20, type=int,
+                     help='Number of keys (default 20)')
+    top.add_argument('table', metavar='TABLE')
+    return ap
+
+
+def add_count_arguments(ap):
+    # Add options for counting to ArgumentParser
+    ap.add_argument('-j', '--jobs', metavar='N', default=1, type=int,
+                    help='Number of counting worker processes (default 1)')
+    ap.add_argument('-m', '--memory-budget', metavar='MB', default=1024,
+                    type=int, help='Memory for counters of all workers ' +
+                    'before spilling to disk (default 1024)')
+    ap.add_argument('--tmpdir', metavar='DIR', default=None,
+                    help='Directory for spill files (default system temp)')
+
+
+def escape(key):
+    return ESCAPE_RE.sub(lambda m: ESCAPES[m.group()], key)
+
+
+def unescape(key):
+    return UNESCAPE_RE.sub(lambda m: UNESCAPES[m.group()], key)
+
+
+def parse_line(l):
+    key, count = l.rstrip('\n').rsplit('\t', 1)
+    return key, int(count)
+
+
+def write_run(items, path):
+    # Write (escaped key, count) items sorted by key to path
+    with open(path, 'w', encoding='utf-8') as out:
+        for key, count in items:
+            out.write('{}\t{}\n'.format(key, count))
+
+
+def read_run(path):
+    with open(path, encoding='utf-8') as f:
+        for l in f:
+            yield parse_line(l)
+
+
+def merge_items(iterables):
+    # Merge iterables of (key, count) sorted by key, summing counts
+    merged = heapq.merge(*iterables, key=itemgetter(0))
+    for key, group in groupby(merged, key=itemgetter(0)):
+        yield key, sum(c for _, c in group)
+
+
+class SpillingCounter(object):
+    """Counter writing sorted runs to disk when over a memory budget."""
+
+    def __init__(self, spill_prefix, memory_budget):
+        self.spill_prefix = spill_prefix
+        self.max_keys = max(1, memory_budget // BYTES_PER_KEY)
+        self.counts = Counter()
+        self.runs = []
+
+    def update(self, keys):
+        self.counts.update(keys)
+        if len(self.counts) > self.max_keys:
+            self.spill()
+
+    def spill(self):
+        if not self.counts:
+            return
+        path = '{}-{}.run'.format(self.spill_prefix, len(self.runs))
+        write_run(sorted((escape(k), c) for k, c in self.counts.items()),
+                  path)
+        self.runs.append(path)
+        self.counts = Counter()
+
+    def close(self):
+        # Spill remaining counts and return paths of runs
+        self.spill()
+        return self.runs
+
+
+def input_chunks(fn, parts):
+    # Return (path, start, end) byte ranges of fn for counting, from
+    # the document index of the file if there is a current one
+    index = load_index(fn)
+    if index is None:
+        return corpusio.file_chunks(fn)
+    with index:
+        return [(fn, *index.byte_range(start, end))
+                for start, end in index.split(parts)]
+
+
+def read_lines(chunk):
+    # Yield lines of (path, start, end) chunk, whole file if start is
+    # None
+    fn, start, end = chunk
+    if start is None:
+        with corpusio.open_text(fn, encoding='utf-8') as f:
+            yield from f
+        return
+    with open(fn, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        for l in f:
+            if remaining <= 0:
+                break
+            remaining -= len(l)
+            yield l.decode('utf-8')
+
+
+def ngrams(keys, n):
+    return (' '.join(keys[i:i+n]) for i in range(len(keys)-n+1))
+
+
+def make_mapper(unit='words', n=1, uncased=False):
+    # Return function mapping a line to the keys to count
+    if unit == 'basic':
+        from fasttokenization import FastBasicTokenizer
+        split = FastBasicTokenizer(do_lower_case=uncased).tokenize
+    else:
+        split = str.split
+    if n == 1:
+        return split
+    return lambda line: ngrams(split(line), n)
+
+
+def init_worker(mapper_args):
+    global WORKER_MAPPER
+    WORKER_MAPPER = make_mapper(*mapper_args)
+
+
+def count_chunks(job):
+    # Count keys in chunks, returning paths of spilled runs and the
+    # number of lines
+    chunks, spill_prefix, memory_budget = job
+    counter = SpillingCounter(spill_prefix, memory_budget)
+    mapper, lines = WORKER_MAPPER, 0
+    for chunk in chunks:
+        for l in read_lines(chunk):
+            counter.update(mapper(l))
+            lines += 1
+    return counter.close(), lines
+
+
+def merge_runs(runs, spill_dir):
+    # Merge runs until at most MERGE_WIDTH remain, return their paths
+    level = 0
+    while len(runs) > MERGE_WIDTH:
+        merged = []
+        for i in range(0, len(runs), MERGE_WIDTH):
+            group = runs[i:i+MERGE_WIDTH]
+            path = os.path.join(spill_dir, 'merge-{}-{}.run'.format(
+                level, len(merged)))
+            write_run(merge_items([read_run(p) for p in group]), path)
+            for p in group:
+                os.remove(p)
+            merged.append(path)
+        runs, level = merged, level + 1
+    return runs
+
+
+def write_table(items, path):
+    # Write (escaped key, count) items sorted by key to count table at
+    # path with its sparse index; returns number of keys and total.
+    tmppath, sparse_tmppath = path + '.tmp', path + SPARSE_SUFFIX + '.tmp'
+    keys, total, offset = 0, 0, 0
+    with open(tmppath, 'wb') as out, \
+         open(sparse_tmppath, 'w', encoding='utf-8') as sparse:
+        for key, count in items:
+            if keys % SPARSE_INTERVAL == 0:
+                sparse.write('{}\t{}\n'.format(key, offset))
+            data = '{}\t{}\n'.format(key, count).encode('utf-8')
+            out.write(data)
+            offset += len(data)
+            keys += 1
+            total += count
+    os.replace(sparse_tmppath, path + SPARSE_SUFFIX)
+    os.replace(tmppath, path)
+    return keys, total
+
+
+def count_files(fns, output, mapper_args, options):
+    # Count keys in files into count table output using workers and
+    # spill files as given by options from add_count_arguments().
+    # Returns number of distinct keys and total count.
+    jobs = max(1, options.jobs)
+    chunks = [c for fn in fns for c in input_chunks(fn, jobs)]
+    groups = [chunks[i::jobs] for i in range(jobs) if chunks[i::jobs]]
+    budget = max(1, options.memory_budget) * 2**20 // max(1, len(groups))
+    spill_dir = tempfile.mkdtemp(prefix='countengine-', dir=options.tmpdir)
+    try:
+        tasks = [(group, os.path.join(spill_dir, str(i)), budget)
+                 for i, group in enumerate(groups)]
+        if len(tasks) > 1:
+            with Pool(len(tasks), init_worker, (mapper_args,)) as pool:
+                results = pool.map(count_chunks, tasks)
+        else:
+            init_worker(mapper_args)
+            results = [count_chunks(t) for t in tasks]
+        runs = [r for rs, _ in results for r in rs]
+        stagemetrics.count('lines', sum(lines for _, lines in results))
+        stagemetrics.count('runs', len(runs))
+        runs = merge_runs(runs, spill_dir)
+        keys, total = write_table(
+            merge_items([read_run(p) for p in runs]), output)
+    finally:
+        shutil.rmtree(spill_dir)
+    stagemetrics.count('keys', keys)
+    stagemetrics.count('total', total)
+    return keys, total
+
+
+def read_table(path):
+    # Yield (key, count) from count table in key order
+    with open(path, encoding='utf-8') as f:
+        for l in f:
+            key, count = parse_line(l)
+            yield unescape(key), count
+
+
+class CountTable(object):
+    """Sorted on-disk count table with lookups via a sparse index.
+
+    Supports table[key] (0 for missing keys), key in table, items()
+    and most_common(n).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.keys, self.offsets = [], []
+        with open(path + SPARSE_SUFFIX, encoding='utf-8') as f:
+            for l in f:
+                key, offset = parse_line(l)
+                self.keys.append(key)
+                self.offsets.append(offset)
+        self.file = open(path, 'rb')
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, key, default=0):
+        key = escape(key)
+        i = bisect_right(self.keys, key) - 1
+        if i < 0:
+            return default
+        self.file.seek(self.offsets[i])
+        for _ in range(SPARSE_INTERVAL):
+            l = self.file.readline()
+            if not l:
+                break
+            k, count = parse_line(l.decode('utf-8'))
+            if k == key:
+                return count
+            elif k > key:
+                break
+        return default
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __contains__(self, key):
+        return self.get(key, None) is not None
+
+    def items(self):
+        # Yield (key, count) in key order
+        return read_table(self.path)
+
+    def most_common(self, n):
+        return heapq.nlargest(n, self.items(), key=itemgetter(1))
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    if args.command == 'count':
+        fns = [fn for fn, _ in corpusio.list_files(args.file)]
+        keys, total = count_files(fns, args.output,
+                                  (args.unit, args.ngram, args.uncased), args)
+        print('counted {} keys, {} distinct, in {}'.format(
+            total, keys, args.output), file=sys.stderr)
+        return 0
+    with CountTable(args.table) as table:
+        if args.command == 'lookup':
+            for key in args.key:
+                print('{}\t{}'.format(key, table[key]))
+        else:
+            for key, count in table.most_common(args.number):
+                print('{}\t{}'.format(key, count))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(stagemetrics.run_main(main, sys.argv))
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+# Create BERT pretraining TFRecords for several sequence lengths from a
+# text file, WordPiece-tokenizing the text only once.
+#
+# Uses the functions of bert/create_pretraining_data.py and produces
+# the same records as running it separately with the same flags for
+# each target. Token ids are cached with sentence and document offsets
+# (optionally in a file reused across runs), and the instances for the
+# targets are created in parallel worker processes.
+
+import sys
+import os
+import json
+import random
+import hashlib
+
+import numpy as np
+
+from multiprocessing import get_context
+
+import corpusio
+import stagemetrics
+
+from docindex import build_index, load_index
+from fasttokenization import FastBasicTokenizer
+from wordpiece import MemoizedFullTokenizer
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_BERT_DIR = os.path.join(BASE_DIR, 'bert')
+
+# Version of the cache format, stored in cache metadata
+CACHE_VERSION = 1
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Create pretraining TFRecords.')
+    ap.add_argument('--bert-dir', metavar='DIR', default=DEFAULT_BERT_DIR,
+                    help='Directory with create_pretraining_data.py')
+    ap.add_argument('--cache', metavar='FILE', default=None,
+                    help='Read token ids from FILE if current, otherwise ' +
+                    'tokenize and save them to FILE')
+    ap.add_argument('--cache-only', default=False, action='store_true',
+                    help='Only create --cache FILE')
+    ap.add_argument('--jobs', metavar='N', default=1, type=int,
+                    help='Number of worker processes (default 1)')
+    ap.add_argument('--output', metavar='FILE', action='append', default=[],
+                    help='Output file for a target; can be repeated')
+    ap.add_argument('--output-params', metavar='FLAGS', action='append',
+                    default=[], help='Flags (e.g. --max_seq_length) for ' +
+                    'the target of the corresponding --output (give as ' +
+                    '--output-params=FLAGS)')
+    ap.add_argument('--wordpiece-cache', metavar='N', default=2**20,
+                    type=int, help='Number of word segmentations cached ' +
+                    'per tokenizing process (default 2**20)')
+    ap.add_argument('--params', metavar='FLAGS', default='',
+                    help='create_pretraining_data.py flags for all ' +
+                    'targets (give as --params=FLAGS)')
+    ap.add_argument('file', help='Input text file')
+    return ap
+
+
+def import_bert(bert_dir):
+    # Return the create_pretraining_data module
+    if bert_dir not in sys.path:
+        sys.path.insert(0, bert_dir)
+    import create_pretraining_data
+    return create_pretraining_data
+
+
+def parse_flags(cpd, params):
+    # Set create_pretraining_data.py flags from string of arguments
+    cpd.FLAGS.unparse_flags()
+    cpd.FLAGS([sys.argv[0]] + params.split())
+    return cpd.FLAGS
+
+
+def create_tokenizer(cpd, flags):
+    return cpd.tokenization.FullTokenizer(
+        vocab_file=flags.vocab_file, do_lower_case=flags.do_lower_case)
+
+
+# Tokenizer for worker processes
+WORKER_TOKENIZER = None
+
+
+def init_tokenize_worker(bert_dir, params, cache_size):
+    global WORKER_TOKENIZER
+    cpd = import_bert(bert_dir)
+    flags = parse_flags(cpd, params)
+    # FastBasicTokenizer does not preserve [unusedN] tokens
+    if getattr(flags, 'preserve_unused_tokens', False):
+        basic_tokenizer = None
+    else:
+        basic_tokenizer = FastBasicTokenizer(flags.do_lower_case)
+    WORKER_TOKENIZER = MemoizedFullTokenizer(
+        create_tokenizer(cpd, flags), cache_size, basic_tokenizer)
+
+
+def read_text_documents(fn):
+    # Yield the documents of a file without an index (e.g. compressed)
+    # as lists of sentences, as DocumentIndex.read_documents() does
+    with corpusio.open_text(fn, encoding='utf-8') as f:
+        sentences = []
+        for l in f:
+            if l.split():
+                sentences.append(l.rstrip())
+            elif sentences:
+                yield sentences
+                sentences = []
+        if sentences:
+            yield sentences
+
+
+def tokenize_documents(job):
+    # Return token ids, sentence lengths and document sentence counts
+    # for a range of documents (all if start is None), skipping
+    # sentences without tokens as create_training_instances() does,
+    # and the word cache hits and misses for the range.
+    fn, start, end = job
+    tokenizer = WORKER_TOKENIZER
+    hits, misses, _ = tokenizer.cache_info()
+    ids, sentence_lengths, document_sizes = [], [], []
+    if start is None:
+        index, documents = None, read_text_documents(fn)
+    else:
+        index = load_index(fn)
+        documents = index.read_documents(start, end)
+    for sentences in documents:
+        size = 0
+        for sentence in sentences:
+            sentence_ids = tokenizer.tokenize_to_ids(sentence.strip())
+            if sentence_ids:
+                ids.extend(sentence_ids)
+                sentence_lengths.append(len(sentence_ids))
+                size += 1
+        if size:
+            document_sizes.append(size)
+    if index is not None:
+        index.close()
+    end_hits, end_misses, _ = tokenizer.cache_info()
+    return (np.array(ids, dtype=np.int32),
+            np.array(sentence_lengths, dtype=np.int64),
+            np.array(document_sizes, dtype=np.int64),
+            (end_hits - hits, end_misses - misses))
+
+
+def cache_metadata(fn, flags):
+    # Identify input and tokenization settings
+    with open(flags.vocab_file, 'rb') as f:
+        vocab_hash = hashlib.sha1(f.read()).hexdigest()
+    st = os.stat(fn)
+    return {
+        'version': CACHE_VERSION,
+        'input-size': st.st_size,
+        'input-mtime': st.st_mtime_ns,
+        'vocab-sha1': vocab_hash,
+        'do-lower-case': flags.do_lower_case,
+    }
+
+
+def load_cache(path, metadata):
+    # Return cached arrays if path exists and matches metadata
+    if path is None or not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        if json.loads(str(data['metadata'])) != metadata:
+            return None
+        return data['ids'], data['sentences'], data['documents']
+
+
+def save_cache(path, metadata, ids, sentences, documents):
+    tmppath = path + '.tmp'
+    with open(tmppath, 'wb') as out:
+        np.savez(out, metadata=json.dumps(metadata), ids=ids,
+                 sentences=sentences, documents=documents)
+    os.replace(tmppath, path)
+
+
+def tokenize_file(fn, options):
+    # Return token ids and offsets of sentences (in ids) and documents
+    # (in sentences) for file, tokenizing document ranges in parallel.
+    # Compressed files cannot be indexed and are tokenized as a whole.
+    if corpusio.is_compressed(fn):
+        jobs = [(fn, None, None)]
+    else:
+        index = load_index(fn)
+        if index is None:
+            build_index(fn)
+            index = load_index(fn)
+        with index:
+            ranges = index.split(max(1, options.jobs) * 4)
+        jobs = [(fn, start, end) for start, end in ranges]
+    init_args = (options.bert_dir, options.params, options.wordpiece_cache)
+    if options.jobs > 1 and len(jobs) > 1:
+        with get_context('spawn').Pool(options.jobs, init_tokenize_worker,
+                                       init_args) as pool:
+            results = pool.map(tokenize_documents, jobs, chunksize=1)
+    else:
+        init_tokenize_worker(*init_args)
+        results = [tokenize_documents(job) for job in jobs]
+    hits = sum(r[3][0] for r in results)
+    misses = sum(r[3][1] for r in results)
+    stagemetrics.count('wordpiece-cache-hits', hits)
+    stagemetrics.count('wordpiece-cache-misses', misses)
+    print('wordpiece cache: {} hits, {} misses ({:.1%} hit rate)'.format(
+        hits, misses, hits/max(1, hits+misses)), file=sys.stderr)
+
+    def concatenate(arrays, dtype):
+        return np.concatenate([np.zeros(0, dtype=dtype)] + list(arrays))
+
+    ids = concatenate((r[0] for r in results), np.int32)
+    sentences = np.concatenate(
+        ([0], np.cumsum(concatenate((r[1] for r in results), np.int64))))
+    documents = np.concatenate(
+        ([0], np.cumsum(concatenate((r[2] for r in results), np.int64))))
+    return ids, sentences, documents
+
+
+def cached_documents(ids, sentences, documents, tokenizer):
+    # Return documents as lists of sentences with lists of tokens, as
+    # read by create_training_instances()
+    inv_vocab = tokenizer.inv_vocab
+    tokens = [inv_vocab[i] for i in ids.tolist()]
+    sentences = sentences.tolist()
+    all_sentences = [
+        tokens[s:e] for s, e in zip(sentences[:-1], sentences[1:])
+    ]
+    documents = documents.tolist()
+    return [all_sentences[s:e] for s, e in zip(documents[:-1], documents[1:])]
+
+
+def create_target(job):
+    # Create instances for target from cached token ids and write them,
+    # following create_pretraining_data.py main().
+    bert_dir, params, output, cache_arrays = job
+    cpd = import_bert(bert_dir)
+    flags = parse_flags(cpd, params)
+    tokenizer = create_tokenizer(cpd, flags)
+    all_documents = cached_documents(*cache_arrays, tokenizer)
+
+    rng = random.Random(flags.random_seed)
+    rng.shuffle(all_documents)
+    vocab_words = list(tokenizer.vocab.keys())
+    instances = []
+    for _ in range(flags.dupe_factor):
+        for document_index in range(len(all_documents)):
+            instances.extend(cpd.create_instances_from_document(
+                all_documents, document_index, flags.max_seq_length,
+                flags.short_seq_prob, flags.masked_lm_prob,
+                flags.max_predictions_per_seq, vocab_words, rng))
+    rng.shuffle(instances)
+
+    cpd.write_instance_to_example_files(
+        instances, tokenizer, flags.max_seq_length,
+        flags.max_predictions_per_seq, [output])
+    return output, len(instances)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    if len(args.output_params) != len(args.output):
+        print('error: give --output-params for each --output',
+              file=sys.stderr)
+        return 1
+    if not args.output and not args.cache_only:
+        print('error: no --output given', file=sys.stderr)
+        return 1
+    cpd = import_bert(args.bert_dir)
+    flags = parse_flags(cpd, args.params)
+    metadata = cache_metadata(args.file, flags)
+    cache_arrays = load_cache(args.cache, metadata)
+    if cache_arrays is None:
+        cache_arrays = tokenize_file(args.file, args)
+        if args.cache is not None:
+            save_cache(args.cache, metadata, *cache_arrays)
+    stagemetrics.count('documents-in', len(cache_arrays[2]) - 1)
+    if args.cache_only:
+        return 0
+    jobs = [(args.bert_dir, args.params + ' ' + target_params, output,
+             cache_arrays)
+            for target_params, output in zip(args.output_params, args.output)]
+    if args.jobs > 1 and len(jobs) > 1:
+        with get_context('spawn').Pool(min(args.jobs, len(jobs))) as pool:
+            results = pool.map(create_target, jobs, chunksize=1)
+    else:
+        results = [create_target(job) for job in jobs]
+    for output, count in results:
+        stagemetrics.count('instances', count)
+        print('wrote {} instances to {}'.format(count, output),
+              file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(stagemetrics.run_main(main, sys.argv))
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+# Remove near-duplicate documents from text with blank lines separating
+# documents, keeping the first document of each cluster.
+#
+# Documents are represented by MinHash signatures over hashed token
+# shingles, computed in parallel per file. Signatures are divided into
+# bands, and documents with identical band keys in any band are
+# candidate duplicates, accepted if the fraction of equal signature
+# values (an estimate of Jaccard similarity of the shingle sets) is at
+# least the threshold. Signatures and band keys are spilled to disk,
+# and bands are grouped one at a time, divided into partitions by key
+# when a band does not fit in the memory budget.
+
+import sys
+import os
+import shutil
+import tempfile
+import zlib
+
+import numpy as np
+
+from multiprocessing import Pool
+
+import corpusio
+import stagemetrics
+
+
+
+# Multiplier for combining token and signature value hashes
+HASH_MULTIPLIER = np.uint64(0x100000001b3)
+
+# Approximate bytes of memory used per document when grouping a band
+BYTES_PER_BAND_ENTRY = 32
+
+# Number of candidate pairs verified at a time
+VERIFY_BLOCK = 65536
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Remove near-duplicate documents.')
+    ap.add_argument('-b', '--bands', metavar='N', default=16, type=int,
+                    help='Number of LSH bands (default 16)')
+    ap.add_argument('-j', '--jobs', metavar='N', default=os.cpu_count(),
+                    type=int, help='Number of worker processes')
+    ap.add_argument('-k', '--shingle-size', metavar='N', default=5,
+                    type=int, help='Tokens per shingle (default 5)')
+    ap.add_argument('-m', '--memory-budget', metavar='MB', default=1024,
+                    type=int, help='Memory for grouping a band (default 1024)')
+    ap.add_argument('-p', '--num-perm', metavar='N', default=128, type=int,
+                    help='MinHash signature length (default 128)')
+    ap.add_argument('-r', '--report', metavar='FILE', default=None,
+                    help='Write removed documents and their duplicates')
+    ap.add_argument('-s', '--seed', metavar='INT', default=0, type=int,
+                    help='Random seed for hash functions (default 0)')
+    ap.add_argument('-t', '--threshold', metavar='FLOAT', default=0.8,
+                    type=float, help='Minimum estimated Jaccard similarity ' +
+                    'of duplicates (default 0.8)')
+    ap.add_argument('--tmpdir', metavar='DIR', default=None,
+                    help='Directory for spill files (default system temp)')
+    corpusio.add_output_arguments(ap)
+    ap.add_argument('input', help='Input directory')
+    ap.add_argument('output', help='Output directory')
+    return ap
+
+
+def read_documents(fn):
+    # Yield documents as lists of lines (with newlines)
+    with corpusio.open_text(fn) as f:
+        lines = []
+        for l in f:
+            if l.isspace() or not l:
+                if lines:
+                    yield lines
+                lines = []
+            else:
+                lines.append(l)
+        if lines:
+            yield lines
+
+
+def hash_functions(num_perm, seed):
+    # Return multipliers and increments for multiply-shift hashing
+    random = np.random.RandomState(seed)
+    a = random.randint(0, 2**63, size=num_perm, dtype=np.uint64) * 2 + 1
+    b = random.randint(0, 2**63, size=num_perm, dtype=np.uint64)
+    return a[:, np.newaxis], b[:, np.newaxis]
+
+
+def shingle_hashes(lines, shingle_size):
+    tokens = np.array([zlib.crc32(t.encode('utf-8'))
+                       for l in lines for t in l.split()], dtype=np.uint64)
+    count = max(1, len(tokens) - shingle_size + 1)
+    hashes = tokens[:count].copy()
+    for i in range(1, min(shingle_size, len(tokens))):
+        hashes = hashes * HASH_MULTIPLIER + tokens[i:i+count]
+    return np.unique(hashes)
+
+
+def minhash(hashes, a, b, block=4096):
+    signature = np.full(len(a), np.iinfo(np.uint32).max, dtype=np.uint32)
+    for i in range(0, len(hashes), block):
+        values = (a * hashes[i:i+block] + b) >> np.uint64(32)
+        np.minimum(signature, values.min(axis=1).astype(np.uint32),
+                   out=signature)
+    return signature
+
+
+def band_keys(signatures, bands):
+    # Return array (documents, bands) of hashes of signature bands
+    rows = signatures.shape[1] // bands
+    keys = np.zeros((len(signatures), bands), dtype=np.uint64)
+    for i in range(rows):
+        keys = keys * HASH_MULTIPLIER + signatures[:, i::rows][:, :bands]
+    return keys
+
+
+# Settings for worker processes
+WORKER_OPTIONS = None
+
+
+def init_worker(options):
+    global WORKER_OPTIONS
+    WORKER_OPTIONS = options
+
+
+def signature_file(job):
+    # Compute signatures and band keys for documents in file, saving
+    # them to the spill directory. Returns number of documents.
+    fn, spill_path = job
+    options = WORKER_OPTIONS
+    a, b = hash_functions(options.num_perm, options.seed)
+    signatures = [
+        minhash(shingle_hashes(lines, options.shingle_size), a, b)
+        for lines in read_documents(fn)
+    ]
+    signatures = np.array(signatures, dtype=np.uint32).reshape(
+        -1, options.num_perm)
+    np.save(spill_path + '.sig.npy', signatures)
+    np.save(spill_path + '.keys.npy', band_keys(signatures, options.bands))
+    return len(signatures)
+
+
+def compute_signatures(files, spill_dir, options):
+    # Return memory-mapped signatures (documents, num_perm) and band
+    # keys (bands, documents) for all documents, and the number of
+    # documents in each file.
+    jobs = [(fn, os.path.join(spill_dir, str(i)))
+            for i, (fn, name) in enumerate(files)]
+    if options.jobs > 1:
+        with Pool(options.jobs, init_worker, (options,)) as pool:
+            counts = pool.map(signature_file, jobs, chunksize=1)
+    else:
+        init_worker(options)
+        counts = [signature_file(job) for job in jobs]
+    total = sum(counts)
+    signatures = np.lib.format.open_memmap(
+        os.path.join(spill_dir, 'signatures.npy'), mode='w+',
+        dtype=np.uint32, shape=(total, options.num_perm))
+    keys = np.lib.format.open_memmap(
+        os.path.join(spill_dir, 'keys.npy'), mode='w+',
+        dtype=np.uint64, shape=(options.bands, total))
+    offset = 0
+    for (fn, spill_path), count in zip(jobs, counts):
+        signatures[offset:offset+count] = np.load(spill_path + '.sig.npy')
+        keys[:, offset:offset+count] = np.load(spill_path + '.keys.npy').T
+        os.remove(spill_path + '.sig.npy')
+        os.remove(spill_path + '.keys.npy')
+        offset += count
+    signatures.flush()
+    keys.flush()
+    return signatures, keys, counts
+
+
+class UnionFind(object):
+    """Disjoint sets of documents with the smallest index as root."""
+
+    def __init__(self, size):
+        self.parent = np.arange(size)
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            self.parent[max(i, j)] = min(i, j)
+
+    def roots(self):
+        # Vectorized find for all documents (parents always precede
+        # children, so pointer jumping converges to the roots)
+        parent = self.parent
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        self.parent = parent
+        return parent
+
+
+def band_candidates(band, partitions, partition, block):
+    # Return (first, other) arrays of candidate pairs for documents
+    # with equal keys in a partition of the band, pairing each document
+    # with the first document having the same key. The band is read in
+    # blocks to select the partition.
+    if partitions > 1:
+        ids = []
+        for i in range(0, len(band), block):
+            keys = band[i:i+block]
+            selected = keys % np.uint64(partitions) == np.uint64(partition)
+            ids.append(np.flatnonzero(selected) + i)
+        ids = np.concatenate(ids) if ids else np.array([], dtype=int)
+    else:
+        ids = np.arange(len(band))
+    if not len(ids):
+        return ids, ids
+    keys = np.asarray(band[ids])
+    order = np.argsort(keys, kind='stable')
+    keys, ids = keys[order], ids[order]
+    starts = np.concatenate(([True], keys[1:] != keys[:-1]))
+    first = ids[np.maximum.accumulate(np.where(starts, np.arange(len(ids)),
+                                               0))]
+    pairs = ~starts
+    return first[pairs], ids[pairs]
+
+
+def verify_pairs(signatures, first, other, threshold):
+    # Return pairs with estimated similarity at least threshold
+    accepted_first, accepted_other = [], []
+    for i in range(0, len(first), VERIFY_BLOCK):
+        f, o = first[i:i+VERIFY_BLOCK], other[i:i+VERIFY_BLOCK]
+        similarity = np.mean(signatures[f] == signatures[o], axis=1)
+        accepted = similarity >= threshold
+        accepted_first.append(f[accepted])
+        accepted_other.append(o[accepted])
+    if not accepted_first:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    return np.concatenate(accepted_first), np.concatenate(accepted_other)
+
+
+def find_duplicates(signatures, keys, options):
+    # Return array mapping each document to the first document of its
+    # cluster.
+    total = keys.shape[1]
+    clusters = UnionFind(total)
+    budget = max(1, options.memory_budget) * 2**20
+    partitions = max(1, -(-total * BYTES_PER_BAND_ENTRY // budget))
+    block = max(1, budget // BYTES_PER_BAND_ENTRY)
+    for b in range(options.bands):
+        for p in range(partitions):
+            first, other = band_candidates(keys[b], partitions, p, block)
+            if not len(first):
+                continue
+            # skip pairs already in the same cluster
+            roots = clusters.roots()
+            new = roots[first] != roots[other]
+            first, other = first[new], other[new]
+            first, other = verify_pairs(signatures, first, other,
+                                        options.threshold)
+            for i, j in zip(first.tolist(), other.tolist()):
+                clusters.union(i, j)
+    return clusters.roots()
+
+
+def write_deduplicated(job):
+    # Write documents of file not in removed set; returns count written
+    fn, outpath, removed, options = job
+    removed = set(removed)
+    written = 0
+    os.makedirs(os.path.dirname(outpath), exist_ok=True)
+    tmppath = outpath + '.tmp'
+    with corpusio.options_output(tmppath, options) as out:
+        for i, lines in enumerate(read_documents(fn)):
+            if i not in removed:
+                out.write(''.join(lines))
+                out.write('\n')
+                written += 1
+    os.replace(tmppath, outpath)
+    return written
+
+
+def write_report(path, files, removed, roots, offsets):
+    # Write tab-separated file and document number of each removed
+    # document, file and document number of the kept duplicate, and the
+    # first line of the removed document.
+    def location(i):
+        f = int(np.searchsorted(offsets, i, 'right')) - 1
+        return files[f][1], int(i - offsets[f])
+
+    with open(path, 'w') as out:
+        for f, ((fn, name), in_file) in enumerate(zip(files, removed)):
+            if not in_file:
+                continue
+            wanted = set(in_file)
+            for d, lines in enumerate(read_documents(fn)):
+                if d in wanted:
+                    kept = location(roots[offsets[f]+d])
+                    print('{}\t{}\t{}\t{}\t{}'.format(
+                        name, d, kept[0], kept[1], lines[0].rstrip('\n')),
+                          file=out)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    if args.num_perm % args.bands != 0:
+        print('error: --num-perm must be divisible by --bands',
+              file=sys.stderr)
+        return 1
+    files = [(fn, name) for fn, name in corpusio.list_files([args.input])
+             if not fn.endswith('.tmp')]
+    spill_dir = tempfile.mkdtemp(prefix='dedupdocs-', dir=args.tmpdir)
+    try:
+        signatures, keys, counts = compute_signatures(files, spill_dir, args)
+        roots = find_duplicates(signatures, keys, args)
+        del signatures, keys
+    finally:
+        shutil.rmtree(spill_dir)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    removed = []
+    for f in range(len(files)):
+        start, end = offsets[f], offsets[f+1]
+        in_file = np.flatnonzero(roots[start:end] != np.arange(start, end))
+        removed.append(in_file.tolist())
+    jobs = [(fn, os.path.join(args.output, name), r, args)
+            for (fn, name), r in zip(files, removed)]
+    if args.jobs > 1:
+        with Pool(args.jobs) as pool:
+            written = pool.map(write_deduplicated, jobs, chunksize=1)
+    else:
+        written = [write_deduplicated(job) for job in jobs]
+    if args.report is not None:
+        write_report(args.report, files, removed, roots, offsets)
+    total, removed_count = sum(counts), sum(len(r) for r in removed)
+    stagemetrics.count('documents-in', total)
+    stagemetrics.count('documents-out', total - removed_count)
+    print('removed {}/{} ({:.1%}) near-duplicate documents, output {}'.format(
+        removed_count, total, removed_count/max(total, 1), sum(written)),
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(stagemetrics.run_main(main, sys.argv))
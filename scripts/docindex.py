@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+# Build and read document indexes for text with blank lines separating
+# documents and one sentence per line.
+#
+# The index for FILE is written to FILE.idx and consists of a header
+# followed by fixed-width little-endian arrays with the byte offset,
+# byte length, sentence count and token count of each document:
+#
+#     magic (8 bytes), document count (uint64), file size (uint64),
+#     file modification time in nanoseconds (uint64)
+#     offsets (uint64 * count)
+#     lengths (uint64 * count)
+#     sentences (uint32 * count)
+#     tokens (uint32 * count)
+#
+# The byte range of a document covers its sentence lines including
+# their newlines but not the blank lines separating documents. An
+# index is current if the size and modification time of the file match
+# those recorded in it; indexes in an older format are not current.
+
+import sys
+import os
+import mmap
+import struct
+
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from itertools import accumulate
+
+import corpusio
+import stagemetrics
+
+
+INDEX_SUFFIX = '.idx'
+
+MAGIC = b'WBPDIDX\x02'
+
+HEADER = struct.Struct('<8sQQQ')
+
+
+DocumentInfo = namedtuple('DocumentInfo', 'offset length sentences tokens')
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Build or query document indexes.')
+    ap.add_argument('-f', '--force', default=False, action='store_true',
+                    help='Rebuild indexes that are up to date')
+    ap.add_argument('-o', '--output', metavar='FILE', default=None,
+                    help='Write index to FILE (build with single file)')
+    ap.add_argument('-p', '--parts', metavar='N', default=1, type=int,
+                    help='Number of parts for split (default 1)')
+    ap.add_argument('command', choices=['build', 'stats', 'split'],
+                    help='build indexes, print stats from indexes, or ' +
+                    'print document ranges splitting files into parts ' +
+                    'with balanced token counts')
+    ap.add_argument('file', nargs='+')
+    return ap
+
+
+def index_path(fn):
+    return fn + INDEX_SUFFIX
+
+
+def is_index_path(fn):
+    return fn.endswith(INDEX_SUFFIX)
+
+
+def scan_documents(fn):
+    # Return arrays of offsets, lengths, sentence and token counts for
+    # the documents in the given file.
+    offsets, lengths = array('Q'), array('Q')
+    sentences, tokens = array('I'), array('I')
+    with open(fn, 'rb') as f:
+        offset, start, end, sents, toks = 0, None, None, 0, 0
+        for l in f:
+            split = l.decode('utf-8').split()
+            if split:
+                if start is None:
+                    start, sents, toks = offset, 0, 0
+                sents += 1
+                toks += len(split)
+                end = offset + len(l)
+            elif start is not None:
+                offsets.append(start)
+                lengths.append(end-start)
+                sentences.append(sents)
+                tokens.append(toks)
+                start = None
+            offset += len(l)
+        if start is not None:
+            offsets.append(start)
+            lengths.append(end-start)
+            sentences.append(sents)
+            tokens.append(toks)
+    return offsets, lengths, sentences, tokens
+
+
+def build_index(fn, output=None):
+    if corpusio.is_compressed(fn):
+        raise ValueError('cannot index compressed file {}'.format(fn))
+    if output is None:
+        output = index_path(fn)
+    stat = os.stat(fn)    # before scanning, so later changes are seen
+    arrays = scan_documents(fn)
+    if sys.byteorder != 'little':
+        for a in arrays:
+            a.byteswap()
+    tmppath = output + '.tmp'
+    with open(tmppath, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, len(arrays[0]), stat.st_size,
+                              stat.st_mtime_ns))
+        for a in arrays:
+            a.tofile(out)
+    os.replace(tmppath, output)
+    return len(arrays[0])
+
+
+class DocumentIndex(object):
+    """Memory-mapped document index for a text file.
+
+    Supports len(), index[i] (returning DocumentInfo) and reading
+    documents or ranges of documents from the indexed file.
+    """
+
+    def __init__(self, fn, path=None):
+        self.fn = fn
+        self.path = index_path(fn) if path is None else path
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < HEADER.size:
+            self._mmap.close()
+            raise ValueError('not a document index: {}'.format(self.path))
+        magic, count, self.file_size, self.file_mtime = HEADER.unpack_from(
+            self._mmap)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError('not a document index: {}'.format(self.path))
+        self.count = count
+        pos = HEADER.size
+        self.offsets, pos = self._array('Q', pos, count)
+        self.lengths, pos = self._array('Q', pos, count)
+        self.sentences, pos = self._array('I', pos, count)
+        self.tokens, pos = self._array('I', pos, count)
+
+    def _array(self, typecode, pos, count):
+        end = pos + array(typecode).itemsize * count
+        view = memoryview(self._mmap)[pos:end]
+        if sys.byteorder == 'little':
+            return view.cast(typecode), end
+        a = array(typecode, view.tobytes())
+        a.byteswap()
+        return a, end
+
+    def close(self):
+        for name in ('offsets', 'lengths', 'sentences', 'tokens'):
+            a = getattr(self, name)
+            if isinstance(a, memoryview):
+                a.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return DocumentInfo(self.offsets[i], self.lengths[i],
+                            self.sentences[i], self.tokens[i])
+
+    def is_current(self):
+        # True if the indexed file has the size and modification time
+        # it had when indexed
+        stat = os.stat(self.fn)
+        return (stat.st_size == self.file_size and
+                stat.st_mtime_ns == self.file_mtime)
+
+    def total_sentences(self):
+        return sum(self.sentences)
+
+    def total_tokens(self):
+        return sum(self.tokens)
+
+    def byte_range(self, start, end):
+        # Return (offset, end offset) in the file for documents
+        # start..end-1.
+        if start >= end:
+            return 0, 0
+        return (self.offsets[start],
+                self.offsets[end-1] + self.lengths[end-1])
+
+    def read_documents(self, start=0, end=None, encoding='utf-8'):
+        # Yield documents start..end-1 as lists of sentences, reading
+        # the file with a single seek.
+        if end is None:
+            end = self.count
+        begin, stop = self.byte_range(start, end)
+        with open(self.fn, 'rb') as f:
+            f.seek(begin)
+            data = f.read(stop-begin)
+        for i in range(start, end):
+            pos = self.offsets[i] - begin
+            text = data[pos:pos+self.lengths[i]].decode(encoding)
+            yield [s.rstrip() for s in text.split('\n') if s.strip()]
+
+    def document(self, i, encoding='utf-8'):
+        return next(self.read_documents(i, i+1, encoding))
+
+    def split(self, parts, weights=None):
+        # Return at most parts (start, end) ranges of documents with
+        # approximately equal total weight (default token count).
+        if weights is None:
+            weights = self.tokens
+        cumulative = list(accumulate(weights))
+        total = cumulative[-1] if cumulative else 0
+        ranges, start = [], 0
+        for p in range(1, parts+1):
+            end = (self.count if p == parts else
+                   bisect_left(cumulative, total * p / parts) + 1)
+            end = min(max(end, start), self.count)
+            if end > start:
+                ranges.append((start, end))
+            start = end
+        return ranges
+
+
+def load_index(fn):
+    # Return DocumentIndex for fn if a current index exists, else None.
+    path = index_path(fn)
+    if not os.path.exists(path):
+        return None
+    try:
+        index = DocumentIndex(fn, path)
+    except ValueError:
+        return None    # e.g. index in older format
+    if not index.is_current():
+        index.close()
+        return None
+    return index
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    if args.output is not None and len(args.file) > 1:
+        print('--output requires a single file', file=sys.stderr)
+        return 1
+    for fn in args.file:
+        if args.command == 'build':
+            if corpusio.is_compressed(fn):
+                print('not indexing compressed file {}'.format(fn),
+                      file=sys.stderr)
+                continue
+            if not args.force and args.output is None:
+                index = load_index(fn)
+                if index is not None:
+                    index.close()
+                    continue
+            count = build_index(fn, args.output)
+            stagemetrics.count('documents-indexed', count)
+            print('indexed {} documents in {}'.format(count, fn),
+                  file=sys.stderr)
+            continue
+        index = load_index(fn)
+        if index is None:
+            print('missing or outdated index for {}'.format(fn),
+                  file=sys.stderr)
+            return 1
+        with index:
+            if args.command == 'stats':
+                print('{}\tdocuments:{}\tsentences:{}\ttokens:{}'.format(
+                    fn, len(index), index.total_sentences(),
+                    index.total_tokens()))
+            else:
+                for start, end in index.split(args.parts):
+                    print('{}\t{}\t{}'.format(fn, start, end))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(stagemetrics.run_main(main, sys.argv))
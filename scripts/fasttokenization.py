@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# Fast BasicTokenizer compatible with bert/tokenization.py.
+#
+# Character classes are computed once for all codepoints: control
+# characters are removed and whitespace normalized with str.translate(),
+# CJK characters are spaced and punctuation split off with compiled
+# regular expressions, and the lowercasing, accent stripping and
+# punctuation splitting of each word is cached in a bounded LRU cache.
+# The output is identical to that of BasicTokenizer (which can be
+# checked on a corpus with --verify), except that [unusedN] tokens are
+# not preserved as with the preserve_unused_tokens flag of newer bert
+# versions.
+
+import sys
+import re
+import unicodedata
+
+from functools import lru_cache
+
+import corpusio
+import stagemetrics
+
+
+DEFAULT_CACHE_SIZE = 2**20
+
+# Codepoint ranges considered CJK characters (_is_chinese_char)
+CJK_RANGES = (
+    (0x4E00, 0x9FFF),
+    (0x3400, 0x4DBF),
+    (0x20000, 0x2A6DF),
+    (0x2A700, 0x2B73F),
+    (0x2B740, 0x2B81F),
+    (0x2B820, 0x2CEAF),
+    (0xF900, 0xFAFF),
+    (0x2F800, 0x2FA1F),
+)
+
+# ASCII non-letters and non-numbers treated as punctuation
+ASCII_PUNCTUATION_RANGES = ((33, 47), (58, 64), (91, 96), (123, 126))
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Basic tokenize text for BERT.')
+    ap.add_argument('--bert-dir', metavar='DIR', default=None,
+                    help='Directory with tokenization.py for --verify ' +
+                    '(default bert submodule)')
+    ap.add_argument('--cache-size', metavar='N', default=DEFAULT_CACHE_SIZE,
+                    type=int, help='Maximum number of cached words')
+    ap.add_argument('--uncased', default=False, action='store_true',
+                    help='Lowercase and strip accents (for uncased model)')
+    ap.add_argument('--verify', default=False, action='store_true',
+                    help='Compare to reference tokenizer instead of output')
+    ap.add_argument('file', nargs='+')
+    return ap
+
+
+def ranges(codepoints):
+    # Return (first, last) ranges of consecutive codepoints
+    result = []
+    for cp in sorted(codepoints):
+        if result and result[-1][1] == cp-1:
+            result[-1][1] = cp
+        else:
+            result.append([cp, cp])
+    return result
+
+
+def class_ranges(codepoint_ranges):
+    # Return regular expression character class contents for ranges
+    parts = []
+    for first, last in codepoint_ranges:
+        if first == last:
+            parts.append(re.escape(chr(first)))
+        else:
+            parts.append('{}-{}'.format(re.escape(chr(first)),
+                                        re.escape(chr(last))))
+    return ''.join(parts)
+
+
+@lru_cache(maxsize=None)
+def character_tables():
+    # Return str.translate() tables for cleaning text and stripping
+    # accents and the character class contents for punctuation, as
+    # defined by _clean_text(), _run_strip_accents() and
+    # _is_punctuation().
+    clean = {0: None, 0xfffd: None}
+    strip, punctuation = {}, set()
+    for first, last in ASCII_PUNCTUATION_RANGES:
+        punctuation.update(range(first, last+1))
+    for cp in range(sys.maxunicode+1):
+        category = unicodedata.category(chr(cp))
+        if category in ('Cc', 'Cf'):
+            clean[cp] = None
+        elif category == 'Zs':
+            clean[cp] = ' '
+        elif category == 'Mn':
+            strip[cp] = None
+        elif category.startswith('P'):
+            punctuation.add(cp)
+    for c in '\t\n\r':
+        clean[ord(c)] = ' '    # whitespace, not control
+    return clean, strip, class_ranges(ranges(punctuation))
+
+
+class FastBasicTokenizer(object):
+    """Drop-in replacement for BasicTokenizer with cached words."""
+
+    def __init__(self, do_lower_case=True, cache_size=DEFAULT_CACHE_SIZE):
+        self.do_lower_case = do_lower_case
+        self.clean_table, self.strip_table, punctuation = character_tables()
+        self.cjk_re = re.compile('[{}]'.format(class_ranges(CJK_RANGES)))
+        self.split_re = re.compile('[{0}]|[^{0}]+'.format(punctuation))
+        self.split_word = lru_cache(maxsize=cache_size)(self._split_word)
+
+    def _split_word(self, word):
+        # Return tuple of tokens for whitespace-separated word
+        if self.do_lower_case:
+            word = unicodedata.normalize('NFD', word.lower())
+            word = word.translate(self.strip_table)
+        return tuple(self.split_re.findall(word))
+
+    def tokenize(self, text):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'ignore')
+        text = text.translate(self.clean_table)
+        text = self.cjk_re.sub(r' \g<0> ', text)
+        tokens = []
+        for word in text.split():
+            tokens.extend(self.split_word(word))
+        return tokens
+
+    def cache_info(self):
+        # Return (hits, misses, current size) of the word cache
+        info = self.split_word.cache_info()
+        return info.hits, info.misses, info.currsize
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    tokenizer = FastBasicTokenizer(args.uncased, args.cache_size)
+    if args.verify:
+        # wordpiece.py uses this module
+        from wordpiece import DEFAULT_BERT_DIR, import_tokenization
+        tokenization = import_tokenization(args.bert_dir or DEFAULT_BERT_DIR)
+        reference = tokenization.BasicTokenizer(do_lower_case=args.uncased)
+    lines, mismatches = 0, 0
+    for fn in args.file:
+        with corpusio.open_text(fn) as f:
+            for ln, l in enumerate(f, start=1):
+                tokens = tokenizer.tokenize(l)
+                lines += 1
+                if not args.verify:
+                    print(' '.join(tokens))
+                elif tokens != reference.tokenize(l):
+                    mismatches += 1
+                    print('{}:{}: mismatch: {}'.format(fn, ln, l.rstrip('\n')),
+                          file=sys.stderr)
+    hits, misses, _ = tokenizer.cache_info()
+    stagemetrics.count('lines-in', lines)
+    stagemetrics.count('cache-hits', hits)
+    stagemetrics.count('cache-misses', misses)
+    if args.verify:
+        print('verified {} lines, {} mismatches'.format(lines, mismatches),
+              file=sys.stderr)
+        return 1 if mismatches else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(stagemetrics.run_main(main, sys.argv))
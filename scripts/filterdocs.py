@@ -9,9 +9,15 @@ import unicodedata
 
 from string import punctuation
 from collections import Counter
+from multiprocessing import Pool
+
+import corpusio
+import stagemetrics
+
 
 try:
     from langdetect import detect, DetectorFactory
+    from langdetect.detector_factory import init_factory
     # Make langdetect deterministic
     DetectorFactory.seed = 0
 except ImportError:
@@ -26,6 +32,24 @@ WORD_RE = None    # see compile_regular_expressions()
 # Regex definition for --foreign-ratio option
 FOREIGN_LETTER = None    # see compile_regular_expressions()
 
+# Active filter checks in order of evaluation
+CHECKS = None    # see compile_checks()
+
+# Word characters, including uppercase variants
+ALPHABET = None    # see compile_regular_expressions()
+
+# Character class flags, cached per character by char_classes()
+UPPER, DIGIT, PUNCT, FOREIGN, LETTER, NATIVE, DISTINCTIVE = (
+    1, 2, 4, 8, 16, 32, 64
+)
+CHAR_FLAGS = (UPPER, DIGIT, PUNCT, FOREIGN, LETTER, NATIVE, DISTINCTIVE)
+CHAR_CLASSES = {}
+
+PUNCTUATION = frozenset(punctuation)
+
+# Options of worker process for --output-dir, see init_worker()
+WORKER_OPTIONS = None
+
 
 # Languages not supported by langdetect or having a high langdetect
 # error rate
@@ -33,6 +57,14 @@ NO_LANGDETECT_LANGUAGES = (
     'sr', 'eu', 'hy', 'be', 'ga', 'gl', 'la', 'gd', 'ug', 'cu', 'mt'
 )
 
+# Scripts used by at most one language supported by langdetect. Text
+# written mostly in one of these can be accepted as the language
+# without running langdetect (see --prescreen-accept).
+DISTINCTIVE_SCRIPTS = (
+    'ARMENIAN', 'GEORGIAN', 'GREEK', 'HANGUL', 'HEBREW', 'HIRAGANA',
+    'KATAKANA', 'TAMIL', 'TELUGU', 'THAI',
+)
+
 # Unicode character ranges for selected languages
 UNICODE_RANGES = {
     'ja': [
@@ -49,6 +81,21 @@ UNICODE_RANGES = {
 def argparser():
     from argparse import ArgumentParser
     ap = ArgumentParser(description='Filter documents.')
+    add_filter_arguments(ap)
+    ap.add_argument('-j', '--jobs', metavar='N', default=1, type=int,
+                    help='number of worker processes for --output-dir')
+    ap.add_argument('-o', '--output-dir', metavar='DIR', default=None,
+                    help='filter each file into DIR instead of stdout, ' +
+                    'keeping paths relative to directories given as ' +
+                    'input and names up to the first "."; existing ' +
+                    'outputs are skipped, and --rejected names a directory')
+    corpusio.add_output_arguments(ap)
+    ap.add_argument('file', nargs='+', help='file (or with --output-dir, ' +
+                    'file or directory)')
+    return ap
+
+
+def add_filter_arguments(ap):
     ap.add_argument('-a', '--avg-len', default=None, type=int,
                     help='minimum average sentence length (lowercase words)')
     ap.add_argument('-d', '--digit-ratio', default=None, type=float,
@@ -59,6 +106,8 @@ def argparser():
                     help='invert filter criteria')
     ap.add_argument('-l', '--langdetect', metavar='LANG', default=None,
                     help='run langdetect to filter to LANG')
+    ap.add_argument('--langdetect-sents', metavar='N', default=None, type=int,
+                    help='run langdetect on at most N evenly spaced sentences')
     ap.add_argument('-L', '--limit', default=None, type=int,
                     help='limit number of documents to process')
     ap.add_argument('--language', default=None,
@@ -67,6 +116,16 @@ def argparser():
                     help='maximum ratio of lines without word tokens')
     ap.add_argument('-p', '--punct-ratio', default=None, type=float,
                     help='maximum ratio of punctuation characters')
+    ap.add_argument('-r', '--rejected', metavar='FILE', default=None,
+                    help='output documents failing filters to FILE with ' +
+                    'the fail reason prefixed to each line')
+    ap.add_argument('--prescreen-accept', metavar='RATIO', default=None,
+                    type=float, help='pass --langdetect without running ' +
+                    'langdetect if at least RATIO of letters are in a ' +
+                    'script distinctive to the language')
+    ap.add_argument('--prescreen-reject', metavar='RATIO', default=None,
+                    type=float, help='fail --langdetect without running ' +
+                    'langdetect if less than RATIO of letters are word chars')
     ap.add_argument('-s', '--min-sents', default=None, type=int,
                     help='minimum number of sentences')
     ap.add_argument('-S', '--max-sents', default=None, type=int,
@@ -81,45 +140,118 @@ def argparser():
                     help='minimum number of words')
     ap.add_argument('-W', '--word-chars', default=None,
                     help='characters allowed as part of words')
-    ap.add_argument('file', nargs='+')
-    return ap
-
-
-def num_toks(sentences):
-    return sum(len(s.split()) for s in sentences)
-
-
-def num_words(sentences):
-    return sum(len(WORD_RE.findall(s)) for s in sentences)
-
-
-def foreign_ratio(sentences):
-    return sum(len(FOREIGN_LETTER.findall(s)) for s in sentences)/char_count(sentences)
-
-
-def avg_len(sentences):
-    return num_words(sentences) / len(sentences)
-
-
-def char_count(sentences):
-    return sum(len(s) for s in sentences)
-
 
-def uppercase_ratio(sentences):
-    return sum(c.isupper() for s in sentences for c in s)/char_count(sentences)
 
-
-def digit_ratio(sentences):
-    return sum(c.isdigit() for s in sentences for c in s)/char_count(sentences)
-
-
-def no_word_ratio(sentences):
-    return sum(1 for s in sentences if len(WORD_RE.findall(s)) == 0)/len(sentences)
-
-
-def punctuation_ratio(sentences):
-    punct = set(punctuation)
-    return sum(c in punct for s in sentences for c in s)/char_count(sentences)
+def char_classes(c):
+    flags = CHAR_CLASSES.get(c)
+    if flags is None:
+        flags = ((UPPER if c.isupper() else 0) |
+                 (DIGIT if c.isdigit() else 0) |
+                 (PUNCT if c in PUNCTUATION else 0) |
+                 (FOREIGN if FOREIGN_LETTER.match(c) else 0))
+        if c.isalpha():
+            flags |= LETTER
+            if c in ALPHABET:
+                flags |= NATIVE
+                script = unicodedata.name(c, '').split(' ', 1)[0]
+                if script in DISTINCTIVE_SCRIPTS:
+                    flags |= DISTINCTIVE
+        CHAR_CLASSES[c] = flags
+    return flags
+
+
+class DocumentMetrics(object):
+    """Document statistics for filtering.
+
+    Statistics are grouped by the pass over the document that is
+    needed to compute them, and each group is computed once on first
+    use so that only the statistics required by active checks are
+    computed.
+    """
+
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self._num_toks = None
+        self._word_counts = None
+        self._char_counts = None
+        self.lid_path = None    # see language_fails()
+
+    @property
+    def num_sents(self):
+        return len(self.sentences)
+
+    @property
+    def num_toks(self):
+        if self._num_toks is None:
+            self._num_toks = sum(len(s.split()) for s in self.sentences)
+        return self._num_toks
+
+    @property
+    def word_counts(self):
+        # Number of words on each line
+        if self._word_counts is None:
+            self._word_counts = [len(WORD_RE.findall(s))
+                                 for s in self.sentences]
+        return self._word_counts
+
+    @property
+    def num_words(self):
+        return sum(self.word_counts)
+
+    @property
+    def avg_len(self):
+        return self.num_words / self.num_sents
+
+    @property
+    def no_word_ratio(self):
+        return self.word_counts.count(0) / self.num_sents
+
+    @property
+    def char_counts(self):
+        # Total character count and counts by character class flag,
+        # tallied from a single character histogram.
+        if self._char_counts is None:
+            histogram = Counter()
+            for s in self.sentences:
+                histogram.update(s)
+            total, counts = 0, Counter()
+            for c, count in histogram.items():
+                total += count
+                flags = char_classes(c)
+                if flags:
+                    for flag in CHAR_FLAGS:
+                        if flags & flag:
+                            counts[flag] += count
+            self._char_counts = (total, counts)
+        return self._char_counts
+
+    def char_ratio(self, flag):
+        total, counts = self.char_counts
+        return counts[flag] / total
+
+    @property
+    def uppercase_ratio(self):
+        return self.char_ratio(UPPER)
+
+    @property
+    def digit_ratio(self):
+        return self.char_ratio(DIGIT)
+
+    @property
+    def punctuation_ratio(self):
+        return self.char_ratio(PUNCT)
+
+    @property
+    def foreign_ratio(self):
+        return self.char_ratio(FOREIGN)
+
+    def letter_ratio(self, flag):
+        # Ratio of letters with given flag out of all letters, or None
+        # if there are no letters.
+        total, counts = self.char_counts
+        if not counts[LETTER]:
+            return None
+        return counts[flag] / counts[LETTER]
 
 
 def detect_lang(sentences):
@@ -131,41 +263,94 @@ def detect_lang(sentences):
         return None
 
 
-def filter_sentences(sentences, options):
-    if options.avg_len is not None and avg_len(sentences) < options.avg_len:
-        return 'avg-len'
-    if options.min_sents is not None and len(sentences) < options.min_sents:
-        return 'min-sents'
-    if options.max_sents is not None and len(sentences) > options.max_sents:
-        return 'max-sents'
-    if options.min_toks is not None and num_toks(sentences) < options.min_toks:
-        return 'min-toks'
-    if options.max_toks is not None and num_toks(sentences) > options.max_toks:
-        return 'max-toks'
-    if (options.no_word_ratio is not None and
-        no_word_ratio(sentences) > options.no_word_ratio):
-        return 'no-word-ratio'
-    if (options.punct_ratio is not None and
-        punctuation_ratio(sentences) > options.punct_ratio):
-        return 'punct-ratio'
-    if (options.upper_ratio is not None and
-        uppercase_ratio(sentences) > options.upper_ratio):
-        return 'upper-ratio'
-    if (options.digit_ratio is not None and
-        digit_ratio(sentences) > options.digit_ratio):
-        return 'digit-ratio'
-    if (options.foreign_ratio is not None and
-        foreign_ratio(sentences) > options.foreign_ratio):
-        return 'foreign-ratio'
-    if (options.min_words is not None and
-        num_words(sentences) < options.min_words):
-        return 'min-words'
-    if (options.langdetect is not None and
-        detect_lang(sentences) != options.langdetect):
-        return 'langdetect'
+def prescreen_language(metrics, options):
+    # Classify document language by the ratios of letters in the
+    # language alphabet and in a script distinctive to the language.
+    # Return True (accept), False (reject) or None (ambiguous).
+    if options.prescreen_reject is not None:
+        ratio = metrics.letter_ratio(NATIVE)
+        if ratio is not None and ratio < options.prescreen_reject:
+            return False
+    if options.prescreen_accept is not None:
+        ratio = metrics.letter_ratio(DISTINCTIVE)
+        if ratio is not None and ratio >= options.prescreen_accept:
+            return True
     return None
 
 
+def sample_sentences(sentences, max_sents):
+    # Return at most max_sents evenly spaced sentences
+    if max_sents is None or len(sentences) <= max_sents:
+        return sentences
+    step = len(sentences) / max_sents
+    return [sentences[int(i*step)] for i in range(max_sents)]
+
+
+def language_fails(metrics, options):
+    accept = prescreen_language(metrics, options)
+    if accept is not None:
+        metrics.lid_path = 'prescreen-accept' if accept else 'prescreen-reject'
+        return not accept
+    metrics.lid_path = 'langdetect'
+    sentences = sample_sentences(metrics.sentences, options.langdetect_sents)
+    return detect_lang(sentences) != options.langdetect
+
+
+def compile_checks(options):
+    global CHECKS
+
+    # Each check is (cost, name, test), where cost reflects the pass
+    # over the document needed to compute the metric and test returns
+    # True for documents that fail the check.
+    o = options
+    checks = []
+    if o.min_sents is not None:
+        checks.append((0, 'min-sents', lambda m: m.num_sents < o.min_sents))
+    if o.max_sents is not None:
+        checks.append((0, 'max-sents', lambda m: m.num_sents > o.max_sents))
+    if o.min_toks is not None:
+        checks.append((1, 'min-toks', lambda m: m.num_toks < o.min_toks))
+    if o.max_toks is not None:
+        checks.append((1, 'max-toks', lambda m: m.num_toks > o.max_toks))
+    if o.punct_ratio is not None:
+        checks.append((2, 'punct-ratio',
+                       lambda m: m.punctuation_ratio > o.punct_ratio))
+    if o.upper_ratio is not None:
+        checks.append((2, 'upper-ratio',
+                       lambda m: m.uppercase_ratio > o.upper_ratio))
+    if o.digit_ratio is not None:
+        checks.append((2, 'digit-ratio',
+                       lambda m: m.digit_ratio > o.digit_ratio))
+    if o.foreign_ratio is not None:
+        checks.append((2, 'foreign-ratio',
+                       lambda m: m.foreign_ratio > o.foreign_ratio))
+    if o.avg_len is not None:
+        checks.append((3, 'avg-len', lambda m: m.avg_len < o.avg_len))
+    if o.no_word_ratio is not None:
+        checks.append((3, 'no-word-ratio',
+                       lambda m: m.no_word_ratio > o.no_word_ratio))
+    if o.min_words is not None:
+        checks.append((3, 'min-words', lambda m: m.num_words < o.min_words))
+    if o.langdetect is not None:
+        checks.append((4, 'langdetect', lambda m: language_fails(m, o)))
+    checks.sort(key=lambda c: c[0])
+    CHECKS = [(name, test) for cost, name, test in checks]
+
+
+def filter_sentences(sentences, options, stats=None):
+    # Return the name of the first failing check (cheapest first), or
+    # None if the document passes all checks.
+    metrics = DocumentMetrics(sentences)
+    fail = None
+    for name, test in CHECKS:
+        if test(metrics):
+            fail = name
+            break
+    if stats is not None and metrics.lid_path is not None:
+        stats['lid-{}'.format(metrics.lid_path)] += 1
+    return fail
+
+
 def report_stats(name, stats, out=sys.stderr):
     stats = stats.copy()
     docs, output = stats.pop('total-docs'), stats.pop('output-docs')
@@ -177,8 +362,8 @@ def report_stats(name, stats, out=sys.stderr):
     pass
 
 
-def process_document(sentences, stats, options):
-    fail = filter_sentences(sentences, options)
+def process_document(sentences, stats, options, rejected_out=None, out=None):
+    fail = filter_sentences(sentences, options, stats)
     if fail is None:
         result = 'pass-all'
         skip = False
@@ -186,22 +371,28 @@ def process_document(sentences, stats, options):
         result = 'fail-{}'.format(fail)
         skip = True
     stats[result] += 1
+    if fail is not None and rejected_out is not None:
+        for s in sentences:
+            print('{}\t{}'.format(fail, s), file=rejected_out)
+        print(file=rejected_out)
     if options.invert:
         skip = not skip
     if skip:
         return 0
     else:
         for s in sentences:
-            print(s)
+            print(s, file=out)
         if sentences:
-            print()
+            print(file=out)
         return 1
 
 
-def process(fn, options):
+def process(fn, options, rejected_out=None, out=None, name=None):
+    # Filter documents in fn to out (default stdout) and return stats,
+    # reporting them under name (default basename of fn)
     stats = Counter()
     total_count, output_count = 0, 0
-    with open(fn) as f:
+    with corpusio.open_text(fn) as f:
         sentences = []
         for ln, l in enumerate(f, start=1):
             l = l.rstrip()
@@ -209,7 +400,8 @@ def process(fn, options):
                 sentences.append(l)
             else:
                 if sentences:
-                    output_count += process_document(sentences, stats, options)
+                    output_count += process_document(sentences, stats, options,
+                                                     rejected_out, out)
                     total_count += 1
                 sentences = []
                 if options.limit is not None and total_count >= options.limit:
@@ -217,14 +409,24 @@ def process(fn, options):
             if ln % 10000 == 0:
                 print('processed {} ...'.format(ln), file=sys.stderr)
         if sentences:
-            output_count += process_document(sentences, stats, options)
+            output_count += process_document(sentences, stats, options,
+                                             rejected_out, out)
             total_count += 1
     stats['total-docs'] = total_count
     stats['output-docs'] = output_count
-    report_stats(os.path.basename(fn), stats)
+    report_stats(name or os.path.basename(fn), stats)
     return stats
 
 
+def update_metrics(stats):
+    # Record stats from process() with stagemetrics. Not done in
+    # process() as the counts of worker processes would be lost.
+    counts = stats.copy()
+    stagemetrics.count('documents-in', counts.pop('total-docs'))
+    stagemetrics.count('documents-out', counts.pop('output-docs'))
+    stagemetrics.update(counts)    # pass and fail counts
+
+
 def get_letters(unicode_ranges, include_a_to_z=True):
     # Return list of characters in given unicode ranges with the
     # letter (L) Unicode category.
@@ -239,7 +441,7 @@ def get_letters(unicode_ranges, include_a_to_z=True):
 
 
 def compile_regular_expressions(options):
-    global WORD_RE, FOREIGN_LETTER
+    global WORD_RE, FOREIGN_LETTER, ALPHABET
 
     if options.language not in ('ja', 'ko'):
         # Require two characters per word for most languages
@@ -281,28 +483,118 @@ def compile_regular_expressions(options):
     # Unicode letter that is not part of the alphabet
     # (https://stackoverflow.com/a/6314634)
     FOREIGN_LETTER = re.compile(r'[^\W\d_'+alpha+upper+r']')
+    ALPHABET = frozenset(alpha+upper)
+    CHAR_CLASSES.clear()
 
 
-def main(argv):
-    args = argparser().parse_args(argv[1:])
-    if args.langdetect in NO_LANGDETECT_LANGUAGES:
+def setup_filter(options):
+    if options.langdetect in NO_LANGDETECT_LANGUAGES:
         print('NOTE: langdetect disabled for {} due to high error rate'.format(
-            args.langdetect), file=sys.stderr)
-        args.langdetect = None
-
-    compile_regular_expressions(args)
+            options.langdetect), file=sys.stderr)
+        options.langdetect = None
+
+    compile_regular_expressions(options)
+    compile_checks(options)
+
+
+def init_worker(options):
+    global WORKER_OPTIONS
+    setup_filter(options)
+    if options.langdetect is not None and detect is not None:
+        init_factory()    # load language profiles once per worker
+    WORKER_OPTIONS = options
+
+
+def filter_file(job):
+    # Filter file into outpath (and rejected documents into
+    # rejected_path unless None) atomically; returns name and stats
+    fn, name, outpath, rejected_path = job
+    options = WORKER_OPTIONS
+    os.makedirs(os.path.dirname(outpath), exist_ok=True)
+    tmppath = outpath + '.tmp'
+    rejected_out = None
+    if rejected_path is not None:
+        os.makedirs(os.path.dirname(rejected_path), exist_ok=True)
+        rejected_out = open(rejected_path + '.tmp', 'w')
+    try:
+        with corpusio.options_output(tmppath, options) as out:
+            stats = process(fn, options, rejected_out, out, name)
+    finally:
+        if rejected_out is not None:
+            rejected_out.close()
+    if rejected_path is not None:
+        os.replace(rejected_path + '.tmp', rejected_path)
+    os.replace(tmppath, outpath)
+    return name, stats
+
+
+def filter_files(jobs, options):
+    # Yield results of filter_file() for jobs as they complete
+    if options.jobs > 1 and len(jobs) > 1:
+        with Pool(min(options.jobs, len(jobs)), init_worker,
+                  (options,)) as pool:
+            yield from pool.imap_unordered(filter_file, jobs)
+    else:
+        init_worker(options)
+        yield from map(filter_file, jobs)
+
+
+def filter_to_directory(options):
+    # Filter files into options.output_dir with the naming of
+    # pipeline/500-filter-docs.sh, skipping existing outputs
+    jobs = []
+    for fn, name in corpusio.list_files(options.file):
+        if fn.endswith('.tmp'):
+            continue
+        reldir = os.path.dirname(name)
+        outbase = os.path.basename(name).split('.', 1)[0]
+        outpath = os.path.join(options.output_dir, reldir, outbase)
+        if os.path.isfile(outpath) and os.path.getsize(outpath) > 0:
+            print('{} exists, skipping {}'.format(outpath, fn),
+                  file=sys.stderr)
+            stagemetrics.count('files-skipped')
+            continue
+        rejected_path = None
+        if options.rejected is not None:
+            rejected_path = os.path.join(options.rejected, reldir, outbase)
+        jobs.append((fn, name, outpath, rejected_path))
+    print('filtering {} files into {} ...'.format(
+        len(jobs), options.output_dir), file=sys.stderr)
     totals = Counter()
-    for fn in args.file:
-        print('processing {} ...'.format(os.path.basename(fn)),
-              file=sys.stderr)
-        stats = process(fn, args)
+    for name, stats in filter_files(jobs, options):
+        update_metrics(stats)
         totals.update(stats)
-        print('completed {}.'.format(os.path.basename(fn)),
-              file=sys.stderr)
+        print('completed {}.'.format(name), file=sys.stderr)
+    if totals['total-docs']:
+        report_stats('TOTAL', totals)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    if args.output_dir is not None:
+        filter_to_directory(args)
+        return 0
+    setup_filter(args)
+    if args.rejected is None:
+        rejected_out = None
+    else:
+        rejected_out = open(args.rejected, 'w')
+    totals = Counter()
+    with corpusio.compressed_stdout(args):
+        for fn in args.file:
+            print('processing {} ...'.format(os.path.basename(fn)),
+                  file=sys.stderr)
+            stats = process(fn, args, rejected_out)
+            update_metrics(stats)
+            totals.update(stats)
+            print('completed {}.'.format(os.path.basename(fn)),
+                  file=sys.stderr)
+    if rejected_out is not None:
+        rejected_out.close()
     if len(args.file) > 1:
         report_stats('TOTAL', totals)
     return 0
 
 
 if __name__ == '__main__':
-    sys.exit(main(sys.argv))
+    sys.exit(stagemetrics.run_main(main, sys.argv))
@@ -1,43 +1,46 @@
 #!/usr/bin/env python3
 
+# Get lowercased alphabetic characters in text with their frequencies.
+
 import sys
-import re
 
 from collections import Counter
 
+from charhist import add_histogram_arguments, get_histogram
+import stagemetrics
+
 
 def argparser():
     from argparse import ArgumentParser
     ap = ArgumentParser()
     ap.add_argument('-t', '--threshold', type=float, default=0.0001,
                     help='Relative frequency cutoff')
-    ap.add_argument('file', nargs='+')
+    add_histogram_arguments(ap)
     return ap
 
 
-def count_alpha(fn, options):
+def count_alpha(histogram):
     counts = Counter()
-    with open(fn) as f:
-        for ln, l in enumerate(f, start=1):
-            l = l.rstrip()
-            for c in l.lower():
-                if c.isalpha():
-                    counts[c] += 1
+    for c, count in histogram.lowercased().items():
+        if c.isalpha():
+            counts[c] = count
     return counts
 
 
 def main(argv):
     args = argparser().parse_args(argv[1:])
-    totals = Counter()
-    for fn in args.file:
-        counts = count_alpha(fn, args)
-        totals.update(counts)
+    try:
+        histogram = get_histogram(args)
+    except ValueError as e:
+        print('error: {}'.format(e), file=sys.stderr)
+        return 1
+    totals = count_alpha(histogram)
     total = sum(totals.values())
-    for k, v in sorted(totals.items(), key=lambda i: i[1], reverse=True):
+    for k, v in sorted(totals.items(), key=lambda i: (-i[1], i[0])):
         print('{}\t{}\t{}\t({:.4%})'.format(
             v/total > args.threshold, k, v, v/total))
     return 0
 
 
 if __name__ == '__main__':
-    sys.exit(main(sys.argv))
+    sys.exit(stagemetrics.run_main(main, sys.argv))
@@ -7,6 +7,9 @@ import re
 
 from collections import Counter
 
+from charhist import add_histogram_arguments, get_histogram
+import stagemetrics
+
 
 def argparser():
     from argparse import ArgumentParser
@@ -15,7 +18,7 @@ def argparser():
                     help='ignore given characters')
     ap.add_argument('--lower', default=False, action='store_true',
                     help='lowercase input')
-    ap.add_argument('file', nargs='+')
+    add_histogram_arguments(ap)
     return ap
 
 
@@ -23,19 +26,23 @@ def main(argv):
     args = argparser().parse_args(argv[1:])
     ignore = '' if args.ignore is None else args.ignore
     letter_re = re.compile(r'[^\W\d_'+ignore+r']')
-    counts = Counter()
-    for fn in args.file:
-        with open(fn) as f:
-            for ln, l in enumerate(f, start=1):
-                l = l.rstrip('\n')
-                if args.lower:
-                    l = l.lower()
-                counts.update(letter_re.findall(l))
+    try:
+        histogram = get_histogram(args)
+    except ValueError as e:
+        print('error: {}'.format(e), file=sys.stderr)
+        return 1
+    if args.lower:
+        chars = histogram.lowercased()
+    else:
+        chars = histogram.counts
+    counts = Counter({
+        c: count for c, count in chars.items() if letter_re.fullmatch(c)
+    })
     total = sum(counts.values())
-    for k, v in sorted(counts.items(), key=lambda i: -i[1]):
+    for k, v in sorted(counts.items(), key=lambda i: (-i[1], i[0])):
         print('{}\t{}\t({:.2%})'.format(v, k, v/total))
     return 0
 
 
 if __name__ == '__main__':
-    sys.exit(main(sys.argv))
+    sys.exit(stagemetrics.run_main(main, sys.argv))
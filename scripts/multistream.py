@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+
+# Extract texts from a multistream Wikipedia dump in parallel.
+#
+# A multistream dump (pages-articles-multistream.xml.bz2) is a
+# concatenation of independent bzip2 streams: the first holds the
+# <siteinfo> header, each following one up to 100 <page> elements, and
+# the last the closing </mediawiki> tag. The accompanying index
+# (pages-articles-multistream-index.txt.bz2) has "offset:id:title"
+# lines giving the byte offset of the stream containing each page.
+#
+# The streams are grouped into shards that are decompressed and passed
+# to WikiExtractor in parallel worker processes, each shard as a small
+# dump with the header and footer of the full one. As WikiExtractor
+# expands templates defined anywhere in the dump, the Template and
+# Module namespace pages of the full dump are first collected (from
+# the streams the index lists them in) into a templates file given to
+# WikiExtractor for every shard. The output of each shard is moved into
+# place in OUTPUT/NNNNN/ only when complete, so later stages never see
+# partial shards and an interrupted run resumes from the shards that
+# are missing. The "check" subcommand compares the sharded extraction
+# of the first streams of a dump to a serial WikiExtractor run.
+
+import sys
+import os
+import re
+import bz2
+import shutil
+import tempfile
+import subprocess
+
+from multiprocessing import Pool
+from xml.sax.saxutils import unescape
+
+import corpusio
+import stagemetrics
+
+
+# Number of pages per stream in created multistream dumps
+PAGES_PER_STREAM = 100
+
+# Footer closing the dump for each shard
+FOOTER = b'</mediawiki>\n'
+
+# Output shard directory name for shard number
+SHARD_NAME = '{:05d}'
+
+# Keys of the Template and Module namespaces, whose pages WikiExtractor
+# collects for template expansion
+TEMPLATE_NAMESPACES = (10, 828)
+
+# WikiExtractor options disabling template expansion
+NO_TEMPLATES_OPTIONS = ('--no_templates', '--no-templates')
+
+NAMESPACE_RE = re.compile(
+    rb'<namespace key="(-?\d+)"[^>]*>([^<]*)</namespace>')
+
+PAGE_RE = re.compile(rb'[ \t]*<page>.*?</page>\n?', re.S)
+
+TITLE_RE = re.compile(rb'<title>(.*?)</title>')
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Process multistream Wikipedia dumps.')
+    sub = ap.add_subparsers(dest='command')
+    sub.required = True
+    extract = sub.add_parser('extract', help='Extract texts with ' +
+                             'WikiExtractor, shards in parallel')
+    extract.add_argument('-j', '--jobs', metavar='N', default=os.cpu_count(),
+                         type=int, help='Number of worker processes')
+    extract.add_argument('-s', '--streams-per-shard', metavar='N',
+                         default=100, type=int,
+                         help='Number of streams per shard (default 100)')
+    extract.add_argument('-w', '--wikiextractor', metavar='PATH',
+                         required=True, help='Path to WikiExtractor.py')
+    extract.add_argument('-p', '--params', metavar='ARGS', default='',
+                         help='Arguments for WikiExtractor.py')
+    extract.add_argument('-t', '--templates', metavar='FILE', default=None,
+                         help='Templates file, created if missing ' +
+                         '(default OUTPUT.templates)')
+    extract.add_argument('dump', help='Multistream dump')
+    extract.add_argument('index', help='Multistream index')
+    extract.add_argument('output', help='Output directory')
+    check = sub.add_parser('check', help='Compare extraction of the ' +
+                           'first streams in shards to a serial ' +
+                           'WikiExtractor run')
+    check.add_argument('-j', '--jobs', metavar='N', default=os.cpu_count(),
+                       type=int, help='Number of worker processes')
+    check.add_argument('-n', '--streams', metavar='N', default=100, type=int,
+                       help='Number of streams to extract (default 100)')
+    check.add_argument('-s', '--streams-per-shard', metavar='N', default=10,
+                       type=int, help='Number of streams per shard ' +
+                       '(default 10)')
+    check.add_argument('-w', '--wikiextractor', metavar='PATH',
+                       required=True, help='Path to WikiExtractor.py')
+    check.add_argument('-p', '--params', metavar='ARGS', default='',
+                       help='Arguments for WikiExtractor.py')
+    check.add_argument('dump', help='Multistream dump')
+    check.add_argument('index', help='Multistream index')
+    create = sub.add_parser('create', help='Create multistream dump and ' +
+                            'index from a regular dump')
+    create.add_argument('-n', '--pages', metavar='N',
+                        default=PAGES_PER_STREAM, type=int,
+                        help='Pages per stream (default {})'.format(
+                            PAGES_PER_STREAM))
+    create.add_argument('input', help='Dump (possibly compressed)')
+    create.add_argument('dump', help='Output multistream dump')
+    create.add_argument('index', help='Output multistream index')
+    return ap
+
+
+def read_stream_offsets(index_path):
+    # Return sorted unique stream offsets from multistream index
+    offsets = set()
+    with corpusio.open_text(index_path, encoding='utf-8') as f:
+        for ln, l in enumerate(f, start=1):
+            if not l.strip():
+                continue
+            try:
+                offsets.add(int(l.split(':', 1)[0]))
+            except ValueError:
+                raise ValueError('Failed to parse line {} in {}: {}'.format(
+                    ln, index_path, l.rstrip()))
+    return sorted(offsets)
+
+
+def read_header(dump_path, end):
+    # Return the dump header up to and including </siteinfo> from the
+    # first stream (bytes 0..end)
+    with open(dump_path, 'rb') as f:
+        data = bz2.decompress(f.read(end))
+    close = data.find(b'</siteinfo>')
+    if close < 0:
+        raise ValueError('no <siteinfo> in first stream of {}'.format(
+            dump_path))
+    return data[:close+len(b'</siteinfo>')] + b'\n'
+
+
+def stream_ranges(offsets, size):
+    # Return (start, end) byte ranges of streams. The last stream also
+    # holds the footer, as its end is not indexed.
+    return list(zip(offsets, offsets[1:] + [size]))
+
+
+def shard_ranges(streams, streams_per_shard):
+    # Return lists of (start, end) stream byte ranges for each shard
+    return [streams[i:i+streams_per_shard]
+            for i in range(0, len(streams), streams_per_shard)]
+
+
+def write_shard_dump(dump_path, header, streams, out):
+    # Write a dump with the pages in the given streams to out
+    out.write(header)
+    with open(dump_path, 'rb') as f:
+        for start, end in streams:
+            f.seek(start)
+            data = bz2.decompress(f.read(end-start))
+            close = data.rfind(b'</page>')
+            if close < 0:
+                continue    # no pages (e.g. footer only)
+            out.write(data[:close+len(b'</page>')])
+            out.write(b'\n')
+    out.write(FOOTER)
+
+
+def template_prefixes(header):
+    # Return the title prefixes (as in the dump XML) of the namespaces
+    # in TEMPLATE_NAMESPACES from the dump header
+    return tuple(name + b':' for key, name in NAMESPACE_RE.findall(header)
+                 if int(key) in TEMPLATE_NAMESPACES)
+
+
+def template_streams(index_path, prefixes):
+    # Return the set of offsets of streams with pages whose titles
+    # start with prefixes according to the multistream index
+    prefixes = tuple(unescape(p.decode('utf-8')) for p in prefixes)
+    offsets = set()
+    with corpusio.open_text(index_path, encoding='utf-8') as f:
+        for l in f:
+            fields = l.rstrip('\n').split(':', 2)
+            if len(fields) == 3 and fields[2].startswith(prefixes):
+                offsets.add(int(fields[0]))
+    return offsets
+
+
+def read_template_pages(job):
+    # Return the XML of the pages in stream (start, end) whose titles
+    # start with prefixes
+    dump_path, start, end, prefixes = job
+    with open(dump_path, 'rb') as f:
+        f.seek(start)
+        data = bz2.decompress(f.read(end-start))
+    pages = []
+    for m in PAGE_RE.finditer(data):
+        title = TITLE_RE.search(m.group())
+        if title is not None and title.group(1).startswith(prefixes):
+            pages.append(m.group())
+    return b''.join(pages)
+
+
+def collect_templates(dump_path, index_path, header, streams, path, pool):
+    # Write the Template and Module pages in streams to path in dump
+    # order, in the format WikiExtractor reads with --templates.
+    # Returns the number of streams with templates.
+    prefixes = template_prefixes(header)
+    if not prefixes:
+        raise ValueError('no template namespace in header of {}'.format(
+            dump_path))
+    offsets = template_streams(index_path, prefixes)
+    jobs = [(dump_path, start, end, prefixes) for start, end in streams
+            if start in offsets]
+    tmppath = path + '.tmp'
+    with open(tmppath, 'wb') as out:
+        for data in pool.imap(read_template_pages, jobs):
+            out.write(data)
+    os.replace(tmppath, path)
+    return len(jobs)
+
+
+def wikiextractor_command(options, templates=None):
+    # Return command for running WikiExtractor on a shard
+    command = (['python3', options.wikiextractor] + options.params.split() +
+               ['--processes', '1'])
+    if templates is not None:
+        command += ['--templates', templates]
+    return command
+
+
+def expands_templates(options):
+    return not any(o in options.params.split() for o in NO_TEMPLATES_OPTIONS)
+
+
+def extract_shard(job):
+    # Extract shard with WikiExtractor into output/NAME, returning the
+    # shard number and number of streams, or None for done shards.
+    number, streams, dump_path, header, output, command = job
+    name = SHARD_NAME.format(number)
+    final = os.path.join(output, name)
+    if os.path.isdir(final):
+        return None
+    # Work in a sibling directory of output so that partial shards are
+    # never seen in it
+    tmpdir = os.path.join(output + '.tmp', name)
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+    xmlpath = os.path.join(tmpdir, 'dump.xml')
+    with open(xmlpath, 'wb') as out:
+        write_shard_dump(dump_path, header, streams, out)
+    textdir = os.path.join(tmpdir, 'text')
+    process = subprocess.run(
+        command + ['--output', textdir, xmlpath],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise ValueError('WikiExtractor failed for shard {}: {}'.format(
+            name, process.stderr.decode('utf-8', 'replace').strip()))
+    os.makedirs(textdir, exist_ok=True)    # no texts in shard
+    os.replace(textdir, final)
+    shutil.rmtree(tmpdir)
+    return number, len(streams)
+
+
+def read_streams(options):
+    # Return header and stream (start, end) ranges of dump
+    offsets = read_stream_offsets(options.index)
+    if not offsets:
+        raise ValueError('no streams in {}'.format(options.index))
+    header = read_header(options.dump, offsets[0])
+    size = os.path.getsize(options.dump)
+    return header, stream_ranges(offsets, size)
+
+
+def extract_streams(options, header, streams, output, templates, pool):
+    # Extract streams of dump into shards in output, collecting
+    # templates into the file templates first unless it exists
+    # (or is None for no template expansion)
+    if templates is not None and not os.path.exists(templates):
+        print('collecting templates from {} into {}'.format(
+            options.dump, templates), file=sys.stderr)
+        count = collect_templates(options.dump, options.index, header,
+                                  streams, templates, pool)
+        stagemetrics.count('template-streams', count)
+    shards = shard_ranges(streams, options.streams_per_shard)
+    command = wikiextractor_command(options, templates)
+    os.makedirs(output, exist_ok=True)
+    jobs = [(i, s, options.dump, header, output, command)
+            for i, s in enumerate(shards)]
+    print('extracting {} streams in {} shards from {}'.format(
+        len(streams), len(shards), options.dump), file=sys.stderr)
+    extracted = 0
+    for result in pool.imap_unordered(extract_shard, jobs):
+        if result is None:
+            stagemetrics.count('shards-skipped')
+            continue
+        number, count = result
+        extracted += 1
+        stagemetrics.count('shards')
+        stagemetrics.count('streams', count)
+        print('extracted shard {} ({}/{})'.format(
+            SHARD_NAME.format(number), extracted, len(jobs)),
+              file=sys.stderr)
+    shutil.rmtree(output + '.tmp', ignore_errors=True)
+
+
+def extract(options):
+    header, streams = read_streams(options)
+    templates = None
+    if expands_templates(options):
+        templates = options.templates or options.output + '.templates'
+    with Pool(max(1, options.jobs)) as pool:
+        extract_streams(options, header, streams, options.output, templates,
+                        pool)
+
+
+def read_extracted(directory):
+    # Return lines of the WikiExtractor output files in directory in
+    # order (shards and files in name order)
+    lines = []
+    for root, dirs, fns in sorted(os.walk(directory)):
+        dirs.sort()
+        for fn in sorted(fns):
+            with corpusio.open_text(os.path.join(root, fn)) as f:
+                lines.extend(f)
+    return lines
+
+
+def check(options):
+    # Extract the first streams of the dump serially and in shards
+    # and compare the output, returning True if identical
+    header, streams = read_streams(options)
+    streams = streams[:options.streams]
+    workdir = tempfile.mkdtemp(prefix='multistream-')
+    try:
+        xmlpath = os.path.join(workdir, 'dump.xml')
+        with open(xmlpath, 'wb') as out:
+            write_shard_dump(options.dump, header, streams, out)
+        serial = os.path.join(workdir, 'serial')
+        command = ['python3', options.wikiextractor] + options.params.split()
+        process = subprocess.run(command + ['--output', serial, xmlpath],
+                                 stdout=subprocess.DEVNULL)
+        if process.returncode != 0:
+            raise ValueError('serial WikiExtractor run failed')
+        sharded = os.path.join(workdir, 'sharded')
+        templates = None
+        if expands_templates(options):
+            templates = os.path.join(workdir, 'templates')
+        with Pool(max(1, options.jobs)) as pool:
+            extract_streams(options, header, streams, sharded, templates,
+                            pool)
+        expected, got = read_extracted(serial), read_extracted(sharded)
+    finally:
+        shutil.rmtree(workdir)
+    for ln, (e, g) in enumerate(zip(expected, got), start=1):
+        if e != g:
+            print('line {} differs:\n  serial:  {}  sharded: {}'.format(
+                ln, e, g), file=sys.stderr, end='')
+            return False
+    if len(expected) != len(got):
+        print('serial output has {} lines, sharded {}'.format(
+            len(expected), len(got)), file=sys.stderr)
+        return False
+    print('{} streams: sharded output matches serial ({} lines)'.format(
+        len(streams), len(expected)), file=sys.stderr)
+    return True
+
+
+def page_info(lines):
+    # Return (id, title) of page from its XML lines
+    text = b''.join(lines).decode('utf-8')
+    title = re.search(r'<title>(.*?)</title>', text)
+    page_id = re.search(r'<id>(\d+)</id>', text)
+    return (page_id.group(1) if page_id else '',
+            unescape(title.group(1)) if title else '')
+
+
+def create(options):
+    # Write input dump as a multistream dump with index
+    with corpusio.open_binary(options.input) as f, \
+         open(options.dump, 'wb') as dump, \
+         bz2.open(options.index, 'wt', encoding='utf-8') as index:
+
+        def write_stream(pages):
+            offset = dump.tell()
+            dump.write(bz2.compress(b''.join(l for p in pages for l in p)))
+            for lines in pages:
+                index.write('{}:{}:{}\n'.format(offset, *page_info(lines)))
+
+        header, pages, page = [], [], None
+        for l in f:
+            if page is None and b'<page>' in l:
+                if header is not None:
+                    dump.write(bz2.compress(b''.join(header)))
+                    header = None
+                page = []
+            if page is None:
+                if header is not None:
+                    header.append(l)
+                continue
+            page.append(l)
+            if b'</page>' in l:
+                pages.append(page)
+                page = None
+                if len(pages) >= options.pages:
+                    write_stream(pages)
+                    pages = []
+        if pages:
+            write_stream(pages)
+        dump.write(bz2.compress(FOOTER))
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    try:
+        if args.command == 'extract':
+            extract(args)
+        elif args.command == 'check':
+            if not check(args):
+                return 1
+        else:
+            create(args)
+    except ValueError as e:
+        print('error: {}'.format(e), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(stagemetrics.run_main(main, sys.argv))
@@ -4,46 +4,248 @@
 # kenln language model
 
 import sys
-import gzip
+import os
+import sqlite3
+import hashlib
+
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
 
 import kenlm
 
+import corpusio
+import stagemetrics
+
+from ppfilter import ScoreWriter
+
 
 def argparser():
     from argparse import ArgumentParser
     ap = ArgumentParser()
+    ap.add_argument('--batch-size', metavar='N', default=10000, type=int,
+                    help='Number of lines per scoring batch')
+    ap.add_argument('--cache', metavar='FILE', default=None,
+                    help='Cache sentence perplexities in SQLite FILE')
     ap.add_argument('--encoding', default='utf-8')
+    ap.add_argument('--jobs', metavar='N', default=1, type=int,
+                    help='Number of scoring processes (default 1)')
+    ap.add_argument('--no-output', default=False, action='store_true',
+                    help='Do not output scored text (with --save-scores)')
+    ap.add_argument('--save-scores', default=False, action='store_true',
+                    help='Save binary sentence scores for FILE to ' +
+                    'FILE.ppl for ppfilter.py --binary')
     ap.add_argument('model')
     ap.add_argument('file', nargs='+')
     return ap
 
 
-def process_stream(f, fn, model, options):
-    for ln, l in enumerate(f, start=1):
-        l = l.rstrip('\n')
-        if l.isspace() or not l:
-            print()
+# Model for scoring in worker processes (or the main process)
+WORKER_MODEL = None
+
+
+def init_worker(model_path):
+    global WORKER_MODEL
+    WORKER_MODEL = kenlm.Model(model_path)
+
+
+def score_sentences(sentences):
+    return [WORKER_MODEL.perplexity(s) for s in sentences]
+
+
+def model_identity(model_path):
+    # Identify model by name, size and modification time (hashing the
+    # content of large models would take longer than scoring).
+    st = os.stat(model_path)
+    return '{}\t{}\t{}'.format(
+        os.path.basename(model_path), st.st_size, st.st_mtime_ns)
+
+
+def sentence_key(sentence):
+    return hashlib.blake2b(sentence.encode('utf-8'), digest_size=16).digest()
+
+
+class ScoreCache(object):
+    """SQLite cache of sentence perplexities keyed by sentence hash."""
+
+    # Maximum number of keys per lookup query
+    MAX_LOOKUP = 500
+
+    def __init__(self, path, model_path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS meta '
+            '(key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS scores '
+            '(key BLOB PRIMARY KEY, perplexity REAL) WITHOUT ROWID')
+        identity = model_identity(model_path)
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'model'").fetchone()
+        if row is None:
+            self.connection.execute(
+                "INSERT INTO meta VALUES ('model', ?)", (identity,))
+            self.connection.commit()
+        elif row[0] != identity:
+            raise ValueError('cache {} was created for model {}, '
+                             'not {}'.format(path, row[0], identity))
+        self.hits, self.misses = 0, 0
+
+    def lookup(self, keys):
+        # Return dict mapping keys found in cache to perplexities
+        found = {}
+        keys = list(set(keys))
+        for i in range(0, len(keys), self.MAX_LOOKUP):
+            chunk = keys[i:i+self.MAX_LOOKUP]
+            found.update(self.connection.execute(
+                'SELECT key, perplexity FROM scores WHERE key IN ({})'.format(
+                    ','.join('?' * len(chunk))), chunk))
+        return found
+
+    def store(self, items):
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO scores VALUES (?, ?)', items)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def read_batches(fn, options):
+    # Yield lists of lines (without newlines) from file
+    with corpusio.open_text(fn, encoding=options.encoding) as f:
+        lines = (l.rstrip('\n') for l in f)
+        while True:
+            batch = list(islice(lines, options.batch_size))
+            if not batch:
+                break
+            yield batch
+
+
+class BatchScorer(object):
+    """Score batches of lines in order, using cache and worker pool
+    when available."""
+
+    def __init__(self, options):
+        if options.cache is None:
+            self.cache = None
+        else:
+            self.cache = ScoreCache(options.cache, options.model)
+        self.pool = None
+        if options.jobs > 1:
+            self.pool = Pool(options.jobs, init_worker, (options.model,))
+        else:
+            init_worker(options.model)
+        self.pending = deque()
+        self.max_pending = max(1, options.jobs) * 4
+
+    def submit(self, fn, lines):
+        # Queue batch, yielding (file, line, perplexity) for completed
+        # batches with None perplexity for blank lines.
+        sentences = [l for l in lines if l and not l.isspace()]
+        if self.cache is not None:
+            keys = [sentence_key(s) for s in sentences]
+            cached = self.cache.lookup(keys)
+            to_score = list({
+                k: s for k, s in zip(keys, sentences) if k not in cached
+            }.items())
+        else:
+            keys, cached = None, {}
+            to_score = list(enumerate(sentences))
+        texts = [s for k, s in to_score]
+        if self.pool is not None:
+            result = self.pool.apply_async(score_sentences, (texts,))
         else:
-            print('{}\t{}'.format(model.perplexity(l), l))
+            result = score_sentences(texts)
+        self.pending.append((fn, lines, keys, cached, to_score, result))
+        while len(self.pending) > self.max_pending:
+            yield from self.complete()
 
+    def complete(self):
+        fn, lines, keys, cached, to_score, result = self.pending.popleft()
+        if self.pool is not None:
+            result = result.get()
+        if self.cache is not None:
+            scores = dict(zip((k for k, s in to_score), result))
+            self.cache.store(list(scores.items()))
+            self.cache.hits += len(keys) - len(to_score)
+            self.cache.misses += len(to_score)
+            scores.update(cached)
+            sentence_scores = iter([scores[k] for k in keys])
+        else:
+            sentence_scores = iter(result)
+        stagemetrics.count('lines-in', len(lines))
+        for l in lines:
+            if l.isspace() or not l:
+                yield fn, l, None
+            else:
+                yield fn, l, next(sentence_scores)
+
+    def flush(self):
+        while self.pending:
+            yield from self.complete()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        if self.cache is not None:
+            stagemetrics.count('cache-hits', self.cache.hits)
+            stagemetrics.count('cache-misses', self.cache.misses)
+            print('perplexity.py: cache hits {}, misses {}'.format(
+                self.cache.hits, self.cache.misses), file=sys.stderr)
+            self.cache.close()
+
+
+class ScoredOutput(object):
+    """Output scored lines as text and/or binary scores per file."""
 
-def process(fn, model, options):
-    if fn.endswith('.gz'):
-        with gzip.open(fn, mode='rt', encoding=options.encoding) as f:
-            process_stream(f, fn, model, options)
-    else:
-        with open(fn) as f:
-            process_stream(f, fn, model, options)
+    def __init__(self, options):
+        self.options = options
+        self.writer = None
+        self.saved = set()
+
+    def write(self, scored):
+        for fn, l, perplexity in scored:
+            if self.options.save_scores and (
+                    self.writer is None or self.writer.fn != fn):
+                self.close()
+                self.writer = ScoreWriter(fn)
+                self.saved.add(fn)
+            if perplexity is None:
+                if not self.options.no_output:
+                    print()
+                continue
+            if self.writer is not None:
+                self.writer.add(perplexity, len(l.split()))
+            if not self.options.no_output:
+                print('{}\t{}'.format(perplexity, l))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
 
 
 def main(argv):
     args = argparser().parse_args(argv[1:])
-    model = kenlm.Model(args.model)
+    try:
+        scorer = BatchScorer(args)
+    except ValueError as e:
+        print('error: {}'.format(e), file=sys.stderr)
+        return 1
+    output = ScoredOutput(args)
     for fn in args.file:
-        process(fn, model, args)
-        return 0
+        for batch in read_batches(fn, args):
+            output.write(scorer.submit(fn, batch))
+    output.write(scorer.flush())
+    output.close()
+    if args.save_scores:
+        for fn in set(args.file) - output.saved:
+            ScoreWriter(fn).close()    # no lines
+    scorer.close()
+    return 0
 
-    
-if __name__ == '__main__':
-    sys.exit(main(sys.argv))
 
+if __name__ == '__main__':
+    sys.exit(stagemetrics.run_main(main, sys.argv))
@@ -1,18 +1,75 @@
 #!/usr/bin/env python3
 
+# Filter documents by average sentence perplexity after trimming
+# high-perplexity and short sentences from document starts and ends.
+#
+# Input is either perplexity.py text output or, with --binary, text
+# files with a document index (docindex.py) and binary sentence scores
+# (perplexity.py --save-scores). In binary mode several thresholds can
+# be evaluated in one pass, reporting what each setting keeps.
+
+import os
 import sys
 
+import numpy as np
+
+import corpusio
+import stagemetrics
+
+from docindex import load_index
+
+
+# Suffix of binary sentence score file for text file
+SCORE_SUFFIX = '.ppl'
+
+# Perplexity and number of tokens for each sentence
+SCORE_DTYPE = np.dtype([('perplexity', '<f4'), ('tokens', '<u4')])
+
 
 def argparser():
     from argparse import ArgumentParser
     ap = ArgumentParser()
+    ap.add_argument('--binary', default=False, action='store_true',
+                    help='Read scores from FILE.ppl and documents ' +
+                    'using FILE.idx')
     ap.add_argument('--min-tokens', default=None, type=int)
-    ap.add_argument('--trim-threshold', default=None, type=float)
-    ap.add_argument('--threshold', default=10000, type=float)
+    ap.add_argument('--trim-threshold', default=None, type=float,
+                    action='append', help='Trim threshold; repeat to ' +
+                    'evaluate several (requires --binary, only reports)')
+    ap.add_argument('--threshold', default=None, type=float,
+                    action='append', help='Threshold (default 10000); ' +
+                    'repeat to evaluate several (requires --binary, ' +
+                    'only reports)')
+    corpusio.add_output_arguments(ap)
     ap.add_argument('file', nargs='+')
     return ap
 
 
+class ScoreWriter(object):
+    """Write binary sentence scores for a text file."""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.path = fn + SCORE_SUFFIX
+        self.tmppath = self.path + '.tmp'
+        self.out = open(self.tmppath, 'wb')
+        self.scores = []
+
+    def add(self, perplexity, tokens):
+        self.scores.append((perplexity, tokens))
+        if len(self.scores) >= 100000:
+            self.flush()
+
+    def flush(self):
+        np.array(self.scores, dtype=SCORE_DTYPE).tofile(self.out)
+        self.scores = []
+
+    def close(self):
+        self.flush()
+        self.out.close()
+        os.replace(self.tmppath, self.path)
+
+
 def trim_document(perplexities, sentences, lengths, options):
     assert len(perplexities) == len(sentences)
 
@@ -68,7 +125,7 @@ def process_document(perplexities, sentences, options):
 def process_file(fn, options):
     perplexities, sentences = [], []
     output, total = 0, 0
-    with open(fn) as f:
+    with corpusio.open_text(fn) as f:
         for ln, l in enumerate(f, start=1):
             l = l.rstrip('\n')
             if l.isspace() or not l:
@@ -84,16 +141,143 @@ def process_file(fn, options):
                     ln, fn, l))
             perplexities.append(perplexity)
             sentences.append(sentence)
+    stagemetrics.count('documents-in', total)
+    stagemetrics.count('documents-out', output)
     print('Output {}/{} ({:.1%}) for {}'.format(
         output, total, output/total, fn), file=sys.stderr)
 
 
+def load_scores(fn):
+    # Return document index and sentence scores for text file fn
+    index = load_index(fn)
+    if index is None:
+        raise ValueError('missing or outdated index for {}'.format(fn))
+    scores = np.fromfile(fn + SCORE_SUFFIX, dtype=SCORE_DTYPE)
+    if len(scores) != index.total_sentences():
+        index.close()
+        raise ValueError('{} sentence scores for {} sentences in {}'.format(
+            len(scores), index.total_sentences(), fn))
+    return index, scores
+
+
+def trim_documents(scores, doc_starts, trim_threshold, min_tokens):
+    # Vectorized trim_document() for all documents, returning arrays
+    # of first and last kept sentence index for each document (first >
+    # last for documents that are empty after trimming).
+    perplexities, lengths = scores['perplexity'], scores['tokens']
+    good = np.ones(len(scores), dtype=bool)
+    if trim_threshold is not None:
+        good &= perplexities <= trim_threshold
+    if min_tokens is not None:
+        good &= lengths >= min_tokens
+    positions = np.arange(len(scores))
+    first = np.minimum.reduceat(np.where(good, positions, len(scores)),
+                                doc_starts)
+    last = np.maximum.reduceat(np.where(good, positions, -1), doc_starts)
+    return first, last
+
+
+def evaluate_settings(scores, doc_starts, options):
+    # Return dict mapping (trim threshold, threshold) to (boolean array
+    # of kept documents, first and last kept sentences of documents).
+    perplexities, lengths = scores['perplexity'], scores['tokens']
+    doc_ids = np.repeat(np.arange(len(doc_starts)),
+                        np.diff(np.append(doc_starts, len(scores))))
+    positions = np.arange(len(scores))
+    results = {}
+    for trim_threshold in options.trim_threshold:
+        first, last = trim_documents(
+            scores, doc_starts, trim_threshold, options.min_tokens)
+        # average over kept span, skipping short sentences
+        counted = (positions >= first[doc_ids]) & (positions <= last[doc_ids])
+        if options.min_tokens is not None:
+            counted &= lengths >= options.min_tokens
+        sums = np.add.reduceat(
+            np.where(counted, perplexities.astype(np.float64), 0), doc_starts)
+        counts = np.add.reduceat(counted.astype(np.int64), doc_starts)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            averages = sums / counts
+        for threshold in options.threshold:
+            kept = (first <= last) & (counts > 0) & (averages <= threshold)
+            results[(trim_threshold, threshold)] = (kept, first, last)
+    return results
+
+
+def kept_tokens(scores, doc_starts, kept, first, last):
+    lengths = np.concatenate(([0], np.cumsum(scores['tokens'],
+                                             dtype=np.int64)))
+    return int(np.sum((lengths[last+1] - lengths[first])[kept]))
+
+
+def process_binary(fn, totals, options):
+    index, scores = load_scores(fn)
+    with index:
+        if len(index) == 0:
+            return
+        doc_starts = np.concatenate(([0], np.cumsum(
+            index.sentences, dtype=np.int64)[:-1]))
+        results = evaluate_settings(scores, doc_starts, options)
+        for setting, (kept, first, last) in results.items():
+            total = totals.setdefault(setting, [0, 0, 0, 0])
+            total[0] += len(index)
+            total[1] += int(np.sum(kept))
+            total[2] += int(np.sum(scores['tokens'], dtype=np.int64))
+            total[3] += kept_tokens(scores, doc_starts, kept, first, last)
+        if len(results) > 1:
+            return    # only report
+        kept, first, last = next(iter(results.values()))
+        for i, sentences in enumerate(index.read_documents()):
+            if kept[i]:
+                start = first[i] - doc_starts[i]
+                end = last[i] + 1 - doc_starts[i]
+                print('\n'.join(sentences[start:end]))
+                print()
+        output, total = int(np.sum(kept)), len(index)
+        stagemetrics.count('documents-in', total)
+        stagemetrics.count('documents-out', output)
+        print('Output {}/{} ({:.1%}) for {}'.format(
+            output, total, output/total, fn), file=sys.stderr)
+
+
+def report_settings(totals):
+    print('\t'.join(['trim-threshold', 'threshold', 'docs', 'docs-kept',
+                     'tokens', 'tokens-kept']))
+    for (trim_threshold, threshold), t in sorted(
+            totals.items(), key=lambda i: (i[0][0] is not None, i[0])):
+        print('{}\t{}\t{}\t{} ({:.1%})\t{}\t{} ({:.1%})'.format(
+            trim_threshold, threshold, t[0], t[1], t[1]/max(t[0], 1),
+            t[2], t[3], t[3]/max(t[2], 1)))
+
+
 def main(argv):
     args = argparser().parse_args(argv[1:])
-    for fn in args.file:
-        process_file(fn, args)
+    if args.threshold is None:
+        args.threshold = [10000]
+    if args.trim_threshold is None:
+        args.trim_threshold = [None]
+    multiple = len(args.threshold) > 1 or len(args.trim_threshold) > 1
+    if args.binary:
+        totals = {}
+        with corpusio.compressed_stdout(args):
+            for fn in args.file:
+                try:
+                    process_binary(fn, totals, args)
+                except ValueError as e:
+                    print('error: {}'.format(e), file=sys.stderr)
+                    return 1
+        if multiple:
+            report_settings(totals)
+        return 0
+    if multiple:
+        print('error: multiple thresholds require --binary', file=sys.stderr)
+        return 1
+    args.threshold, = args.threshold
+    args.trim_threshold, = args.trim_threshold
+    with corpusio.compressed_stdout(args):
+        for fn in args.file:
+            process_file(fn, args)
     return 0
 
 
 if __name__ == '__main__':
-    sys.exit(main(sys.argv))
+    sys.exit(stagemetrics.run_main(main, sys.argv))
@@ -0,0 +1,616 @@
+#!/usr/bin/env python3
+
+# Run the numbered pipeline stages for a language as a dependency graph.
+#
+# Stages that process files independently (tokenization, filtering,
+# document sampling and TFRecord creation) are expanded into one task
+# per file, and tasks whose dependencies are done run concurrently
+# within a worker budget.
+# The remaining stages run their pipeline/*.sh scripts as single tasks.
+# Per-file outputs are written atomically and recorded in stamp files
+# with hashes of their inputs and command, and are only recreated when
+# these change. Stages reading and writing whole directories (e.g.
+# deduplication and vocabulary creation) are stamped with the listing
+# of their inputs and outputs and a hash of their script and settings,
+# and their outputs are removed to have the script recreate them when
+# these change.
+
+import sys
+import os
+import re
+import json
+import hashlib
+import shutil
+import time
+import subprocess
+
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import stagemetrics
+import udpipeserver
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PIPELINE_DIR = os.path.join(BASE_DIR, 'pipeline')
+
+# Variables read from pipeline/common.sh
+COMMON_VARIABLES = (
+    'DATA_DIR', 'WIKI_TEXT_DIR', 'UDPIPE_MODEL_PATH', 'TOKENIZER',
+    'TOKENIZER_PARAMS', 'TOKENIZED_TEXT_DIR', 'DOC_FILTER',
+    'DOC_FILTER_PARAMS', 'DOC_FILTERED_DIR', 'SEGMENTFILTER',
+    'FUSED_TOKENIZE_FILTER', 'WORDPIECE_VOCAB_PATH', 'CREATE_TFRECORD',
+    'CREATE_TFRECORD_PARAMS', 'CREATE_TFRECORD_PARAMS_128',
+    'CREATE_TFRECORD_PARAMS_512', 'TFRECORD_DIR_128', 'TFRECORD_DIR_512',
+    'DOCINDEX', 'DEDUPED_DIR', 'CREATE_TFRECORDS', 'CREATE_TFRECORD_JOBS',
+    'WORDPIECE_ID_CACHE_DIR', 'WIKIBERT_METRICS', 'TOKENIZED_TEXT_CODEC',
+    'FILTERED_TEXT_CODEC', 'COMPRESS_THREADS', 'WIKIBERT_UDPIPE_SOCKET',
+    'DEDUP_PARAMS', 'DEDUP_REPORT_PATH', 'DEDUPED_TEXT_CODEC',
+    'VOCAB_METHOD', 'SAMPLED_TEXT_PATH', 'SAMPLED_SENTENCE_NUM',
+    'SAMPLED_SENTENCE_SEED', 'SAMPLEDOCS', 'SAMPLEDOCS_PARAMS',
+    'SAMPLED_DOC_RATIO', 'SAMPLED_DOC_CODEC', 'SAMPLED_DOC_DIR',
+    'HELD_OUT_DOC_DIR',
+    'BASICTOKENIZE_PARAMS', 'TOKENIZED_SAMPLE_PATH', 'SENTENCEPIECE_PARAMS',
+    'SENTENCEPIECE_MODEL_PATH', 'SENTENCEPIECE_VOCAB_PATH',
+    'SENT2WORDPIECE_PARAMS', 'WORDPIECEVOCAB_PARAMS', 'WORD_COUNTS_PATH',
+)
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Run pipeline stages for language.')
+    ap.add_argument('-j', '--jobs', metavar='N', default=os.cpu_count(),
+                    type=int, help='Worker budget (default CPU count)')
+    ap.add_argument('-n', '--dry-run', default=False, action='store_true',
+                    help='Only list tasks that are not up to date')
+    ap.add_argument('lang', metavar='LC', help='Two-character language code')
+    return ap
+
+
+def read_settings(lang):
+    # Source pipeline/common.sh once and return the values of
+    # COMMON_VARIABLES.
+    script = (
+        'PIPELINE_DIR="$1"; shift; source "$PIPELINE_DIR/common.sh"; ' +
+        'for v in {}; do printf "%s=%s\\0" "$v" "${{!v}}"; done'.format(
+            ' '.join(COMMON_VARIABLES))
+    )
+    output = subprocess.run(
+        ['bash', '-c', script, 'runpipeline.py', PIPELINE_DIR, lang],
+        stdout=subprocess.PIPE, check=True).stdout.decode('utf-8')
+    settings = {}
+    for item in output.split('\0'):
+        if item:
+            key, value = item.split('=', 1)
+            settings[key] = value
+    return settings
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def jobs_in_params(params):
+    # Return the value of a --jobs option in params, or 1.
+    m = re.search(r'--jobs(?:=|\s+)(\d+)', params)
+    return int(m.group(1)) if m else 1
+
+
+def list_files(directory):
+    # Return sorted paths of files under directory, skipping hidden
+    # (e.g. temporary) files and document indexes.
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        for fn in files:
+            if not fn.startswith('.') and not fn.endswith('.idx'):
+                paths.append(os.path.join(root, fn))
+    return sorted(paths)
+
+
+def path_signature(paths):
+    # Return hash of the names, sizes and mtimes of paths and of the
+    # files under those that are directories (see list_files()).
+    h = hashlib.sha1()
+    for path in paths:
+        if os.path.isdir(path):
+            files = list_files(path)
+        else:
+            files = [path] if os.path.exists(path) else []
+        h.update(json.dumps(path).encode())
+        for fn in files:
+            st = os.stat(fn)
+            h.update(json.dumps([os.path.relpath(fn, path), st.st_size,
+                                 st.st_mtime_ns]).encode())
+    return h.hexdigest()
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def output_base(path):
+    # Output basename for input path, as in pipeline/*.sh
+    return os.path.basename(path).split('.', 1)[0]
+
+
+class Task(object):
+    """Command producing one output or running one pipeline script.
+
+    If output is given, the command is run with '{output}' replaced by
+    a temporary path (or its stdout redirected there if stdout is
+    True), and the temporary file is renamed to output on success.
+    Further outputs of the same command (extra_outputs) are written
+    likewise through '{output1}', '{output2}' and so on. Tasks that
+    are not primary (e.g. index building) are not used as inputs to
+    the next per-file stage.
+    """
+
+    def __init__(self, name, command, inputs=(), output=None, stdout=False,
+                 slots=1, deps=(), primary=True, extra_outputs=()):
+        self.name = name
+        self.command = command
+        self.inputs = list(inputs)
+        self.output = output
+        self.extra_outputs = list(extra_outputs)
+        self.stdout = stdout
+        self.slots = slots
+        self.deps = list(deps)
+        self.primary = primary
+        self.stage = None    # name, set by expand_stages()
+        self.done = False
+
+    def params_hash(self):
+        return hashlib.sha1(json.dumps(self.command).encode()).hexdigest()
+
+    def stamp_path(self, stamp_dir, lang_dir):
+        relpath = os.path.relpath(self.output, lang_dir)
+        return os.path.join(stamp_dir, relpath + '.json')
+
+    def input_signature(self, previous=None):
+        # Map input paths to [size, mtime, hash], only rehashing inputs
+        # whose size or mtime differ from the previous signature.
+        previous = previous or {}
+        signature = {}
+        for path in self.inputs:
+            st = os.stat(path)
+            prev = previous.get(path)
+            if prev and prev[0] == st.st_size and prev[1] == st.st_mtime_ns:
+                signature[path] = prev
+            else:
+                signature[path] = [st.st_size, st.st_mtime_ns, file_hash(path)]
+        return signature
+
+    def is_up_to_date(self, stamp_dir, lang_dir):
+        outputs = [self.output] + self.extra_outputs
+        if self.output is None or not all(os.path.exists(p) for p in outputs):
+            return False
+        try:
+            with open(self.stamp_path(stamp_dir, lang_dir)) as f:
+                stamp = json.load(f)
+        except (OSError, ValueError):
+            return False
+        sizes = [os.path.getsize(p) for p in outputs]
+        if (stamp.get('params') != self.params_hash() or
+            stamp.get('output-size') != sizes[0] or
+            stamp.get('extra-output-sizes', []) != sizes[1:]):
+            return False
+        previous = stamp.get('inputs', {})
+        current = self.input_signature(previous)
+        return ({k: v[2] for k, v in current.items()} ==
+                {k: v[2] for k, v in previous.items()})
+
+    def write_stamp(self, stamp_dir, lang_dir):
+        path = self.stamp_path(stamp_dir, lang_dir)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        stamp = {
+            'params': self.params_hash(),
+            'inputs': self.input_signature(),
+            'output-size': os.path.getsize(self.output),
+            'extra-output-sizes': [os.path.getsize(p)
+                                   for p in self.extra_outputs],
+        }
+        with open(path, 'w') as out:
+            json.dump(stamp, out, indent=4)
+
+    def run(self, stamp_dir, lang_dir):
+        if self.output is None:
+            # pipeline script, recorded as a stage
+            status = stagemetrics.run_command(self.command, self.stage)
+            if status != 0:
+                raise subprocess.CalledProcessError(status, self.command)
+            return
+        env = dict(os.environ)
+        env[stagemetrics.STAGE_ENV] = self.stage
+        outputs = [self.output] + self.extra_outputs
+        tmppaths = []
+        for path in outputs:
+            outdir, outbase = os.path.split(path)
+            os.makedirs(outdir, exist_ok=True)
+            tmppaths.append(os.path.join(outdir, '.{}.tmp'.format(outbase)))
+        command = list(self.command)
+        for i, tmppath in enumerate(tmppaths):
+            placeholder = '{{output{}}}'.format(i or '')
+            command = [c.replace(placeholder, tmppath) for c in command]
+        try:
+            if self.stdout:
+                with open(tmppaths[0], 'w') as out:
+                    subprocess.run(command, stdout=out, env=env, check=True)
+            else:
+                subprocess.run(command, env=env, check=True)
+            for tmppath, path in zip(tmppaths, outputs):
+                os.replace(tmppath, path)
+        finally:
+            for tmppath in tmppaths:
+                if os.path.exists(tmppath):
+                    os.remove(tmppath)
+        self.write_stamp(stamp_dir, lang_dir)
+
+
+class StageTask(Task):
+    """Pipeline script reading and writing whole directories.
+
+    The stamp records signatures of the input and output paths (see
+    path_signature()) and a hash of the script and the settings it
+    depends on. As the scripts skip existing outputs, outputs are
+    removed before running the script unless the stamp is current.
+    """
+
+    def __init__(self, name, command, inputs, outputs, settings, deps=()):
+        super().__init__(name, command, inputs, deps=deps)
+        self.outputs = list(outputs)
+        self.settings = settings
+
+    def params_hash(self):
+        params = [self.command, file_hash(self.command[0]), self.settings]
+        return hashlib.sha1(json.dumps(params).encode()).hexdigest()
+
+    def stamp_path(self, stamp_dir, lang_dir):
+        return os.path.join(stamp_dir, self.stage + '.json')
+
+    def is_up_to_date(self, stamp_dir, lang_dir):
+        try:
+            with open(self.stamp_path(stamp_dir, lang_dir)) as f:
+                stamp = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return (stamp.get('params') == self.params_hash() and
+                stamp.get('inputs') == path_signature(self.inputs) and
+                stamp.get('outputs') == path_signature(self.outputs))
+
+    def write_stamp(self, stamp_dir, lang_dir):
+        path = self.stamp_path(stamp_dir, lang_dir)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        stamp = {
+            'params': self.params_hash(),
+            'inputs': path_signature(self.inputs),
+            'outputs': path_signature(self.outputs),
+        }
+        with open(path, 'w') as out:
+            json.dump(stamp, out, indent=4)
+
+    def run(self, stamp_dir, lang_dir):
+        # Remove the stamp first so that an interrupted run is not
+        # taken as done
+        stamp_path = self.stamp_path(stamp_dir, lang_dir)
+        if os.path.exists(stamp_path):
+            os.remove(stamp_path)
+        for path in self.outputs:
+            remove_path(path)
+        super().run(stamp_dir, lang_dir)
+        self.write_stamp(stamp_dir, lang_dir)
+
+
+class Stage(object):
+    """Numbered pipeline stage, expanded into tasks when possible."""
+
+    def __init__(self, script):
+        self.script = script
+        self.name = os.path.basename(script)
+        self.tasks = None    # not yet expanded
+
+    @property
+    def done(self):
+        return self.tasks is not None and all(t.done for t in self.tasks)
+
+
+class PerFileStage(Stage):
+    """Stage with one task per input file.
+
+    If the input files are the outputs of the previous per-file stage,
+    tasks map one-to-one to its tasks; otherwise the input directory is
+    listed once the previous stage is done.
+    """
+
+    def __init__(self, script, input_dir, make_tasks, chained=False):
+        super().__init__(script)
+        self.input_dir = input_dir
+        self.make_tasks = make_tasks
+        self.chained = chained
+
+
+class DirectoryStage(Stage):
+    """Stage run as a single StageTask."""
+
+    def __init__(self, script, inputs, outputs, variables):
+        super().__init__(script)
+        self.inputs = inputs
+        self.outputs = outputs
+        self.variables = variables
+
+
+def directory_stages(settings):
+    # Return Stage constructors for stages run as StageTasks, keyed by
+    # script name. Stages skipped with the current VOCAB_METHOD have
+    # no inputs or outputs.
+    s = settings
+    wordpiece = s['VOCAB_METHOD'] == 'wordpiece'
+    spm_outputs = [s['SENTENCEPIECE_MODEL_PATH'] + '.model',
+                   s['SENTENCEPIECE_VOCAB_PATH']]
+    stages = {
+        '550-dedup-docs.sh': (
+            [s['DOC_FILTERED_DIR']],
+            [s['DEDUPED_DIR'], s['DEDUP_REPORT_PATH']],
+            ['DEDUP_PARAMS', 'DEDUPED_TEXT_CODEC']),
+        '600-sample-sentences.sh': (
+            [] if wordpiece else [s['DEDUPED_DIR']],
+            [] if wordpiece else [s['SAMPLED_TEXT_PATH']],
+            ['SAMPLED_SENTENCE_NUM', 'SAMPLED_SENTENCE_SEED']),
+        '700-basic-tokenize.sh': (
+            [] if wordpiece else [s['SAMPLED_TEXT_PATH']],
+            [] if wordpiece else [s['TOKENIZED_SAMPLE_PATH']],
+            ['BASICTOKENIZE_PARAMS']),
+        '800-create-vocabulary.sh': (
+            [s['DEDUPED_DIR']] if wordpiece else [s['TOKENIZED_SAMPLE_PATH']],
+            ([s['WORDPIECE_VOCAB_PATH'], s['WORD_COUNTS_PATH']] if wordpiece
+             else spm_outputs),
+            ['WORDPIECEVOCAB_PARAMS' if wordpiece else
+             'SENTENCEPIECE_PARAMS']),
+        '850-convert-vocabulary.sh': (
+            [] if wordpiece else [s['SENTENCEPIECE_VOCAB_PATH']],
+            [] if wordpiece else [s['WORDPIECE_VOCAB_PATH']],
+            ['SENT2WORDPIECE_PARAMS']),
+    }
+
+    def constructor(inputs, outputs, variables):
+        values = {v: s[v] for v in ['VOCAB_METHOD'] + variables}
+        return lambda script: DirectoryStage(script, inputs, outputs, values)
+
+    return {name: constructor(*args) for name, args in stages.items()}
+
+
+def per_file_stages(settings, lang):
+    # Return Stage constructors for stages run per file, keyed by
+    # script name.
+    s = settings
+    fused = s['FUSED_TOKENIZE_FILTER'] == 'true'
+
+    def output_path(path, input_dir, output_dir, suffix=''):
+        reldir = os.path.dirname(os.path.relpath(path, input_dir))
+        return os.path.join(output_dir, reldir, output_base(path) + suffix)
+
+    def codec_params(codec):
+        return ['--output-codec', codec,
+                '--compress-threads', s['COMPRESS_THREADS']]
+
+    def index_tasks(task, codec):
+        # Compressed files are not indexed
+        if codec != 'none':
+            return [task]
+        command = ['python3', s['DOCINDEX'], 'build', '--output', '{output}',
+                   task.output]
+        return [task, Task('index {}'.format(task.output), command,
+                           [task.output], task.output + '.idx', deps=[task],
+                           primary=False)]
+
+    def segment_tasks(path, input_dir, deps):
+        output = output_path(path, input_dir, s['TOKENIZED_TEXT_DIR'])
+        codec = s['TOKENIZED_TEXT_CODEC']
+        command = (['python3', s['TOKENIZER']] + s['TOKENIZER_PARAMS'].split() +
+                   codec_params(codec) + [s['UDPIPE_MODEL_PATH'], path])
+        task = Task('segment {}'.format(path), command,
+                    [s['UDPIPE_MODEL_PATH'], path], output, stdout=True,
+                    slots=jobs_in_params(s['TOKENIZER_PARAMS']), deps=deps)
+        return index_tasks(task, codec)
+
+    def filter_tasks(path, input_dir, deps):
+        output = output_path(path, input_dir, s['DOC_FILTERED_DIR'])
+        codec = s['FILTERED_TEXT_CODEC']
+        if fused:
+            command = (['python3', s['SEGMENTFILTER']] +
+                       s['TOKENIZER_PARAMS'].split() +
+                       s['DOC_FILTER_PARAMS'].split() + codec_params(codec) +
+                       [s['UDPIPE_MODEL_PATH'], path])
+            inputs = [s['UDPIPE_MODEL_PATH'], path]
+            slots = jobs_in_params(s['TOKENIZER_PARAMS'])
+        else:
+            command = (['python3', s['DOC_FILTER']] +
+                       s['DOC_FILTER_PARAMS'].split() + codec_params(codec) +
+                       [path])
+            inputs, slots = [path], 1
+        task = Task('filter {}'.format(path), command, inputs, output,
+                    stdout=True, slots=slots, deps=deps)
+        return index_tasks(task, codec)
+
+    def sample_tasks(path, input_dir, deps):
+        sampled = output_path(path, input_dir, s['SAMPLED_DOC_DIR'])
+        held_out = output_path(path, input_dir, s['HELD_OUT_DOC_DIR'])
+        command = (['python3', s['SAMPLEDOCS']] +
+                   s['SAMPLEDOCS_PARAMS'].split() +
+                   codec_params(s['SAMPLED_DOC_CODEC']) +
+                   ['--sampled', '{output}', '--rest', '{output1}',
+                    s['SAMPLED_DOC_RATIO'], path])
+        return [Task('sample {}'.format(path), command, [path], sampled,
+                     deps=deps, extra_outputs=[held_out])]
+
+    def tfrecord_tasks(path, input_dir, deps):
+        # Tokenize once to a cache, then create records for both
+        # sequence lengths from it
+        script = ['python3', s['CREATE_TFRECORDS'], '--bert-dir',
+                  os.path.dirname(s['CREATE_TFRECORD'])]
+        common = '--params={}'.format(s['CREATE_TFRECORD_PARAMS'])
+        jobs = int(s['CREATE_TFRECORD_JOBS'])
+        cache = output_path(path, input_dir, s['WORDPIECE_ID_CACHE_DIR'],
+                            '.npz')
+        command = script + ['--jobs', str(jobs), '--cache', '{output}',
+                            '--cache-only', common, path]
+        cache_task = Task('wordpiece {}'.format(path), command,
+                          [s['WORDPIECE_VOCAB_PATH'], path], cache,
+                          slots=jobs, deps=deps)
+        tasks = [cache_task]
+        for seq_len in ('128', '512'):
+            output = output_path(path, input_dir,
+                                 s['TFRECORD_DIR_{}'.format(seq_len)],
+                                 '.tfrecord')
+            params = s['CREATE_TFRECORD_PARAMS_{}'.format(seq_len)]
+            command = script + ['--cache', cache, common,
+                                '--output-params={}'.format(params),
+                                '--output', '{output}', path]
+            tasks.append(Task('tfrecord-{} {}'.format(seq_len, path),
+                              command,
+                              [s['WORDPIECE_VOCAB_PATH'], path, cache],
+                              output, deps=[cache_task]))
+        return tasks
+
+    stages = {
+        '500-filter-docs.sh': lambda script: PerFileStage(
+            script, s['WIKI_TEXT_DIR'] if fused else s['TOKENIZED_TEXT_DIR'],
+            filter_tasks, chained=not fused),
+        '650-sample-docs.sh': lambda script: PerFileStage(
+            script, s['DEDUPED_DIR'], sample_tasks),
+        '900-create-tfrecords.sh': lambda script: PerFileStage(
+            script, s['DEDUPED_DIR'], tfrecord_tasks),
+    }
+    if fused:
+        stages['400-segment-texts.sh'] = lambda script: PerFileStage(
+            script, None, lambda path, input_dir, deps: [])
+    else:
+        stages['400-segment-texts.sh'] = lambda script: PerFileStage(
+            script, s['WIKI_TEXT_DIR'], segment_tasks)
+    return stages
+
+
+def create_stages(settings, lang):
+    constructors = directory_stages(settings)
+    constructors.update(per_file_stages(settings, lang))
+    stages = []
+    scripts = sorted(glob(os.path.join(PIPELINE_DIR, '[0-9]*.sh')))
+    for script in scripts:
+        name = os.path.basename(script)
+        if name in constructors:
+            stages.append(constructors[name](script))
+        else:
+            stages.append(Stage(script))
+    return stages
+
+
+def expand_stages(stages, lang):
+    # Expand stages into tasks in order as far as currently possible.
+    previous = None
+    for stage in stages:
+        if stage.tasks is None:
+            if previous is not None and previous.tasks is None:
+                break
+            deps = previous.tasks if previous is not None else []
+            if isinstance(stage, DirectoryStage):
+                stage.tasks = [StageTask(stage.name, [stage.script, lang],
+                                         stage.inputs, stage.outputs,
+                                         stage.variables, deps=deps)]
+            elif not isinstance(stage, PerFileStage):
+                stage.tasks = [Task(stage.name, [stage.script, lang],
+                                    deps=deps)]
+            elif (stage.chained and isinstance(previous, PerFileStage) and
+                  previous.input_dir is not None):
+                stage.tasks = []
+                for task in (t for t in previous.tasks if t.primary):
+                    stage.tasks.extend(stage.make_tasks(
+                        task.output, stage.input_dir, [task]))
+            elif stage.input_dir is None:
+                stage.tasks = []
+            elif previous is None or previous.done:
+                stage.tasks = []
+                for path in list_files(stage.input_dir):
+                    stage.tasks.extend(stage.make_tasks(
+                        path, stage.input_dir, deps))
+            else:
+                break
+            for task in stage.tasks:
+                task.stage = stage.name
+        previous = stage
+
+
+def run_stages(stages, settings, options):
+    lang_dir = os.path.join(settings['DATA_DIR'], options.lang)
+    stamp_dir = os.path.join(lang_dir, 'stamps')
+    script = os.path.basename(__file__)
+    pending, running, free_slots = [], {}, options.jobs
+    seen, failed = set(), False
+
+    with ThreadPoolExecutor(max_workers=options.jobs) as executor:
+        while True:
+            expand_stages(stages, options.lang)
+            for stage in stages:
+                for task in stage.tasks or []:
+                    if id(task) not in seen:
+                        seen.add(id(task))
+                        pending.append(task)
+
+            progress, waiting = False, []
+            for task in pending:
+                if failed or not all(d.done for d in task.deps):
+                    waiting.append(task)
+                elif task.is_up_to_date(stamp_dir, lang_dir):
+                    task.done = progress = True
+                elif options.dry_run:
+                    print(task.name)
+                    task.done = progress = True
+                elif task.slots > free_slots and running:
+                    waiting.append(task)
+                else:
+                    print('{}: running {}'.format(script, task.name),
+                          file=sys.stderr, flush=True)
+                    future = executor.submit(task.run, stamp_dir, lang_dir)
+                    running[future] = task
+                    free_slots -= task.slots
+            pending = waiting
+            if progress:
+                continue    # completed tasks may allow further expansion
+            if not running:
+                break
+
+            completed, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in completed:
+                task = running.pop(future)
+                free_slots += task.slots
+                try:
+                    future.result()
+                    task.done = True
+                except Exception as e:
+                    print('{}: {} failed: {}'.format(script, task.name, e),
+                          file=sys.stderr)
+                    failed = True
+    return not failed and not pending
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    os.environ.setdefault(stagemetrics.RUN_ENV, '{}-{}'.format(
+        time.strftime('%Y%m%dT%H%M%S'), os.getpid()))
+    settings = read_settings(args.lang)
+    os.environ[stagemetrics.METRICS_ENV] = settings['WIKIBERT_METRICS']
+    os.environ[udpipeserver.SOCKET_ENV] = settings['WIKIBERT_UDPIPE_SOCKET']
+    stages = create_stages(settings, args.lang)
+    if not run_stages(stages, settings, args):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -3,18 +3,28 @@
 # Sample documents from text with blank lines as document boundaries
 
 import sys
+import hashlib
+
 from random import random, seed
 
+import corpusio
+import stagemetrics
+
 
 def argparser():
     from argparse import ArgumentParser
     ap = ArgumentParser()
+    ap.add_argument('--hash', default=False, action='store_true',
+                    help='Sample by seeded hash of document text instead ' +
+                    'of random draws, making the result independent of ' +
+                    'file order and partitioning')
     ap.add_argument('--sampled', metavar='FILE', default=None,
                     help='Output sampled to FILE (default stdout)')
     ap.add_argument('--rest', metavar='FILE', default=None,
                     help='Output non-sampled to FILE (not output by default)')
     ap.add_argument('--seed', metavar='INT', default=None, type=int,
                     help='Random seed')
+    corpusio.add_output_arguments(ap)
     ap.add_argument('ratio', type=float)
     ap.add_argument('file', nargs='+')
     return ap
@@ -22,14 +32,49 @@ def argparser():
 
 def sample_documents(fn, sampled_out, rest_out, options):
     rand = random()
-    with open(fn) as f:
+    documents, sampled = 0, 0
+    with corpusio.open_text(fn) as f:
         for ln, l in enumerate(f, start=1):
             if rand < options.ratio:
                 sampled_out.write(l)
             else:
                 rest_out.write(l)
             if l.isspace() or not l:
+                documents += 1
+                sampled += rand < options.ratio
                 rand = random()
+    stagemetrics.count('documents-in', documents)
+    stagemetrics.count('documents-out', sampled)
+
+
+def hash_fraction(text, key):
+    # Map text to a number in [0, 1) using a keyed hash
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=8,
+                             key=key).digest()
+    return int.from_bytes(digest, 'big') / 2**64
+
+
+def sample_documents_by_hash(fn, sampled_out, rest_out, options):
+    key = b'' if options.seed is None else str(options.seed).encode()
+
+    def write_document(lines):
+        text = ''.join(l for l in lines if l and not l.isspace())
+        stagemetrics.count('documents-in')
+        if hash_fraction(text, key) < options.ratio:
+            sampled_out.write(''.join(lines))
+            stagemetrics.count('documents-out')
+        else:
+            rest_out.write(''.join(lines))
+
+    with corpusio.open_text(fn) as f:
+        lines = []
+        for ln, l in enumerate(f, start=1):
+            lines.append(l)
+            if l.isspace() or not l:
+                write_document(lines)
+                lines = []
+        if lines:
+            write_document(lines)
 
 
 class NullOut(object):
@@ -40,22 +85,26 @@ class NullOut(object):
 def main(argv):
     args = argparser().parse_args(argv[1:])
     seed(args.seed)
-    if args.sampled is None:
-        sampled_out = sys.stdout
-    else:
-        sampled_out = open(args.sampled, 'w')
-    if args.rest is None:
-        rest_out = NullOut()
-    else:
-        rest_out = open(args.rest, 'w')        
-    for fn in args.file:
-        sample_documents(fn, sampled_out, rest_out, args)
-    if args.sampled is not None:
-        sampled_out.close()
-    if args.rest is not None:
-        rest_out.close()
+    with corpusio.compressed_stdout(args):
+        if args.sampled is None:
+            sampled_out = sys.stdout
+        else:
+            sampled_out = corpusio.options_output(args.sampled, args)
+        if args.rest is None:
+            rest_out = NullOut()
+        else:
+            rest_out = corpusio.options_output(args.rest, args)
+        for fn in args.file:
+            if args.hash:
+                sample_documents_by_hash(fn, sampled_out, rest_out, args)
+            else:
+                sample_documents(fn, sampled_out, rest_out, args)
+        if args.sampled is not None:
+            sampled_out.close()
+        if args.rest is not None:
+            rest_out.close()
     return 0
 
 
 if __name__ == '__main__':
-    sys.exit(main(sys.argv))
+    sys.exit(stagemetrics.run_main(main, sys.argv))
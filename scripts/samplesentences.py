@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# Sample given number of non-blank lines (sentences) from text files.
+#
+# Each line is assigned a random key from a generator seeded with the
+# seed and the file name (relative to the given directory), and the
+# lines with the smallest keys are selected. Files are divided between
+# worker processes that each keep a reservoir of the lines with the
+# smallest keys seen, and the worker reservoirs are merged as they
+# complete, so the input is read once, the sample is exactly the
+# requested size (or all lines, if there are fewer) and it does not
+# depend on the number of workers. The sampled lines are output in
+# input order.
+
+import sys
+import os
+
+from array import array
+from random import Random
+from multiprocessing import Pool
+
+import numpy as np
+
+import corpusio
+import stagemetrics
+
+
+# Line positions are packed as file index << LINE_BITS | line number
+LINE_BITS = 40
+
+# Maximum default number of worker processes, as each keeps a reservoir
+# of up to twice the sample size of lines in memory
+DEFAULT_MAX_JOBS = 8
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Sample sentences.')
+    ap.add_argument('-j', '--jobs', metavar='N',
+                    default=min(DEFAULT_MAX_JOBS, os.cpu_count()), type=int,
+                    help='Number of worker processes, each keeping up ' +
+                    'to twice the sample size of sentences in memory ' +
+                    '(default CPU count, at most {})'.format(
+                        DEFAULT_MAX_JOBS))
+    ap.add_argument('-n', '--number', metavar='NUM', required=True, type=int,
+                    help='Number of sentences to sample')
+    ap.add_argument('-s', '--seed', metavar='INT', default=0, type=int,
+                    help='Random seed (default 0)')
+    ap.add_argument('file', nargs='+', help='File or directory')
+    return ap
+
+
+def partition_files(files, parts):
+    # Divide files into parts of approximately equal total size,
+    # greedily assigning largest files first. Files are represented
+    # as (index, path, name) in the parts.
+    groups = [[] for _ in range(parts)]
+    sizes = [0] * parts
+    indexed = [(idx, fn, name) for idx, (fn, name) in enumerate(files)]
+    indexed.sort(key=lambda i: -os.path.getsize(i[1]))
+    for idx, fn, name in indexed:
+        smallest = sizes.index(min(sizes))
+        groups[smallest].append((idx, fn, name))
+        sizes[smallest] += os.path.getsize(fn)
+    return [g for g in groups if g]
+
+
+class Reservoir(object):
+    """Lines with the smallest keys seen, with their keys and positions.
+
+    Keys and positions are appended to compact arrays and lines to a
+    list, which are cut down to the number smallest whenever they grow
+    to twice that size.
+    """
+
+    def __init__(self, number):
+        self.number = number
+        self.keys, self.positions, self.lines = array('d'), array('Q'), []
+        self.cutoff = float('inf')    # larger keys cannot be selected
+
+    def add(self, key, position, line):
+        if key <= self.cutoff:
+            self.keys.append(key)
+            self.positions.append(position)
+            self.lines.append(line)
+            if len(self.keys) >= 2 * self.number:
+                self.compact()
+
+    def extend(self, keys, positions, lines):
+        # Add the entries of another reservoir
+        self.keys.frombytes(keys.tobytes())
+        self.positions.frombytes(positions.tobytes())
+        self.lines.extend(lines)
+        if len(self.keys) >= 2 * self.number:
+            self.compact()
+
+    def compact(self):
+        keys = np.array(self.keys, dtype=np.float64)
+        positions = np.array(self.positions, dtype=np.uint64)
+        order = np.lexsort((positions, keys))[:self.number]
+        keys, positions = keys[order], positions[order]
+        lines = [self.lines[i] for i in order.tolist()]
+        self.keys, self.positions = array('d'), array('Q')
+        self.keys.frombytes(keys.tobytes())
+        self.positions.frombytes(positions.tobytes())
+        self.lines = lines
+        if len(keys) >= self.number:
+            self.cutoff = keys[-1]
+        return keys, positions, lines
+
+
+def sample_group(files, number, seed):
+    # Return arrays of keys and positions and the list of the lines
+    # with the smallest keys in the given files.
+    reservoir = Reservoir(number)
+    for idx, fn, name in files:
+        rand = Random('{}\t{}'.format(seed, name)).random
+        base = idx << LINE_BITS
+        with corpusio.open_text(fn) as f:
+            for ln, l in enumerate(f, start=1):
+                if not l or l.isspace():
+                    continue
+                reservoir.add(rand(), base | ln, l)
+    return reservoir.compact()
+
+
+def sample_group_star(args):
+    return sample_group(*args)
+
+
+def sample_sentences(files, number, seed, jobs):
+    # Return list of sampled lines in input order
+    if number <= 0:
+        return []
+    groups = partition_files(files, max(1, jobs))
+    args = [(group, number, seed) for group in groups]
+    sampled = Reservoir(number)
+    if jobs > 1 and len(groups) > 1:
+        with Pool(len(groups)) as pool:
+            for reservoir in pool.imap_unordered(sample_group_star, args):
+                sampled.extend(*reservoir)
+    else:
+        for a in args:
+            sampled.extend(*sample_group(*a))
+    _, positions, lines = sampled.compact()
+    return [lines[i] for i in np.argsort(positions, kind='stable').tolist()]
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    files = corpusio.list_files(args.file)
+    sampled = sample_sentences(files, args.number, args.seed, args.jobs)
+    for l in sampled:
+        sys.stdout.write(l if l.endswith('\n') else l + '\n')
+    stagemetrics.count('sentences-out', len(sampled))
+    print('sampled {} sentences (target {}) from {} files'.format(
+        len(sampled), args.number, len(files)), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(stagemetrics.run_main(main, sys.argv))
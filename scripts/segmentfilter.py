@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# Tokenize WikiExtractor output with UDPipe and filter the resulting
+# documents in one streaming pass, without writing the tokenized texts.
+# Equivalent to running udtokenize.py followed by filterdocs.py.
+
+import sys
+import json
+
+from collections import Counter
+
+import corpusio
+import filterdocs
+import udpipeserver
+
+from udtokenize import tokenized_file_chunks
+import stagemetrics
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Tokenize and filter documents.')
+    filterdocs.add_filter_arguments(ap)
+    ap.add_argument('--batch-size', metavar='CHARS', default=None, type=int,
+                    help='Tokenize up to CHARS characters of paragraphs ' +
+                    'per UDPipe call (default one per paragraph); ' +
+                    'sentence boundaries and tokens can differ')
+    ap.add_argument('--encoding', default='utf-8')
+    ap.add_argument('--jobs', metavar='N', default=1, type=int,
+                    help='Number of tokenizer worker processes (default 1)')
+    ap.add_argument('--save-stats', metavar='FILE', default=None,
+                    help='Save combined tokenization and filter stats')
+    udpipeserver.add_server_argument(ap)
+    corpusio.add_output_arguments(ap)
+    ap.add_argument('model', help='UDPipe model')
+    ap.add_argument('file', nargs='+')
+    # udtokenize.py options that must keep their defaults here
+    ap.set_defaults(keep_blank=False, document_tags=False, no_split=False)
+    return ap
+
+
+def tokenized_documents(fns, stats, options):
+    # Yield (file name, document) with documents as lists of sentences,
+    # with blank lines in the tokenizer output separating documents as
+    # in the tokenized texts. --limit applies per file as in
+    # filterdocs.py, and the rest of a file is not tokenized once its
+    # limit is reached.
+    file_counts = Counter()
+
+    def done(fn):
+        return options.limit is not None and file_counts[fn] >= options.limit
+
+    def documents():
+        sentences, current = [], None
+        for fn, output, chunk_stats in tokenized_file_chunks(fns, options,
+                                                             done):
+            if fn != current and sentences:
+                yield current, sentences
+                sentences = []
+            current = fn
+            stats.update(chunk_stats)
+            for t in output:
+                for l in t.split('\n'):
+                    l = l.rstrip()
+                    if l and not l.isspace():
+                        sentences.append(l)
+                    elif sentences:
+                        yield fn, sentences
+                        sentences = []
+        if sentences:
+            yield current, sentences
+
+    for fn, sentences in documents():
+        if not done(fn):
+            file_counts[fn] += 1
+            yield fn, sentences
+
+
+def filter_documents(documents, stats, options, rejected_out=None):
+    # Filter (file name, document) pairs
+    total_count, output_count = 0, 0
+    for fn, sentences in documents:
+        output_count += filterdocs.process_document(
+            sentences, stats, options, rejected_out)
+        total_count += 1
+    stagemetrics.update(stats)    # pass and fail counts
+    stagemetrics.count('documents-in', total_count)
+    stagemetrics.count('documents-out', output_count)
+    stats['total-docs'] = total_count
+    stats['output-docs'] = output_count
+    return stats
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    filterdocs.setup_filter(args)
+    if args.rejected is None:
+        rejected_out = None
+    else:
+        rejected_out = open(args.rejected, 'w')
+    tokenize_stats, filter_stats = Counter(), Counter()
+    documents = tokenized_documents(args.file, tokenize_stats, args)
+    with corpusio.compressed_stdout(args):
+        filter_documents(documents, filter_stats, args, rejected_out)
+    documents.close()
+    stagemetrics.update(tokenize_stats)
+    if rejected_out is not None:
+        rejected_out.close()
+    filterdocs.report_stats('TOTAL', filter_stats)
+    if args.save_stats:
+        with open(args.save_stats, 'w') as out:
+            json.dump({
+                'tokenize': dict(tokenize_stats.items()),
+                'filter': dict(filter_stats.items()),
+            }, out, indent=4)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(stagemetrics.run_main(main, sys.argv))
@@ -4,10 +4,12 @@ import sys
 
 from sentencepiece import SentencePieceTrainer
 
+import stagemetrics
+
 
 def main(argv):
     SentencePieceTrainer.Train(' '.join(argv[1:]))
 
 
 if __name__ == '__main__':
-    sys.exit(main(sys.argv))
+    sys.exit(stagemetrics.run_main(main, sys.argv))
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+# Record and summarize resource metrics of pipeline stages and scripts.
+#
+# When the environment variable WIKIBERT_METRICS names a file, scripts
+# run through run_main() and commands run through run_command() (or
+# "stagemetrics.py run") append a JSON line to it with wall and CPU
+# time, peak RSS, bytes read and written, and counts such as documents
+# in and out reported by the script with count() and update(). The
+# records of a run are aggregated into a per-stage table with
+# "stagemetrics.py summary FILE".
+
+import sys
+import os
+import json
+import time
+import resource
+import subprocess
+
+from collections import Counter, OrderedDict
+
+
+# Environment variables naming the metrics file, current stage and run
+METRICS_ENV = 'WIKIBERT_METRICS'
+STAGE_ENV = 'WIKIBERT_STAGE'
+RUN_ENV = 'WIKIBERT_RUN_ID'
+
+# Record for the running script, see run_main()
+CURRENT = None
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Record or summarize stage metrics.')
+    sub = ap.add_subparsers(dest='command')
+    sub.required = True
+    run = sub.add_parser('run', help='Run command, recording its metrics')
+    run.add_argument('--stage', metavar='NAME', default=None,
+                     help='Stage name (default command basename)')
+    run.add_argument('argv', nargs='+', metavar='COMMAND')
+    summary = sub.add_parser('summary', help='Summarize recorded metrics')
+    summary.add_argument('--run', metavar='ID', default=None,
+                         help='Summarize run ID (default latest)')
+    summary.add_argument('--counts', default=False, action='store_true',
+                         help='Also list counts for each stage and script')
+    summary.add_argument('file', nargs='?', default=None,
+                         help='Metrics file (default ${})'.format(
+                             METRICS_ENV))
+    return ap
+
+
+def metrics_path():
+    return os.environ.get(METRICS_ENV) or None
+
+
+def append_record(path, record):
+    # Append record as a single write so that concurrent processes do
+    # not interleave lines.
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    data = (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+def peak_rss_mb(usage):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    if sys.platform == 'darwin':
+        return usage.ru_maxrss / 2**20
+    return usage.ru_maxrss / 2**10
+
+
+def io_bytes():
+    # Return (read, written) bytes of this process, or (None, None)
+    # where /proc/self/io is not available.
+    try:
+        with open('/proc/self/io') as f:
+            values = dict(l.split(': ') for l in f.read().splitlines())
+        return int(values['rchar']), int(values['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class MetricsRecord(object):
+    """Metrics of a script or command run, with named counts."""
+
+    def __init__(self, kind, name, args, stage=None):
+        self.kind = kind
+        self.name = name
+        self.stage = stage
+        self.args = list(args)
+        self.counts = Counter()
+        self.start = time.time()
+        self.start_wall = time.perf_counter()
+
+    def to_dict(self, wall, user, system, rss, status):
+        return OrderedDict([
+            ('run', os.environ.get(RUN_ENV)),
+            ('stage', self.stage),
+            ('kind', self.kind),
+            ('name', self.name),
+            ('args', self.args),
+            ('start', self.start),
+            ('wall-seconds', wall),
+            ('user-seconds', user),
+            ('system-seconds', system),
+            ('peak-rss-mb', rss),
+            ('exit-status', status),
+            ('counts', dict(self.counts)),
+        ])
+
+
+def count(name, n=1):
+    # Add n to the named count of the running script, if recorded
+    if CURRENT is not None:
+        CURRENT.counts[name] += n
+
+
+def update(counts, prefix=''):
+    # Add counts (e.g. a Counter of filter results) with names prefixed
+    if CURRENT is not None:
+        for name, n in counts.items():
+            CURRENT.counts[prefix + str(name)] += n
+
+
+def run_main(main, argv):
+    # Run main(argv), recording metrics for the process (including
+    # waited-for worker processes) if METRICS_ENV is set.
+    global CURRENT
+    path = metrics_path()
+    if path is None:
+        return main(argv)
+    CURRENT = record = MetricsRecord(
+        'script', os.path.basename(argv[0]), argv[1:],
+        os.environ.get(STAGE_ENV))
+    status = 'error'
+    try:
+        status = main(argv)
+        return status
+    except SystemExit as e:
+        status = e.code
+        raise
+    finally:
+        wall = time.perf_counter() - record.start_wall
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        data = record.to_dict(
+            wall, own.ru_utime + children.ru_utime,
+            own.ru_stime + children.ru_stime,
+            max(peak_rss_mb(own), peak_rss_mb(children)), status)
+        data['read-bytes'], data['written-bytes'] = io_bytes()
+        append_record(path, data)
+        CURRENT = None
+
+
+def run_command(command, stage=None, **kwargs):
+    # Run command and return its exit status, recording its metrics
+    # as a stage if METRICS_ENV is set. Resource usage is that of the
+    # command and its waited-for descendants (os.wait4).
+    path = metrics_path()
+    if path is None:
+        return subprocess.run(command, **kwargs).returncode
+    name = os.path.basename(command[0])
+    if stage is None:
+        stage = name
+    env = dict(kwargs.pop('env', None) or os.environ)
+    env[STAGE_ENV] = stage
+    record = MetricsRecord('stage', name, command[1:], stage)
+    process = subprocess.Popen(command, env=env, **kwargs)
+    try:
+        _, wait_status, usage = os.wait4(process.pid, 0)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    if os.WIFSIGNALED(wait_status):
+        process.returncode = -os.WTERMSIG(wait_status)
+    else:
+        process.returncode = os.WEXITSTATUS(wait_status)
+    wall = time.perf_counter() - record.start_wall
+    append_record(path, record.to_dict(
+        wall, usage.ru_utime, usage.ru_stime, peak_rss_mb(usage),
+        process.returncode))
+    return process.returncode
+
+
+def read_records(path, run=None):
+    # Return records of run (default the run of the last record)
+    records = []
+    with open(path) as f:
+        for l in f:
+            if l.strip():
+                records.append(json.loads(l))
+    if run is None and records:
+        run = records[-1].get('run')
+    return [r for r in records if r.get('run') == run], run
+
+
+def human_bytes(n):
+    if n is None:
+        return '-'
+    for unit in ('B', 'K', 'M', 'G'):
+        if abs(n) < 1024:
+            return '{:.0f}{}'.format(n, unit)
+        n /= 1024
+    return '{:.1f}T'.format(n)
+
+
+def summarize(records):
+    # Return rows aggregating records by stage, each followed by rows
+    # for the scripts run in the stage.
+    stages = OrderedDict()
+    for r in sorted(records, key=lambda r: r['start']):
+        stage = stages.setdefault(r.get('stage') or '-', {
+            'stage': None, 'scripts': OrderedDict()
+        })
+        if r['kind'] == 'stage':
+            stage['stage'] = r
+        else:
+            stage['scripts'].setdefault(r['name'], []).append(r)
+
+    def aggregate(label, records, wall=None):
+        counts = Counter()
+        for r in records:
+            counts.update(r.get('counts', {}))
+
+        def total(key):
+            values = [r.get(key) for r in records]
+            if any(v is None for v in values):
+                return None
+            return sum(values)
+
+        return {
+            'label': label,
+            'runs': len(records),
+            'wall': (sum(r['wall-seconds'] for r in records)
+                     if wall is None else wall),
+            'cpu': sum(r['user-seconds'] + r['system-seconds']
+                       for r in records),
+            'rss': max(r['peak-rss-mb'] for r in records),
+            'read': total('read-bytes'),
+            'written': total('written-bytes'),
+            'failed': sum(1 for r in records if r['exit-status'] not in
+                          (0, None)),
+            'counts': counts,
+        }
+
+    rows = []
+    for name, stage in stages.items():
+        scripts = []
+        for script, rs in stage['scripts'].items():
+            scripts.append(aggregate('  ' + script, rs))
+            scripts[-1]['key'] = '{}/{}'.format(name, script)
+        if stage['stage'] is not None:
+            row = aggregate(name, [stage['stage']])
+        else:
+            row = aggregate(name, [r for rs in stage['scripts'].values()
+                                   for r in rs])
+        for key in ('read', 'written'):
+            values = [s[key] for s in scripts]
+            row[key] = None if not values or None in values else sum(values)
+        row['counts'] = sum((s['counts'] for s in scripts), Counter())
+        rows.append(row)
+        rows.extend(scripts)
+    return rows
+
+
+def print_summary(rows, options, out=sys.stdout):
+    header = ('stage/script', 'runs', 'wall', 'cpu', 'rss', 'read',
+              'written', 'docs-in', 'docs-out', 'failed')
+    print('\t'.join(header), file=out)
+    for row in rows:
+        counts = row['counts']
+        print('\t'.join([
+            row['label'], str(row['runs']),
+            '{:.1f}s'.format(row['wall']), '{:.1f}s'.format(row['cpu']),
+            '{:.0f}M'.format(row['rss']), human_bytes(row['read']),
+            human_bytes(row['written']),
+            str(counts.get('documents-in', '-')),
+            str(counts.get('documents-out', '-')),
+            str(row['failed']),
+        ]), file=out)
+    if options.counts:
+        for row in rows:
+            if 'key' not in row:
+                continue    # stage totals of script counts
+            for name, n in sorted(row['counts'].items()):
+                print('{}\t{}\t{}'.format(row['key'], name, n), file=out)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    if args.command == 'run':
+        return run_command(args.argv, args.stage)
+    path = args.file or metrics_path()
+    if path is None:
+        print('error: no metrics file given and ${} not set'.format(
+            METRICS_ENV), file=sys.stderr)
+        return 1
+    records, run = read_records(path, args.run)
+    if not records:
+        print('error: no records for run {} in {}'.format(run, path),
+              file=sys.stderr)
+        return 1
+    print('run {}'.format(run))
+    print_summary(summarize(records), args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -4,16 +4,55 @@
 # one sentence per line, and space-separated tokens.
 
 import sys
+import os
 import math
+import mmap
+
+import numpy as np
 
 from collections import Counter
+from functools import partial
+from multiprocessing import Pool
+
+import corpusio
+import stagemetrics
+
+from docindex import load_index
+
+
+# Size of chunks of bytes processed at a time in fast mode
+FAST_CHUNK_SIZE = 16 * 2**20
+
+# Lookup table for ASCII whitespace bytes (as in str.split())
+ASCII_WHITESPACE = np.array([c < 128 and chr(c).isspace() for c in range(256)])
+
+# UTF-8 encodings of non-ASCII whitespace (as in str.split(); the last
+# whitespace codepoint is U+3000)
+UNICODE_WHITESPACE = [
+    chr(c).encode('utf-8') for c in range(128, 0x3001) if chr(c).isspace()
+]
+
+# Integer keys combining the bytes of each encoding, and the first bytes
+UNICODE_WHITESPACE_KEYS = np.array(
+    sorted(int.from_bytes(b, 'big') for b in UNICODE_WHITESPACE))
+
+UNICODE_WHITESPACE_LEADS = np.unique([b[0] for b in UNICODE_WHITESPACE])
 
 
 def argparser():
     from argparse import ArgumentParser
     ap = ArgumentParser()
+    ap.add_argument('-f', '--fast', default=False, action='store_true',
+                    help='Count with vectorized operations on memory-' +
+                    'mapped bytes (same results, UTF-8 only, ' +
+                    'uncompressed files)')
     ap.add_argument('-H', '--human-readable', default=False,
                     action='store_true')
+    ap.add_argument('-i', '--index', default=False, action='store_true',
+                    help='Read document, sentence and token counts from ' +
+                    'document indexes where available (no char counts)')
+    ap.add_argument('-j', '--jobs', metavar='N', default=1, type=int,
+                    help='Number of files to process in parallel')
     ap.add_argument('-l', '--no-labels', default=False, action='store_true')
     ap.add_argument('-s', '--no-space', default=False, action='store_true')
     ap.add_argument('file', nargs='+')
@@ -48,7 +87,7 @@ def print_stats(name, stats, options):
 def tokenized_stats(fn, options):
     stats = Counter()
     text_seen = False
-    with open(fn) as f:
+    with corpusio.open_text(fn) as f:
         for ln, l in enumerate(f, start=1):
             l = l.rstrip()
             if l.isspace() or not l:
@@ -67,16 +106,150 @@ def tokenized_stats(fn, options):
     return stats
 
 
+def unicode_whitespace_positions(a):
+    # Return positions in byte array a where a non-ASCII whitespace
+    # character starts.
+    candidates = np.flatnonzero(np.isin(a, UNICODE_WHITESPACE_LEADS))
+    if not len(candidates):
+        return candidates
+    padded = np.concatenate((a, np.zeros(2, dtype=np.uint8)))
+    key2 = ((padded[candidates].astype(np.int64) << 8) |
+            padded[candidates+1])
+    key3 = (key2 << 8) | padded[candidates+2]
+    found = (np.isin(key2, UNICODE_WHITESPACE_KEYS) |
+             np.isin(key3, UNICODE_WHITESPACE_KEYS))
+    return candidates[found]
+
+
+def chunk_line_stats(a, options):
+    # Return arrays of (tokens, chars) for the lines in byte array a,
+    # where lines are separated by newlines and the last line may lack
+    # a newline. Chars are counted after stripping trailing whitespace
+    # (or for tokens only with options.no_space), and lines with no
+    # tokens are blank. Lines with non-ASCII whitespace or trailing
+    # whitespace are rare and recounted in Python.
+    ws = np.take(ASCII_WHITESPACE, a)
+    newlines = np.flatnonzero(a == 10)
+    starts = np.concatenate(([0], newlines+1))
+    ends = np.concatenate((newlines, [len(a)]))
+    if starts[-1] == len(a):
+        starts, ends = starts[:-1], ends[:-1]    # no final partial line
+
+    def count_in_lines(positions):
+        # number of sorted positions within each line
+        return (np.searchsorted(positions, ends) -
+                np.searchsorted(positions, starts))
+
+    token_starts = np.flatnonzero(ws[:-1] & ~ws[1:]) + 1
+    if not ws[0]:
+        token_starts = np.concatenate(([0], token_starts))
+    tokens = count_in_lines(token_starts)
+    continuation = np.flatnonzero((a & 0xC0) == 0x80)
+    if options.no_space:
+        chars = (count_in_lines(np.flatnonzero(~ws)) -
+                 count_in_lines(continuation))
+    else:
+        chars = ends - starts - count_in_lines(continuation)
+
+    special = unicode_whitespace_positions(a)
+    if len(special):
+        special = np.searchsorted(starts, special, 'right') - 1
+    if not options.no_space:
+        nonempty = np.flatnonzero(ends > starts)
+        trailing = nonempty[ws[ends[nonempty]-1]]
+        special = np.concatenate((special, trailing))
+    for i in np.unique(special):
+        l = a[starts[i]:ends[i]].tobytes().decode('utf-8').rstrip()
+        split = l.split()
+        tokens[i] = len(split)
+        if options.no_space:
+            chars[i] = sum(len(t) for t in split)
+        else:
+            chars[i] = len(l)
+    return tokens, chars
+
+
+def fast_tokenized_stats(fn, options):
+    # Equivalent to tokenized_stats() for UTF-8 text
+    stats = Counter()
+    if os.path.getsize(fn) == 0:
+        return stats
+    if corpusio.is_compressed(fn):
+        return tokenized_stats(fn, options)
+    with open(fn, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if mm.find(b'\r') != -1:
+            # universal newlines mode splits lines also on carriage
+            # returns; leave these files to the line-by-line version
+            return tokenized_stats(fn, options)
+        text_seen, pos = False, 0
+        while pos < len(mm):
+            end = mm.find(b'\n', pos+FAST_CHUNK_SIZE)
+            end = len(mm) if end == -1 else end+1
+            a = np.frombuffer(mm, dtype=np.uint8, count=end-pos, offset=pos)
+            tokens, chars = chunk_line_stats(a, options)
+            text = tokens > 0
+            previous = np.concatenate(([text_seen], text[:-1]))
+            stats[(0, 'documents')] += int(np.sum(~text & previous))
+            stats[(1, 'sentences')] += int(np.sum(text))
+            stats[(2, 'tokens')] += int(np.sum(tokens))
+            stats[(3, 'chars')] += int(np.sum(chars[text]))
+            if len(text):
+                text_seen = bool(text[-1])
+            del a
+            pos = end
+    finally:
+        mm.close()
+    # drop zero counts as Counter increments in tokenized_stats()
+    return +stats
+
+
+def indexed_stats(fn):
+    # Return stats from document index for fn, or None if not available
+    index = load_index(fn)
+    if index is None:
+        return None
+    with index:
+        return Counter({
+            (0, 'documents'): len(index),
+            (1, 'sentences'): index.total_sentences(),
+            (2, 'tokens'): index.total_tokens(),
+        })
+
+
+def file_stats(fn, options):
+    stats = indexed_stats(fn) if options.index else None
+    if stats is None:
+        if options.fast:
+            stats = fast_tokenized_stats(fn, options)
+        else:
+            stats = tokenized_stats(fn, options)
+        if options.index:
+            del stats[(3, 'chars')]
+    return stats
+
+
 def main(argv):
     args = argparser().parse_args(argv[1:])
+    get_stats = partial(file_stats, options=args)
+    if args.jobs > 1:
+        pool = Pool(args.jobs)
+        file_stats_iter = pool.imap(get_stats, args.file)
+    else:
+        pool = None
+        file_stats_iter = map(get_stats, args.file)
     totals = Counter()
-    for fn in args.file:
-        stats = tokenized_stats(fn, args)
+    for fn, stats in zip(args.file, file_stats_iter):
         print_stats(fn, stats, args)
         totals = totals + stats
     print_stats('TOTAL', totals, args)
+    stagemetrics.update({name: n for (_, name), n in totals.items()})
+    if pool is not None:
+        pool.close()
+        pool.join()
     return 0
 
 
 if __name__ == '__main__':
-    sys.exit(main(sys.argv))
+    sys.exit(stagemetrics.run_main(main, sys.argv))
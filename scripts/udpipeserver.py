@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+# Tokenization server keeping UDPipe models loaded across udtokenize.py
+# and segmentfilter.py runs.
+#
+# The server listens on a Unix socket (by default $WIKIBERT_UDPIPE_SOCKET)
+# and handles each client connection in a thread. A request holds a
+# model path, tokenizer options and a batch of document chunks (see
+# udtokenize.read_documents()); the chunks are tokenized in a pool of
+# worker processes, each keeping up to --max-models models loaded in
+# least recently used order, so pipelines for several languages can
+# share one server. Messages are JSON objects preceded by their length
+# as a 4-byte big-endian integer. Clients get connections with
+# connect(), which returns None when no server is running so that
+# callers can load the model themselves instead.
+
+import sys
+import os
+import json
+import errno
+import signal
+import socket
+import struct
+import threading
+import socketserver
+
+from argparse import Namespace
+from collections import Counter, OrderedDict
+from multiprocessing import Pool
+
+import stagemetrics
+
+
+# Environment variable naming the default server socket
+SOCKET_ENV = 'WIKIBERT_UDPIPE_SOCKET'
+
+# Number of document chunks sent per request by clients
+REQUEST_DOCUMENTS = 128
+
+# udtokenize.py options applied by the server to each request
+TOKENIZER_OPTIONS = ('keep_blank', 'document_tags', 'no_split', 'batch_size')
+
+HEADER = struct.Struct('>I')
+
+# Per-process state of pool workers, see init_worker()
+WORKER_MODELS = None
+WORKER_MAX_MODELS = None
+
+
+class ServerError(Exception):
+    pass
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Serve UDPipe tokenization requests.')
+    sub = ap.add_subparsers(dest='command')
+    sub.required = True
+    serve = sub.add_parser('serve', help='Run server until stopped')
+    serve.add_argument('-j', '--jobs', metavar='N', default=os.cpu_count(),
+                       type=int, help='Number of worker processes')
+    serve.add_argument('-m', '--max-models', metavar='N', default=4,
+                       type=int, help='Models kept loaded in each worker ' +
+                       '(default 4)')
+    sub.add_parser('status', help='Print status of running server')
+    sub.add_parser('stop', help='Stop running server')
+    for p in sub.choices.values():
+        add_server_argument(p, '-s', '--socket')
+    return ap
+
+
+def add_server_argument(ap, *names):
+    # Add option for the server socket to ArgumentParser
+    ap.add_argument(*(names or ('--server',)), metavar='PATH',
+                    dest='server', default=os.environ.get(SOCKET_ENV),
+                    help='Tokenization server socket (default ${})'.format(
+                        SOCKET_ENV))
+
+
+def send_message(sock, message):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        block = sock.recv(size-len(data))
+        if not block:
+            break
+        data.extend(block)
+    return bytes(data)
+
+
+def receive_message(sock):
+    # Return next message from socket, or None if closed by the peer
+    header = receive_exactly(sock, HEADER.size)
+    if not header:
+        return None
+    if len(header) < HEADER.size:
+        raise ServerError('connection closed in message header')
+    size, = HEADER.unpack(header)
+    data = receive_exactly(sock, size)
+    if len(data) < size:
+        raise ServerError('connection closed in message')
+    return json.loads(data.decode('utf-8'))
+
+
+class TokenizerClient(object):
+    """Connection to a tokenization server."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def request(self, message):
+        send_message(self.sock, message)
+        response = receive_message(self.sock)
+        if response is None:
+            raise ServerError('connection closed by server')
+        if 'error' in response:
+            raise ServerError(response['error'])
+        return response
+
+    def status(self):
+        return self.request({'command': 'status'})
+
+    def stop(self):
+        return self.request({'command': 'stop'})
+
+    def tokenize(self, model_path, documents, fn, options):
+        # Return list of (output, stats) for document chunks as from
+        # udtokenize.tokenize_document()
+        response = self.request({
+            'command': 'tokenize',
+            'model': os.path.abspath(model_path),
+            'documents': documents,
+            'fn': fn,
+            'options': {k: getattr(options, k) for k in TOKENIZER_OPTIONS},
+        })
+        return [(output, Counter(stats))
+                for output, stats in response['results']]
+
+
+def connect(path):
+    # Return TokenizerClient for server at path, or None if path is
+    # not given or no server is listening on it
+    if not path:
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return TokenizerClient(sock)
+
+
+def init_worker(max_models):
+    global WORKER_MODELS, WORKER_MAX_MODELS
+    WORKER_MODELS, WORKER_MAX_MODELS = OrderedDict(), max_models
+
+
+def worker_model(model_path):
+    # Return (model, pipeline) for path, loading it if necessary and
+    # unloading the least recently used model if over the limit
+    # udtokenize.py uses this module
+    from udtokenize import create_model
+    if model_path in WORKER_MODELS:
+        WORKER_MODELS.move_to_end(model_path)
+    else:
+        if not os.path.isfile(model_path):
+            raise ValueError('no model {}'.format(model_path))
+        WORKER_MODELS[model_path] = create_model(model_path)
+        while len(WORKER_MODELS) > WORKER_MAX_MODELS:
+            WORKER_MODELS.popitem(last=False)
+    return WORKER_MODELS[model_path]
+
+
+def tokenize_in_worker(model_path, lines, fn, options):
+    from udtokenize import tokenize_document
+    model, pipeline = worker_model(model_path)
+    output, stats = tokenize_document(model, pipeline, lines, fn,
+                                      Namespace(**options))
+    return output, dict(stats)
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    """Handles the requests of one client connection."""
+
+    def handle(self):
+        while True:
+            try:
+                request = receive_message(self.request)
+            except (OSError, ServerError, ValueError):
+                return
+            if request is None:
+                return
+            try:
+                response = self.server.respond(request)
+            except Exception as e:
+                response = {'error': '{}: {}'.format(type(e).__name__, e)}
+            try:
+                send_message(self.request, response)
+            except OSError:
+                return
+
+
+class TokenizerServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    """Unix socket server tokenizing requests in a worker pool."""
+
+    daemon_threads = True
+
+    def __init__(self, path, pool, jobs):
+        super().__init__(path, RequestHandler)
+        self.pool = pool
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.models = OrderedDict()    # paths by last use
+
+    def respond(self, request):
+        command = request.get('command')
+        if command == 'tokenize':
+            return self.tokenize(request)
+        elif command == 'status':
+            with self.lock:
+                return {'pid': os.getpid(), 'jobs': self.jobs,
+                        'models': list(self.models), 'stats': self.stats}
+        elif command == 'stop':
+            threading.Thread(target=self.shutdown).start()
+            return {'stopping': True}
+        else:
+            raise ValueError('unknown command {}'.format(command))
+
+    def tokenize(self, request):
+        model_path, fn = request['model'], request.get('fn')
+        options = {k: request['options'].get(k) for k in TOKENIZER_OPTIONS}
+        pending = [
+            self.pool.apply_async(tokenize_in_worker,
+                                  (model_path, lines, fn, options))
+            for lines in request['documents']
+        ]
+        results = [p.get() for p in pending]
+        with self.lock:
+            self.models[model_path] = True
+            self.models.move_to_end(model_path)
+            self.stats['requests'] += 1
+            self.stats['documents'] += len(results)
+        return {'results': results}
+
+
+def remove_stale_socket(path):
+    # Remove socket left by a server that is no longer running
+    client = connect(path)
+    if client is not None:
+        client.close()
+        raise ServerError('server already running on {}'.format(path))
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def serve(options):
+    remove_stale_socket(options.server)
+    # Exit through the finally clauses below on SIGTERM
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    with Pool(options.jobs, init_worker, (options.max_models,)) as pool:
+        server = TokenizerServer(options.server, pool, options.jobs)
+        try:
+            print('serving on {} with {} workers'.format(
+                options.server, options.jobs), file=sys.stderr)
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(options.server)
+            stagemetrics.update(server.stats)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    if not args.server:
+        print('error: no socket given and ${} not set'.format(SOCKET_ENV),
+              file=sys.stderr)
+        return 1
+    try:
+        if args.command == 'serve':
+            serve(args)
+            return 0
+        client = connect(args.server)
+        if client is None:
+            print('no server on {}'.format(args.server), file=sys.stderr)
+            return 1
+        with client:
+            if args.command == 'status':
+                print(json.dumps(client.status(), indent=4))
+            else:
+                client.stop()
+    except ServerError as e:
+        print('error: {}'.format(e), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(stagemetrics.run_main(main, sys.argv))
@@ -1,16 +1,21 @@
 #!/usr/bin/env python3
 
 import sys
+import os
 import re
 import json
-import gzip
-import bz2
 
-from collections import Counter
+from collections import Counter, deque
 from logging import warning
+from multiprocessing import Pool
+
+import corpusio
+import stagemetrics
+import udpipeserver
 
 try:
-    from ufal.udpipe import Model, Pipeline
+    from ufal.udpipe import Model, Pipeline, Sentence, OutputFormat
+    from ufal.udpipe import ProcessingError
 except ImportError:
     print('Failed to import ufal.udpipe. (Try `pip3 install ufal.udpipe`?)',
           file=sys.stderr)
@@ -21,19 +26,32 @@ except ImportError:
 DOC_START_TAG_RE = re.compile(r'^<doc\s+id=.*>$')
 DOC_END_TAG_RE = re.compile(r'^</doc>$')
 
+# UDPipe tokenizer options, used for both the pipeline and batched
+# tokenization (see tokenize_paragraphs())
+TOKENIZER_OPTIONS = Model.DEFAULT
+
 
 def argparser():
     from argparse import ArgumentParser
     ap = ArgumentParser()
     ap.add_argument('-b', '--keep-blank', default=False, action='store_true',
                     help='Include blank lines in output')
+    ap.add_argument('-B', '--batch-size', metavar='CHARS', default=None,
+                    type=int, help='Tokenize up to CHARS characters of ' +
+                    'paragraphs per UDPipe call (default one per ' +
+                    'paragraph); faster, but sentence boundaries and ' +
+                    'tokens can differ from per-paragraph calls')
     ap.add_argument('-d', '--document-tags', default=False, action='store_true',
                     help='Include document start/end tags in output')
     ap.add_argument('-e', '--encoding', default='utf-8')
+    ap.add_argument('-j', '--jobs', metavar='N', default=1, type=int,
+                    help='Number of worker processes (default 1)')
     ap.add_argument('-n', '--no-split', default=False, action='store_true',
                     help='Do not split sentences on separate lines')
     ap.add_argument('-s', '--save-stats', metavar='FILE', default=None)
     ap.add_argument('-q', '--quiet', default=False, action='store_true')
+    udpipeserver.add_server_argument(ap)
+    corpusio.add_output_arguments(ap)
     ap.add_argument('model', help='UDPipe model')
     ap.add_argument('file', nargs='+')
     return ap
@@ -41,25 +59,86 @@ def argparser():
 
 def create_model(model_path):
     model = Model.load(model_path)
-    pipeline = Pipeline(model, 'tokenize', 'none', 'none', 'horizontal')
+    pipeline = Pipeline(model, 'tokenizer=' + TOKENIZER_OPTIONS, 'none',
+                        'none', 'horizontal')
     return model, pipeline
 
 
-def character_count(text):
-    return len(list(c for c in text if not c.isspace()))
+def text_stats(text):
+    # Return character (non-space), token and sentence counts for
+    # tokenized text in a single pass over its lines.
+    characters, tokens, sentences = 0, 0, 0
+    for line in text.split('\n'):
+        line_tokens = line.split()
+        if line_tokens:
+            characters += sum(map(len, line_tokens))
+            tokens += len(line_tokens)
+            sentences += 1
+    return characters, tokens, sentences
+
+
+def tokenize_paragraphs(model, paragraphs):
+    # Tokenize paragraphs with a single UDPipe call, returning
+    # horizontal-format output for each paragraph, or None if the
+    # paragraph boundaries could not be recovered from the result.
+    # As the tokenizer sees the paragraphs in context, the output is
+    # not guaranteed to match tokenizing each paragraph separately.
+    tokenizer = model.newTokenizer(TOKENIZER_OPTIONS)
+    output_format = OutputFormat.newOutputFormat('horizontal')
+    tokenizer.setText('\n\n'.join(paragraphs))
+    sentence, error = Sentence(), ProcessingError()
+    output = []
+    while tokenizer.nextSentence(sentence, error):
+        if sentence.getNewPar() or not output:
+            output.append([])
+        output[-1].append(output_format.writeSentence(sentence))
+    if error.occurred() or len(output) != len(paragraphs):
+        return None
+    return [''.join(sentences) for sentences in output]
 
 
-def token_count(text):
-    return len(list(t for t in text.split()))
+def read_documents(f):
+    # Group lines into chunks each ending with a document end tag (or
+    # EOF) so that chunks can be tokenized independently.
+    lines = []
+    for l in f:
+        lines.append(l)
+        if DOC_END_TAG_RE.match(l.rstrip('\n')):
+            yield lines
+            lines = []
+    if lines:
+        yield lines
 
 
-def sentence_count(text):
-    return len(list(s for s in text.split('\n') if s.strip()))
+def tokenize_document(model, pipeline, lines, fn, options):
+    output, stats = [], Counter()
+    paragraphs, batch_size = [], 0
 
+    def add_tokenized(t):
+        characters, tokens, sentences = text_stats(t)
+        stats['characters'] += characters
+        stats['tokens'] += tokens
+        stats['sentences'] += sentences
+        t = t.rstrip('\n')
+        if options.no_split:
+            t = t.replace('\n', ' ')
+        output.append(t)
 
-def tokenize_stream(pipeline, f, fn, options):
-    stats = Counter()
-    for ln, l in enumerate(f, start=1):
+    def flush():
+        nonlocal batch_size
+        if not paragraphs:
+            return
+        tokenized = tokenize_paragraphs(model, paragraphs)
+        if tokenized is None:
+            warning('Failed to batch paragraphs in {}, tokenizing '
+                    'separately'.format(fn))
+            tokenized = [pipeline.process(p) for p in paragraphs]
+        for t in tokenized:
+            add_tokenized(t)
+        paragraphs.clear()
+        batch_size = 0
+
+    for l in lines:
         l = l.rstrip('\n')
         if '\x00' in l:
             warning('Removing null bytes from text in {}: {}'.format(fn, l))
@@ -68,42 +147,136 @@ def tokenize_stream(pipeline, f, fn, options):
         end_m = DOC_END_TAG_RE.match(l)
         if l.isspace() or not l:
             if options.keep_blank:
-                print(l)
+                flush()
+                output.append(l)
         elif start_m or end_m:
             if options.document_tags:
-                print(l)
+                flush()
+                output.append(l)
             elif end_m:
-                print()    # Empty line as doc boundary
+                flush()
+                output.append('')    # Empty line as doc boundary
+        elif options.batch_size is None:
+            add_tokenized(pipeline.process(l))
         else:
-            t = pipeline.process(l)
-            stats['characters'] += character_count(t)
-            stats['tokens'] += token_count(t)
-            stats['sentences'] += sentence_count(t)
-            t = t.rstrip('\n')
-            if options.no_split:
-                t = t.replace('\n', ' ')
-            print(t)
-    return stats
-
-
-def tokenize(pipeline, fn, options):
-    if fn.endswith('.gz'):
-        with gzip.open(fn, 'rt', encoding=options.encoding) as f:
-            return tokenize_stream(pipeline, f, fn, options)
-    elif fn.endswith('.bz2'):
-        with bz2.open(fn, 'rt', encoding=options.encoding) as f:
-            return tokenize_stream(pipeline, f, fn, options)
-    else:
-        with open(fn) as f:
-            return tokenize_stream(pipeline, f, fn, options)
+            paragraphs.append(l)
+            batch_size += len(l)
+            if batch_size >= options.batch_size:
+                flush()
+    flush()
+    return output, stats
+
+
+def open_input(fn, options):
+    # Open plain or compressed (see corpusio.py) input
+    return corpusio.open_text(fn, encoding=options.encoding)
+
+
+def file_documents(fn, options, done=None):
+    # Yield document chunks of file, stopping when done(fn) is true
+    with open_input(fn, options) as f:
+        for lines in read_documents(f):
+            if done is not None and done(fn):
+                break
+            yield lines
+
+
+# Per-process state for --jobs, see init_worker(). The model must be
+# kept referenced for as long as the pipeline is used.
+WORKER_MODEL = None
+WORKER_PIPELINE = None
+WORKER_OPTIONS = None
+
+
+def init_worker(model_path, options):
+    global WORKER_MODEL, WORKER_PIPELINE, WORKER_OPTIONS
+    WORKER_MODEL, WORKER_PIPELINE = create_model(model_path)
+    WORKER_OPTIONS = options
+
+
+def tokenize_document_in_worker(lines, fn):
+    output, stats = tokenize_document(WORKER_MODEL, WORKER_PIPELINE, lines,
+                                      fn, WORKER_OPTIONS)
+    return fn, output, stats
+
+
+def parallel_tokenized_chunks(fns, options, done=None):
+    # Fan documents out to a pool of workers that each load the model
+    # once, yielding results in input order. The number of documents in
+    # flight is bounded to keep memory use independent of input size.
+    max_pending = options.jobs * 16
+    pending = deque()
+    with Pool(options.jobs, init_worker, (options.model, options)) as pool:
+        for fn in fns:
+            for lines in file_documents(fn, options, done):
+                pending.append(pool.apply_async(
+                    tokenize_document_in_worker, (lines, fn)))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def server_tokenized_chunks(client, fns, options, done=None):
+    # Send document chunks to a tokenization server in batches of
+    # requests, yielding results in input order.
+    model_path = os.path.abspath(options.model)
+
+    def request(batch, fn):
+        for output, stats in client.tokenize(model_path, batch, fn, options):
+            yield fn, output, stats
+
+    for fn in fns:
+        batch = []
+        for lines in file_documents(fn, options, done):
+            batch.append(lines)
+            if len(batch) >= udpipeserver.REQUEST_DOCUMENTS:
+                yield from request(batch, fn)
+                batch = []
+        if batch:
+            yield from request(batch, fn)
+
+
+def tokenized_chunks(fns, options):
+    # Yield (output, stats) for each document chunk in the given files
+    # in order, where output is a list of lines.
+    for fn, output, stats in tokenized_file_chunks(fns, options):
+        yield output, stats
+
+
+def tokenized_file_chunks(fns, options, done=None):
+    # Yield (file name, output, stats) for each document chunk in the
+    # given files in order. A running tokenization server
+    # (udpipeserver.py) is used if one is given, and the model loaded
+    # here otherwise. If given, done(fn) is checked before reading
+    # each chunk, and the rest of the file is skipped when it is true
+    # (chunks already sent to workers or the server are still yielded).
+    client = udpipeserver.connect(options.server)
+    if client is not None:
+        stagemetrics.count('server-connections')
+        with client:
+            yield from server_tokenized_chunks(client, fns, options, done)
+        return
+    if options.jobs > 1:
+        yield from parallel_tokenized_chunks(fns, options, done)
+        return
+    model, pipeline = create_model(options.model)
+    for fn in fns:
+        for lines in file_documents(fn, options, done):
+            yield (fn, *tokenize_document(model, pipeline, lines, fn,
+                                          options))
 
 
 def main(argv):
     args = argparser().parse_args(argv[1:])
-    model, pipeline = create_model(args.model)
     totals = Counter()
-    for fn in args.file:
-        totals += tokenize(pipeline, fn, args)
+    with corpusio.compressed_stdout(args):
+        for output, stats in tokenized_chunks(args.file, args):
+            for t in output:
+                print(t)
+            totals.update(stats)
+            stagemetrics.count('documents-in')
+    stagemetrics.update(totals)
     if args.save_stats:
         with open(args.save_stats, 'w') as out:
             json.dump(dict(totals.items()), out, indent=4)
@@ -111,4 +284,4 @@ def main(argv):
 
 
 if __name__ == '__main__':
-    sys.exit(main(sys.argv))
+    sys.exit(stagemetrics.run_main(main, sys.argv))
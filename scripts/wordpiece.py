@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+# Memoized WordPiece tokenization compatible with the FullTokenizer of
+# bert/tokenization.py.
+#
+# Words from the basic tokenizer (by default FastBasicTokenizer) are
+# segmented into wordpieces with the same greedy longest-match-first
+# algorithm as WordpieceTokenizer, but candidate pieces are bounded by
+# the longest vocabulary entry and the segmentations (with their ids)
+# are cached in a bounded LRU cache.
+
+import sys
+import os
+
+from functools import lru_cache
+
+import corpusio
+import stagemetrics
+
+from fasttokenization import FastBasicTokenizer
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_BERT_DIR = os.path.join(BASE_DIR, 'bert')
+
+DEFAULT_CACHE_SIZE = 2**20
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='WordPiece tokenize text.')
+    ap.add_argument('--bert-dir', metavar='DIR', default=DEFAULT_BERT_DIR,
+                    help='Directory with tokenization.py')
+    ap.add_argument('--cache-size', metavar='N', default=DEFAULT_CACHE_SIZE,
+                    type=int, help='Maximum number of cached words')
+    ap.add_argument('--lower', default=False, action='store_true',
+                    help='Lowercase (do_lower_case)')
+    ap.add_argument('--verify', default=False, action='store_true',
+                    help='Compare to reference tokenizer instead of output')
+    ap.add_argument('vocab', help='WordPiece vocabulary')
+    ap.add_argument('file', nargs='+')
+    return ap
+
+
+def import_tokenization(bert_dir):
+    if bert_dir not in sys.path:
+        sys.path.insert(0, bert_dir)
+    import tokenization
+    return tokenization
+
+
+class MemoizedFullTokenizer(object):
+    """FullTokenizer with cached word segmentations.
+
+    Wraps a reference FullTokenizer, using its vocabulary and the given
+    basic tokenizer (default that of the reference), and provides the
+    same tokenize() and conversion methods as well as tokenize_to_ids().
+    """
+
+    def __init__(self, reference, cache_size=DEFAULT_CACHE_SIZE,
+                 basic_tokenizer=None):
+        self.reference = reference
+        self.vocab = reference.vocab
+        self.inv_vocab = reference.inv_vocab
+        if basic_tokenizer is None:
+            basic_tokenizer = reference.basic_tokenizer
+        self.basic_tokenizer = basic_tokenizer
+        wordpiece = reference.wordpiece_tokenizer
+        self.unk_token = wordpiece.unk_token
+        self.max_input_chars_per_word = wordpiece.max_input_chars_per_word
+        # Longest possible pieces at word start and continuing a word
+        self.max_initial = max((len(v) for v in self.vocab), default=0)
+        self.max_continuation = max(
+            (len(v)-2 for v in self.vocab if v.startswith('##')), default=0)
+        self.segment = lru_cache(maxsize=cache_size)(self._segment)
+
+    def _segment(self, word):
+        # Return tuples of wordpieces and their ids for word
+        vocab = self.vocab
+        if len(word) > self.max_input_chars_per_word:
+            pieces = [self.unk_token]
+        else:
+            pieces, start = [], 0
+            while start < len(word):
+                if start == 0:
+                    end = min(len(word), self.max_initial)
+                else:
+                    end = min(len(word), start + self.max_continuation)
+                piece = None
+                while start < end:
+                    substr = word[start:end]
+                    if start > 0:
+                        substr = '##' + substr
+                    if substr in vocab:
+                        piece = substr
+                        break
+                    end -= 1
+                if piece is None:
+                    pieces = [self.unk_token]
+                    break
+                pieces.append(piece)
+                start = end
+        return tuple(pieces), tuple(vocab[p] for p in pieces)
+
+    def tokenize(self, text):
+        pieces = []
+        for word in self.basic_tokenizer.tokenize(text):
+            pieces.extend(self.segment(word)[0])
+        return pieces
+
+    def tokenize_to_ids(self, text):
+        ids = []
+        for word in self.basic_tokenizer.tokenize(text):
+            ids.extend(self.segment(word)[1])
+        return ids
+
+    def convert_tokens_to_ids(self, tokens):
+        return [self.vocab[t] for t in tokens]
+
+    def convert_ids_to_tokens(self, ids):
+        return [self.inv_vocab[i] for i in ids]
+
+    def cache_info(self):
+        # Return (hits, misses, current size) of the word cache
+        info = self.segment.cache_info()
+        return info.hits, info.misses, info.currsize
+
+
+def report_cache(tokenizer, out=sys.stderr):
+    hits, misses, size = tokenizer.cache_info()
+    print('wordpiece cache: {} hits, {} misses ({:.1%} hit rate), {} '
+          'words'.format(hits, misses, hits/max(1, hits+misses), size),
+          file=out)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    tokenization = import_tokenization(args.bert_dir)
+    reference = tokenization.FullTokenizer(
+        vocab_file=args.vocab, do_lower_case=args.lower)
+    tokenizer = MemoizedFullTokenizer(
+        reference, args.cache_size, FastBasicTokenizer(args.lower))
+    lines, mismatches = 0, 0
+    for fn in args.file:
+        with corpusio.open_text(fn) as f:
+            for ln, l in enumerate(f, start=1):
+                tokens = tokenizer.tokenize(l)
+                lines += 1
+                if not args.verify:
+                    print(' '.join(tokens))
+                elif tokens != reference.tokenize(l):
+                    mismatches += 1
+                    print('{}:{}: mismatch: {}'.format(fn, ln, l.rstrip('\n')),
+                          file=sys.stderr)
+    hits, misses, _ = tokenizer.cache_info()
+    stagemetrics.count('lines-in', lines)
+    stagemetrics.count('cache-hits', hits)
+    stagemetrics.count('cache-misses', misses)
+    report_cache(tokenizer)
+    if args.verify:
+        print('verified {} lines, {} mismatches'.format(lines, mismatches),
+              file=sys.stderr)
+        return 1 if mismatches else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(stagemetrics.run_main(main, sys.argv))
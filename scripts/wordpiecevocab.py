@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+# Learn a WordPiece vocabulary from the word counts of a corpus.
+#
+# Lines of the input files are basic tokenized as for BERT
+# (FastBasicTokenizer) and the words counted in parallel in bounded
+# memory into a count table (countengine.py). Each word is then split
+# into its first character and "##"-prefixed continuation characters,
+# and the pair of adjacent pieces with the highest count over all words
+# is merged repeatedly (as in BPE) until the vocabulary has the
+# requested number of pieces. Pair counts are updated incrementally for
+# the words containing each merged pair, and the most frequent pair is
+# found with a heap whose outdated entries are skipped when popped. The
+# vocabulary is written in the format of vocabs/LC/cased/vocab.txt:
+# special tokens, pieces in the order learned, and single characters by
+# frequency.
+
+import sys
+import os
+import heapq
+import shutil
+import tempfile
+
+from collections import Counter, defaultdict
+
+import corpusio
+import countengine
+import stagemetrics
+
+
+
+# Tokens at the start of the vocabulary, in order
+SPECIAL_TOKENS = (
+    ['[PAD]'] +
+    ['[unused{}]'.format(i) for i in range(100)] +
+    ['[UNK]', '[CLS]', '[SEP]', '[MASK]']
+)
+
+# Longer words are [UNK] for WordpieceTokenizer and not learned from
+MAX_WORD_CHARS = 100
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Learn WordPiece vocabulary.')
+    countengine.add_count_arguments(ap)
+    ap.add_argument('-c', '--counts', metavar='TABLE', default=None,
+                    help='Read word counts from TABLE instead of counting')
+    ap.add_argument('-C', '--character-coverage', metavar='RATIO',
+                    default=0.9999, type=float,
+                    help='Ratio of character occurrences to cover; words ' +
+                    'with rarer characters are ignored (default 0.9999)')
+    ap.add_argument('-f', '--min-frequency', metavar='N', default=2,
+                    type=int, help='Minimum count of merged pairs ' +
+                    '(default 2)')
+    ap.add_argument('-s', '--save-counts', metavar='TABLE', default=None,
+                    help='Save word counts to count table TABLE')
+    ap.add_argument('-v', '--vocab-size', metavar='N', default=20000,
+                    type=int, help='Number of pieces, excluding special ' +
+                    'tokens (default 20000)')
+    ap.add_argument('-w', '--min-word-count', metavar='N', default=1,
+                    type=int, help='Ignore words occurring fewer than N ' +
+                    'times (default 1)')
+    ap.add_argument('--uncased', default=False, action='store_true',
+                    help='Lowercase and strip accents (for uncased model)')
+    ap.add_argument('file', nargs='*', help='File or directory')
+    return ap
+
+
+def load_counts(path, min_count=1):
+    # Return Counter of words in count table with at least min_count
+    return Counter({
+        word: count for word, count in countengine.read_table(path)
+        if count >= min_count
+    })
+
+
+def count_words(fns, options):
+    # Count basic tokens in files into a count table (a temporary one
+    # unless saving counts) and return Counter of words from it
+    if options.save_counts is not None:
+        countengine.count_files(fns, options.save_counts,
+                                ('basic', 1, options.uncased), options)
+        return load_counts(options.save_counts, options.min_word_count)
+    tmpdir = tempfile.mkdtemp(prefix='wordpiecevocab-', dir=options.tmpdir)
+    try:
+        path = os.path.join(tmpdir, 'counts')
+        countengine.count_files(fns, path, ('basic', 1, options.uncased),
+                                options)
+        return load_counts(path, options.min_word_count)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def covered_characters(counts, coverage):
+    # Return the set of most frequent characters covering the given
+    # ratio of character occurrences
+    char_counts = Counter()
+    for word, count in counts.items():
+        for c in word:
+            char_counts[c] += count
+    total, covered, characters = sum(char_counts.values()), 0, set()
+    for c, count in sorted(char_counts.items(), key=lambda i: (-i[1], i[0])):
+        if covered >= coverage * total:
+            break
+        characters.add(c)
+        covered += count
+    return characters
+
+
+class WordPieceLearner(object):
+    """Learns WordPiece vocabularies by merging frequent piece pairs."""
+
+    def __init__(self, counts, characters):
+        self.pieces = []       # piece strings by id
+        self.piece_ids = {}
+        self.words = []        # words as lists of piece ids
+        self.word_counts = []
+        self.alphabet = Counter()
+        for word, count in sorted(counts.items()):
+            if len(word) > MAX_WORD_CHARS or not set(word) <= characters:
+                continue
+            pieces = [word[0]] + ['##' + c for c in word[1:]]
+            self.words.append([self.piece_id(p) for p in pieces])
+            self.word_counts.append(count)
+            for p in pieces:
+                self.alphabet[p] += count
+        self.pair_counts = defaultdict(int)
+        self.pair_words = defaultdict(set)
+        for w, word in enumerate(self.words):
+            for pair in zip(word, word[1:]):
+                self.pair_counts[pair] += self.word_counts[w]
+                self.pair_words[pair].add(w)
+        self.heap = [(-c, p) for p, c in self.pair_counts.items()]
+        heapq.heapify(self.heap)
+
+    def piece_id(self, piece):
+        if piece not in self.piece_ids:
+            self.piece_ids[piece] = len(self.pieces)
+            self.pieces.append(piece)
+        return self.piece_ids[piece]
+
+    def most_frequent_pair(self):
+        # Return the pair with the highest count and the count, or
+        # (None, 0) if there are no pairs
+        while self.heap:
+            count, pair = heapq.heappop(self.heap)
+            if self.pair_counts.get(pair) == -count:
+                return pair, -count
+        return None, 0
+
+    def merge(self, pair):
+        # Merge pair in all words containing it and return the new
+        # piece, updating the counts of affected pairs.
+        first, second = pair
+        merged = self.piece_id(self.pieces[first] +
+                               self.pieces[second][2:])
+        changed = set()
+        for w in self.pair_words.pop(pair):
+            word, count = self.words[w], self.word_counts[w]
+            new_word, i = [], 0
+            while i < len(word):
+                if (i+1 < len(word) and word[i] == first and
+                        word[i+1] == second):
+                    new_word.append(merged)
+                    i += 2
+                else:
+                    new_word.append(word[i])
+                    i += 1
+            if len(new_word) == len(word):
+                continue    # pair no longer in word
+            for p in zip(word, word[1:]):
+                self.pair_counts[p] -= count
+                changed.add(p)
+            for p in zip(new_word, new_word[1:]):
+                self.pair_counts[p] += count
+                self.pair_words[p].add(w)
+                changed.add(p)
+            self.words[w] = new_word
+        for p in changed:
+            count = self.pair_counts[p]
+            if count > 0:
+                heapq.heappush(self.heap, (-count, p))
+            else:
+                del self.pair_counts[p]
+                self.pair_words.pop(p, None)
+        return self.pieces[merged]
+
+    def learn(self, size, min_frequency=2):
+        # Return list of merged pieces in order learned and list of
+        # single-character pieces by frequency, together at most size
+        characters = [p for p, c in sorted(self.alphabet.items(),
+                                           key=lambda i: (-i[1], i[0]))]
+        known, merged = set(characters), []
+        while len(characters) + len(merged) < size:
+            pair, count = self.most_frequent_pair()
+            if pair is None or count < min_frequency:
+                break
+            piece = self.merge(pair)
+            if piece not in known:
+                known.add(piece)
+                merged.append(piece)
+        return merged, characters[:max(0, size-len(merged))]
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    if args.counts is not None:
+        counts = load_counts(args.counts, args.min_word_count)
+    elif args.file:
+        fns = [fn for fn, _ in corpusio.list_files(args.file)]
+        counts = count_words(fns, args)
+    else:
+        print('error: no files or --counts given', file=sys.stderr)
+        return 1
+    stagemetrics.count('words', sum(counts.values()))
+    stagemetrics.count('unique-words', len(counts))
+    print('counted {} words, {} unique'.format(
+        sum(counts.values()), len(counts)), file=sys.stderr)
+    characters = covered_characters(counts, args.character_coverage)
+    learner = WordPieceLearner(counts, characters)
+    merged, characters = learner.learn(args.vocab_size, args.min_frequency)
+    stagemetrics.count('pieces', len(merged) + len(characters))
+    print('learned {} pieces from {} words, {} characters'.format(
+        len(merged), len(learner.words), len(characters)), file=sys.stderr)
+    for token in SPECIAL_TOKENS + merged + characters:
+        print(token)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(stagemetrics.run_main(main, sys.argv))